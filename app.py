@@ -7,66 +7,81 @@ https://github.com/Dimitar5555/sofiatraffic-schedules
 The APIs are not documented, likely to change with no notice.
 """
 import sys
-import os
+import argparse
+import csv
+import io
+import zipfile
 from pathlib import Path
 import json
-import urllib
 from datetime import date
 from datetime import timedelta
 from string import capwords
-import zipfile
 import logging
-import requests
 #from utils import generate_track_from_segments
 from utils import generate_timetables_for_schedule
+from client import get_client
+from fetch import fetch_in_order
+from cache import get_cache, set_offline
+from fragments import FragmentStore
+from interning import RouteRegistry
+from sink import FeedSink
+from transform import transform_in_order
+from feed import TRIPS_HEADER, STOP_TIMES_HEADER, write_rows
+from shapes import SHAPES_HEADER
+from frequencies import FREQUENCIES_HEADER
+from metrics import get_metrics
+from validate import validate_feed, ValidationError
+from sqlite_export import export_sqlite
+from columnar import columnar_available
+from timetable import build_index
+from spatial import StopRelations, TRANSFERS_HEADER
+from versions import VersionStore, build_manifest
+from logs import configure_logging, EventCounter
+from stages import Stage, StageGraph, PlanError, RUN, previous_timings
 
 from const import (
     SCHEDULES_URL,
     STOPS_URL,
 #    VIRTUAL_TABLE_URL,
-    LINES_URL
-
+    LINES_URL,
+    FETCH_WORKERS,
+    TRANSFORM_WORKERS,
+    COMPACT_FREQUENCIES,
+    SQLITE_EXPORT,
+    SQLITE_DB,
+    TIMETABLE_OUTPUT,
+    TIMETABLE_INDEX,
+    COLUMNAR_OUTPUT,
+    COLUMNAR_DIR,
+    TRANSFER_RADIUS,
+    DATASET_DIR,
+    DATASET_ZIP,
+    WRITE_TXT,
 )
 logger = logging.getLogger(__name__)
 
 
 def get_sofia_traffic_session():
-    """open a session to Sofia TRaffic and return it to the calling funciton
-      example from 
-#     https://bobbyhadz.com/blog/how-to-use-cookies-in-python-requests
-#   """
-    session = requests.Session()
-    r =  session.get('https://sofiatraffic.bg/bg/public-transport')
-    return session
+    """return the pooled session of the shared sofiatraffic.bg client
+      the tokens are fetched once and reused by all the API calls
+    """
+    return get_client().session
 
 
 def fetch_data_from_sofiatraffic(url, payload):
     """
     Send a POST request to url and return the body
+    the shared client re-uses the connection and the tokens between calls
+    successful responses are streamed into the response cache and served from
+    it until they expire, in offline mode only the cache is used
     """
-    # check if this has already been called so we can re-use it?
-    session = get_sofia_traffic_session()
-    tokens = session.cookies.get_dict()
-    # custom headers
-    headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "en-GB,en;q=0.9",
-            "Accept-Encoding": "gzip, deflate, br",
-            "X-Requested-With": "XMLHttpRequest",
-            "Content-Type": "application/json",
-            "X-XSRF-TOKEN": urllib.parse.unquote(tokens['XSRF-TOKEN']),
-            "Cookie": 'sofia_traffic_session='+
-            urllib.parse.unquote(tokens['sofia_traffic_session']),
-           "Sec-Fetch-Dest": "empty",
-            "Sec-Fetch-Mode": "cors",
-            "Sec-Fetch-Site": "same-origin",
-            "Priority": "u=1",
-            "Pragma": "no-cache",
-            "Cache-Control": "no-cache",
-            "Referrer": "https://www.sofiatraffic.bg/bg/public-transport",
-            "TE": "trailers"}
-
-    response = session.post(url, headers=headers, data=payload, timeout=(3.05, 27) )
+    cache = get_cache()
+    response = cache.get(url, payload)
+    if response is None:
+        response = get_client().post(url, payload,
+                                     store=lambda chunks: cache.put_stream(url, payload, chunks))
+        if response.status_code == 200:
+            response = response.stored
     return response
 
 def get_all_stops():
@@ -93,17 +108,18 @@ def get_schedule(ext_id: str):
     response = fetch_data_from_sofiatraffic(SCHEDULES_URL,payload=payload)
     return response
 
-def generate_stops_txt():
+def generate_stops_txt(sink: FeedSink, list_of_stops: list = None):
     """
-    call get_all_stops() and generate a gtfs-compliant stops.txt file
+    call get_all_stops() (unless the stops are given) and generate a gtfs-compliant stops.txt file
     stop_id, stop_code, stop_name, stop_lat, stop_lon
     some of the names contain comma which trips a validator error
     dirty fix - replace comma with space
+    returns the stops for generate_transfers_txt
     """
-    list_of_stops = get_all_stops().json()
-    file_name = 'gtfs/stops.txt'
-    with open(file_name, 'wt', encoding="utf-8") as fd:
-        fd.write("stop_id, stop_code, stop_name, stop_lat, stop_lon\n")
+    if list_of_stops is None:
+        list_of_stops = get_all_stops().json()
+    with sink.open('stops.txt') as fd:
+        fd.write("stop_id,stop_code,stop_name,stop_lat,stop_lon\n")
         for cgm_stop in list_of_stops:
             ## testing with stop["code"] instead of stop["id"]
 #            string = str(cgm_stop["id"])+\
@@ -113,8 +129,107 @@ def generate_stops_txt():
                 ","+str(cgm_stop["latitude"])+\
                 ","+str(cgm_stop["longitude"]+"\n")
             fd.write(string)
+    return list_of_stops
 
-def generate_agency_txt():
+def generate_transfers_txt(sink: FeedSink, list_of_stops: list):
+    """
+    generate transfers.txt: the stops within TRANSFER_RADIUS meters of each other
+    with the time to walk between them, found on a grid index (spatial.py)
+    the stops that look like one listed twice are logged and reported too
+    """
+    relations = StopRelations(list_of_stops)
+    rows = relations.transfer_rows()
+    with sink.open('transfers.txt') as fd:
+        fd.write(TRANSFERS_HEADER)
+        fd.write(write_rows(rows))
+    relations.write_report()
+    get_metrics().add('stops', {'transfers': len(rows), 'duplicates': len(relations.duplicates)})
+    logger.info("transfers.txt: %s transfers, %s suspected duplicate stops",
+                len(rows), len(relations.duplicates))
+    for duplicate in relations.duplicates[:10]:
+        logger.warning("stop %s looks like a duplicate of %s (%s, %s m apart)",
+                       duplicate['stop_id'], duplicate['duplicate_of'], duplicate['reason'],
+                       duplicate['meters'])
+
+def published_members(zip_path=DATASET_ZIP):
+    """
+    the names of the members of the published archive, none without one
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            return set(archive.namelist())
+    except (OSError, zipfile.BadZipFile):
+        return set()
+
+def carry_members(sink: FeedSink, names, zip_path=DATASET_ZIP):
+    """
+    copy members of the published archive into the sink unchanged,
+    for the stages left out of a partial run
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        present = set(archive.namelist())
+        for name in names:
+            if name not in present:
+                continue
+            with archive.open(name) as source, sink.open(name) as fd:
+                text = io.TextIOWrapper(source, encoding='utf-8', newline='')
+                for block in iter(lambda: text.read(1 << 20), ''):
+                    fd.write(block)
+
+def realigned_rows(reader, present: list, header: str):
+    """
+    the rows of reader, a csv file with the columns present, with the columns
+    of header in its order; the ones the file lacks are left empty, i.e. the
+    shape_id of an archive written before shapes.txt
+    """
+    columns = [present.index(name) if name in present else None
+               for name in header.rstrip('\n').split(',')]
+    for row in reader:
+        if row:
+            yield [row[index] if index is not None and index < len(row) else ''
+                   for index in columns]
+
+def carry_other_lines(fd_trips, fd_stop_times, fd_shapes, fd_frequencies, line_ids: set,
+                      zip_path=DATASET_ZIP):
+    """
+    copy the rows of every line but line_ids from the published archive:
+    their trips, the stop_times and frequencies of those trips and the shapes
+    they use; returns the trip ids and the shape ids written
+    the columns are taken by name into the headers written now, so an archive
+    of an earlier layout is carried over too
+    """
+    trip_ids = set()
+    shape_ids = set()
+    with zipfile.ZipFile(zip_path) as archive:
+        present = set(archive.namelist())
+        with archive.open('trips.txt') as source:
+            reader = csv.reader(io.TextIOWrapper(source, encoding='utf-8-sig', newline=''))
+            columns = TRIPS_HEADER.rstrip('\n').split(',')
+            route, trip, shape = (columns.index(name) for name in ('route_id', 'trip_id', 'shape_id'))
+            rows = [row for row in realigned_rows(reader, next(reader, []), TRIPS_HEADER)
+                    if row[route] not in line_ids]
+        fd_trips.write(write_rows(rows))
+        trip_ids.update(row[trip] for row in rows)
+        shape_ids.update(row[shape] for row in rows if row[shape])
+        for name, fd, header, ids in (
+                ('stop_times.txt', fd_stop_times, STOP_TIMES_HEADER, trip_ids),
+                ('frequencies.txt', fd_frequencies, FREQUENCIES_HEADER, trip_ids),
+                ('shapes.txt', fd_shapes, SHAPES_HEADER, shape_ids)):
+            if fd is None or name not in present:
+                continue
+            with archive.open(name) as source:
+                text = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+                first = text.readline()
+                if first.rstrip('\r\n') == header.rstrip('\n'):
+                    #the trip or shape id comes first in these files
+                    fd.writelines(line for line in text if line.partition(',')[0] in ids)
+                    continue
+                rows = realigned_rows(csv.reader(text), next(csv.reader([first]), []), header)
+                fd.write(write_rows(row for row in rows if row[0] in ids))
+    logger.info('kept %s trips of the other lines from %s', len(trip_ids), zip_path)
+    return trip_ids, shape_ids
+
+def generate_agency_txt(sink: FeedSink):
     """
     generate the gtfs-comliant file agencies.txt
     format: agency_id,agency_name,agency_url,agency_timezone,agency_lang
@@ -125,12 +240,11 @@ def generate_agency_txt():
     agencies.append("sfagency_001,Столичен електротранспорт ЕАД, http://www.elektrotransportsf.com, EET, bg\n")
     agencies.append("sfagency_002, Столичен автотранспорт ЕАД, https://www.sofiabus.bg, EET, bg\n")
     agencies.append("sfagency_003, Метрополитен ЕАД, https://www.metropolitan.bg, EET, bg\n")
-    file_name = 'gtfs/agency.txt'
-    with open(file_name, 'wt', encoding="utf-8") as fd:
+    with sink.open('agency.txt') as fd:
         for agency in agencies:
             fd.write(agency)
 
-def generate_routes_txt(list_of_lines: list):
+def generate_routes_txt(sink: FeedSink, list_of_lines: list):
     """
     generate the gtfs-comliant file routes.txt
     route_id ,agency_id, route_short_name,route_type, route_color
@@ -150,8 +264,7 @@ def generate_routes_txt(list_of_lines: list):
     temp_agency = ''
 #    list_of_lines = (get_all_lines().json())
     logger.info("Generating routes.txt")
-    file_name = 'gtfs/routes.txt'
-    with open(file_name, 'wt', encoding="utf-8") as fd:
+    with sink.open('routes.txt') as fd:
         fd.write("route_id,agency_id,route_short_name,route_type,route_color\n")
         for intput_line in list_of_lines:
             if intput_line["type"] == 1: #bus
@@ -178,7 +291,10 @@ def generate_routes_txt(list_of_lines: list):
                     str(intput_line["color"]).replace("#","")+"\n"
             fd.write(string)
 
-def generate_trips_and_stop_times_txt(list_of_lines: list):
+def generate_trips_and_stop_times_txt(sink: FeedSink, list_of_lines: list, workers: int = FETCH_WORKERS,
+                                      transform_workers: int = TRANSFORM_WORKERS,
+                                      frequencies: bool = COMPACT_FREQUENCIES,
+                                      other_lines_from: str = None):
     """
     list_of_lines: list of jsons
         line_id: int
@@ -260,89 +376,82 @@ def generate_trips_and_stop_times_txt(list_of_lines: list):
     for every time in the array write a line in stop_times
 
     favour multiple itterations over arrays vs multiple calls to the api
+    the schedules are prefetched by workers threads, at most FETCH_RATE_LIMIT
+    requests per second (see client.py), and processed in the order of list_of_lines
+    lines whose schedule did not change since the last run reuse the stored rows,
+    the others are transformed on transform_workers processes (1 - in process)
+    and merged back in the order of list_of_lines
+    shapes.txt is written along, every distinct shape once however many
+    routes and lines share it
+    with frequencies the regular-headway trips are replaced by frequencies.txt entries
+    a route already written for an earlier line is not transformed again and skipped
+    with other_lines_from (an archive) only list_of_lines is rebuilt, the rows
+    of the other lines are copied from the archive, with their frequencies.txt
+    entries whether frequencies is set or not
     """
-    file_name_trips = 'gtfs/trips.txt'
-    file_name_stop_times = 'gtfs/stop_times.txt'
-    timepoint = str(0) #arrival and departure times are approximate <-- move to contstants?
-    with open(file_name_trips, 'wt', encoding="utf-8") as fd_trips, open(file_name_stop_times, 'wt', encoding="utf-8") as fd_stop_times:
+    store = FragmentStore(variant='frequencies' if frequencies else '')
+    shape_ids = set()
+    shape_refs = 0
+    #counted per line, route and stop and logged once at the end
+    anomalies = {'duplicates': EventCounter('duplicate stop times dropped'),
+                 'backwards': EventCounter('stop times going backwards raised')}
+    compaction = {'trips': 0, 'stop_times': 0, 'bytes': 0}
+    #the trips of the other lines may have been compacted when the archive was built
+    carried_frequencies = bool(other_lines_from) and \
+        'frequencies.txt' in published_members(other_lines_from)
+    fd_frequencies = sink.open('frequencies.txt') if frequencies or carried_frequencies else None
+    if fd_frequencies:
+        fd_frequencies.write(FREQUENCIES_HEADER)
+    with sink.open('trips.txt') as fd_trips, sink.open('stop_times.txt') as fd_stop_times, \
+            sink.open('shapes.txt') as fd_shapes:
         logger.info('Generating trips.txt...')
         #header for the trips file
-        fd_trips.write("route_id,service_id,trip_id,trip_headsign\n")
+        fd_trips.write(TRIPS_HEADER)
         logger.info('Generating stop_times.txt...')
         #header for the stop_times file
-        fd_stop_times.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence,timepoint\n")
-        for line in list_of_lines:
-            logger.debug("processing line %s",line["ext_id"])
-            #these are repeated calls to the API
-            #wrap in some timeout logic, sleep cycle if something fails...
-            schedule = get_schedule(line['ext_id'])
-            for route in schedule.json()['routes']:
-                ##!!! Don't forget to check if the route is active
-                #try if route["details"].["is_active"]:
-                logger.debug('Processing route %s',str(route["id"]))
-                sequence = 1
-                #try to innitialize trips once per route
-                trips = []
-                #debug_max_trips_per_route = 0
-                for segment in route["segments"]:
-                    stop = segment["stop"]
-                    if stop["is_active"]:
-                        #check for duplicate times to workaround sofiatraffic.bg errors
-                        #init temp variable for the workatround
-                        temp_time_str = ''
-                        for time in stop['times']:
-                            #check for duplicate times to workaround sofiatraffic.bg errors
-                            if str(time['time']) != temp_time_str:
-                                #separate secondaries - what are they actually?
-                                if 'secondary' in time:
-                                    if time['secondary']:
-                                        time['id'] = 'sec'+str(time['id'])
-                                        logger.debug('newtimeid=%s',time['id'])
-                                if time['weekend']:
-                                    temp_trip_id = str(route["ext_id"])+'weekend'+str(time['id'])
-                                    if temp_trip_id not in trips:
-                                    #route_id,service_id,trip_id,trip_headsign\n
-                                        trips.append(str(str(line["line_id"])+","+
-                                                "holiday_service,"+temp_trip_id+","+
-                                                capwords(str(route["name"]).replace(',',' ')))+"\n")
-                                else:
-                                    temp_trip_id = str(route["ext_id"])+'weekday'+str(time['id'])
-                                    if temp_trip_id not in trips:
-                                    #route_id,service_id,trip_id,trip_headsign\n
-                                        trips.append(str(str(line["line_id"])+","+
-                                                "weekday_service,"+temp_trip_id+","+
-                                                capwords(str(route["name"]).replace(',',' ')))+"\n")
-
-                                #trip_id,arrival_time,departure_time,stop_id,stop_sequence,timepoint\n
-                                #if time is after midnight, switch 00:02 to 24:02
-                                #warning - edge case - departure time 24:55, arrival time 01:00 
-                                if str(time['time']).startswith('00'):
-                                    time['time'] = '24'+str(time['time'])[2:]
-                                fd_stop_times.write(temp_trip_id+","+
-                                                    str(time['time'])+","+
-                                                    str(time['time'])+","+
-                                                    str(stop["code"])+","+
-                                                    str(sequence)+","+
-                                                    timepoint+"\n")
-                                #store the current time iterration in the temp variable
-                                temp_time_str = str(time['time'])
-                            else:
-                                #duplicate found
-                                logger.warning("duplicate found")
-                        #logger.info("route %s stop %s trips %s", str(temp_trip_id),str(stop['code']),str(debug_max_trips_per_route))
-                        #make sure trip value are unique
-                        #turn the list into a dict - unique values, oredered
-                        trips = list(dict.fromkeys(trips))
-                        # temp_time_weekend.sort()
-                    sequence+=1
-                for trip in trips:
-                    fd_trips.writelines(trip)
-                logger.debug("Logged %s trips", len(trips))
-
-                logger.debug('Processing route %s complete',route["id"])
-            logger.debug("processing line %s complete",line["ext_id"])
-
-def generate_calendar_txt():
+        fd_stop_times.write(STOP_TIMES_HEADER)
+        logger.info('Generating shapes.txt...')
+        fd_shapes.write(SHAPES_HEADER)
+        carried_trips = ()
+        if other_lines_from:
+            carried_trips, carried_shapes = carry_other_lines(
+                fd_trips, fd_stop_times, fd_shapes, fd_frequencies,
+                {str(line['line_id']) for line in list_of_lines}, other_lines_from)
+            shape_ids.update(carried_shapes)
+        #a route shared with a carried line was written under that line
+        routes = RouteRegistry(carried_trips)
+        schedules = fetch_in_order(lambda line: get_schedule(line['ext_id']),
+                                   list_of_lines, workers)
+        for line, tables in transform_in_order(schedules, store, transform_workers, frequencies,
+                                               routes):
+            for kind, counter in anomalies.items():
+                for route_id, stop_code, count in tables.get('anomalies', {}).get(kind, ()):
+                    counter.add((line['ext_id'], route_id, stop_code), count)
+            fd_trips.write(tables['trips'])
+            fd_stop_times.write(tables['stop_times'])
+            for shape_id, shape_rows in tables['shapes'].items():
+                shape_refs += 1
+                if shape_id not in shape_ids:
+                    shape_ids.add(shape_id)
+                    fd_shapes.write(shape_rows)
+            if frequencies:
+                fd_frequencies.write(tables['frequencies'])
+                for key, value in tables['compaction'].items():
+                    compaction[key] += value
+    if fd_frequencies:
+        fd_frequencies.close()
+    if frequencies:
+        get_metrics().add('frequencies', compaction)
+        logger.info('frequencies.txt replaced %s trips and %s stop_times rows, %s bytes saved',
+                    compaction['trips'], compaction['stop_times'], compaction['bytes'])
+    logger.info('shapes.txt: %s distinct shapes for %s routes', len(shape_ids), shape_refs)
+    for kind, counter in anomalies.items():
+        counter.log(logger)
+    get_metrics().add('anomalies', {kind: counter.as_dict() for kind, counter in anomalies.items()})
+    routes.log_stats()
+    store.log_stats()
+
+def generate_calendar_txt(sink: FeedSink):
     """
     generate the calendars.txt file describing different schedules as needed.
     static information.
@@ -351,8 +460,7 @@ def generate_calendar_txt():
     start_date = date.today()
     end_date = start_date + timedelta(days=7)
     logger.info("generating calendar.txt")
-    file_name = 'gtfs/calendar.txt'
-    with open(file_name, 'wt', encoding="utf-8") as fd:
+    with sink.open('calendar.txt') as fd:
         #header
         fd.write("service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n")
         #weekday, week night, holiday + night
@@ -361,86 +469,232 @@ def generate_calendar_txt():
         fd.write("weekday_service_night,1,1,1,1,1,0,0,"+start_date.strftime("%Y%m%d")+","+end_date.strftime("%Y%m%d")+"\n")
         fd.write("holiday_service_night,0,0,0,0,0,1,1,"+start_date.strftime("%Y%m%d")+","+end_date.strftime("%Y%m%d")+"\n")
 
-def generate_feed_info_txt():
+def generate_feed_info_txt(sink: FeedSink):
     """
     Add metadata for the dataset
     """
     start_date = date.today()
     end_date = start_date + timedelta(days=7)
-    file_name = 'gtfs/feed_info.txt'
-    with open(file_name, 'wt', encoding="utf-8") as fd:
+    with sink.open('feed_info.txt') as fd:
         fd.write("feed_publisher_name,feed_publisher_url,feed_lang,feed_start_date,feed_end_date\n")
         fd.write("ddppddpp,https://github.com/ddppddpp/sofia_gtfs_py_gen,bg,"+start_date.strftime("%Y%m%d")+","+end_date.strftime("%Y%m%d")+"\n")
 
-def create_dataset_zip():
+def validate_and_record(zip_path, metrics):
     """
-    Create a .zip of the files
+    validate the finished archive, the outcome goes in the run metrics
     """
-    # check how not to create a directory
-    fileset= ['gtfs/agency.txt','gtfs/calendar.txt','gtfs/routes.txt',
-    'gtfs/stop_times.txt','gtfs/stops.txt','gtfs/trips.txt','gtfs/feed_info.txt']
-    try:
-        with zipfile.ZipFile('gtfs/SofiaTraffic.zip', 'a', compression=zipfile.ZIP_DEFLATED) as myzip:
-            # myzip.write('gtfs/agency.txt')
-            # myzip.write('gtfs/calendar.txt')
-            # myzip.write('gtfs/routes.txt')
-            # myzip.write('gtfs/stop_times.txt')
-            # myzip.write('gtfs/stops.txt')
-            # myzip.write('gtfs/trips.txt')
-            # myzip.write('gtfs/feed_info.txt')
-            for file in fileset:
-                myzip.write(file,os.path.basename(file))
-        myzip.close()
-        os.sync()
-    except zipfile.BadZipFile as error:
-        logger.error(error)
-
-def generate_gtfs():
+    with metrics.stage('validate'):
+        report = validate_feed(zip_path, raise_on_error=False)
+    metrics.add('validation', {'valid': report.valid, 'errors': report.errors,
+                               'warnings': report.warnings})
+    if not report.valid:
+        raise ValidationError(report)
+
+def check_new_version(zip_path, metrics, store: VersionStore, manifests: list):
+    """
+    validate the finished archive and hash it, False (do not publish) when it
+    holds the version already published, its manifest is added to manifests
+    """
+    validate_and_record(zip_path, metrics)
+    with metrics.stage('manifest'):
+        manifest = build_manifest(zip_path)
+    unchanged = store.unchanged(manifest) and Path(DATASET_ZIP).exists()
+    metrics.add('version', {'version': manifest['version'], 'published': not unchanged})
+    if unchanged:
+        logger.info('Version %s unchanged, nothing to publish', manifest['version'])
+        return False
+    manifests.append(manifest)
+    return True
+
+def stage_graph(sink: FeedSink, frequencies: bool = COMPACT_FREQUENCIES,
+                sqlite: bool = SQLITE_EXPORT, timetable: bool = TIMETABLE_OUTPUT, lines=None):
+    """
+    the stages of a run writing to sink (see stages.py): the API calls, one
+    stage per file, the archive and the copies made from it
+    the stages writing members can be carried over from the published archive,
+    with lines (ext_ids) only those lines are rebuilt and the others are kept
+    """
+    metrics = get_metrics()
+    previous = published_members()
+    store = VersionStore()
+    manifests = []
+
+    def carried(*names):
+        #the first member is the one the stage always writes
+        return {'carry': lambda results: carry_members(sink, names),
+                'can_carry': lambda: names[0] in previous}
+
+    def trips_and_stop_times(results):
+        list_of_lines = results['lines']
+        other_lines_from = None
+        if lines:
+            list_of_lines = select_lines(list_of_lines, lines)
+            if 'trips.txt' in previous:
+                other_lines_from = DATASET_ZIP
+            else:
+                logger.warning('no published archive, the feed holds only the lines %s',
+                               ', '.join(str(line['ext_id']) for line in list_of_lines))
+        generate_trips_and_stop_times_txt(sink, list_of_lines, frequencies=frequencies,
+                                          other_lines_from=other_lines_from)
+
+    def close_sink(results):
+        logger.info('Completing GTFS Generation')
+        logger.info('Creating Archive...')
+        return sink.close(check=lambda path: check_new_version(path, metrics, store, manifests))
+
+    def record_version(results):
+        if not results['zip']:
+            return None
+        manifest = manifests[0] if manifests else build_manifest(DATASET_ZIP)
+        if store.unchanged(manifest):
+            return None
+        return store.record(DATASET_ZIP, manifest)
+
+    #the copies of an unchanged feed are only made when missing
+    def sqlite_copy(results):
+        if results['zip'] or not Path(SQLITE_DB).exists():
+            export_sqlite(DATASET_ZIP, SQLITE_DB)
+
+    def timetable_index(results):
+        if results['zip'] or not Path(TIMETABLE_INDEX).exists():
+            build_index(DATASET_ZIP, TIMETABLE_INDEX)
+
+    graph = StageGraph()
+    graph.add(Stage('agency.txt', lambda results: generate_agency_txt(sink),
+                    **carried('agency.txt')))
+    graph.add(Stage('stops', lambda results: get_all_stops().json()))
+    graph.add(Stage('stops.txt', lambda results: generate_stops_txt(sink, results['stops']),
+                    needs=('stops',), **carried('stops.txt')))
+    if TRANSFER_RADIUS > 0:
+        graph.add(Stage('transfers.txt',
+                        lambda results: generate_transfers_txt(sink, results['stops']),
+                        needs=('stops',), **carried('transfers.txt')))
+    graph.add(Stage('lines', lambda results: get_all_lines().json()))
+    graph.add(Stage('routes.txt', lambda results: generate_routes_txt(sink, results['lines']),
+                    needs=('lines',), **carried('routes.txt')))
+    graph.add(Stage('calendar.txt', lambda results: generate_calendar_txt(sink),
+                    **carried('calendar.txt')))
+    graph.add(Stage('trips_and_stop_times.txt', trips_and_stop_times, needs=('lines',),
+                    **carried('trips.txt', 'stop_times.txt', 'shapes.txt', 'frequencies.txt')))
+    graph.add(Stage('feed_info.txt', lambda results: generate_feed_info_txt(sink),
+                    **carried('feed_info.txt')))
+    members = [name for name, stage in graph.stages.items() if stage.carry is not None]
+    #a carried archive is the published one, as if it had just been published
+    graph.add(Stage('zip', close_sink, needs=members, carry=lambda results: True,
+                    can_carry=lambda: bool(previous), always=True))
+    graph.add(Stage('versions', record_version, needs=('zip',), always=True))
+    if sqlite:
+        graph.add(Stage('sqlite', sqlite_copy, needs=('zip',), always=True))
+    if timetable:
+        graph.add(Stage('timetable', timetable_index, needs=('zip',), always=True))
+    return graph
+
+def select_lines(list_of_lines: list, lines):
+    """
+    the lines of list_of_lines with the ext_ids in lines, in any case;
+    raises PlanError naming the ones that do not exist
+    """
+    wanted = {ext_id.upper() for ext_id in lines}
+    selected = [line for line in list_of_lines if str(line['ext_id']).upper() in wanted]
+    missing = wanted - {str(line['ext_id']).upper() for line in selected}
+    if missing:
+        raise PlanError('no line %s' % ', '.join(sorted(missing)))
+    return selected
+
+def plan_run(graph: StageGraph, stages=None, lines=None):
+    """
+    the plan for the stages asked for, all by default or the trips of the lines
+    only with lines; the costs come from the previous run
+    raises PlanError when lines are given but the trips are not rebuilt or a
+    line does not exist, the line list is fetched (or read from the cache) for it
+    """
+    costs, rows = previous_timings()
+    trips_stage = 'trips_and_stop_times.txt'
+    if lines and rows.get('routes.txt') and costs.get(trips_stage):
+        costs[trips_stage] *= min(1.0, len(lines) / rows['routes.txt'])
+    if stages is None and lines:
+        stages = [trips_stage]
+    plan = graph.plan(stages, costs)
+    if lines:
+        if plan.actions.get(trips_stage) != RUN:
+            raise PlanError('--lines rebuilds the trips, add %s to the stages' % trips_stage)
+        #the line list is cached, the lines stage reads it again
+        select_lines(get_all_lines().json(), lines)
+    return plan
+
+def generate_gtfs(write_txt: bool = WRITE_TXT, frequencies: bool = COMPACT_FREQUENCIES,
+                  sqlite: bool = SQLITE_EXPORT, columnar: bool = COLUMNAR_OUTPUT,
+                  timetable: bool = TIMETABLE_OUTPUT, stages=None, lines=None,
+                  dry_run: bool = False):
     """
     call the various functions to generate the gtfs-compliant files
+    write_txt keeps a plain copy of every file next to the archive
+    frequencies compacts the regular-headway trips into frequencies.txt
+    sqlite loads the finished archive into SQLITE_DB as well
+    columnar writes typed Parquet copies of the big tables to COLUMNAR_DIR
+    timetable builds the next-departures index TIMETABLE_INDEX from the archive
+    stages - the names of the stages to run (stage_graph), the members of the
+    others are carried over from the published archive; all by default
+    lines - the ext_ids of the lines to rebuild, the rest of the feed is kept
+    dry_run prints the plan with the estimated seconds of every stage and stops
+    independent stages run at the same time, see stages.py
+    the stages and lines asked for are checked first, PlanError is raised
+    before anything is written
+    the stage timings, API latencies and row counts are written to
+    METRICS_JSON and METRICS_PROM at the end of the run, even a failed one
+    the archive is validated before it replaces the old one, errors in it
+    raise ValidationError and are detailed in VALIDATION_REPORT
+    an archive holding the version already published (VERSIONS_DIR) is not
+    published again, a new one is recorded there with its delta
     """
-    console_handler = logging.StreamHandler()
-    file_handler = logging.FileHandler(
-        "gtfs_gen.log", 
-        mode="a", 
-        encoding="utf-8"
-    )
-    logger.setLevel("DEBUG")
-    console_handler.setLevel("INFO")
-    file_handler.setLevel("DEBUG")
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s",
-        style="%",
-        datefmt="%Y-%m-%d %H:%M",
-    )
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-
-    # logging.basicConfig(
-    #     filename='gtfs_gen.log', 
-    #     level=logging.DEBUG, 
-    #     format="%(asctime)s - %(levelname)s - %(message)s",
-    #     style="%",
-    #     datefmt="%Y-%m-%d %H:%M",
-    # )
+    if dry_run:
+        print(plan_run(stage_graph(None, frequencies, sqlite, timetable, lines), stages,
+                       lines).describe())
+        return
+    configure_logging()
     logger.info('Starting GTFS Generation')
     #check if folder exists?
-    Path("./gtfs").mkdir(parents=True, exist_ok=True)
-    generate_agency_txt()
-    generate_stops_txt()
-    list_of_lines = (get_all_lines().json())
-    generate_routes_txt(list_of_lines)
-    generate_calendar_txt()
-    generate_trips_and_stop_times_txt(list_of_lines)
-    generate_feed_info_txt()
-    logger.info('Completing GTFS Generation')
-    #move existing .zip to archive??
-    logger.info('Creating Archive...')
-    #gzip the folder?
-    create_dataset_zip()
-    logger.info('Archive succesfully created. End.')
+    Path(DATASET_DIR).mkdir(parents=True, exist_ok=True)
+    #the members are streamed into the archive, which replaces the old one once complete
+    if columnar and not columnar_available():
+        logger.warning('pyarrow is not installed, no Parquet output')
+        columnar = False
+    sink = FeedSink(DATASET_ZIP, txt_dir=DATASET_DIR if write_txt else None,
+                    columnar_dir=COLUMNAR_DIR if columnar else None)
+    try:
+        graph = stage_graph(sink, frequencies, sqlite, timetable, lines)
+        plan = plan_run(graph, stages, lines)
+    except BaseException:
+        sink.abort()
+        raise
+    logger.debug('plan:\n%s', plan.describe())
+    metrics = get_metrics()
+    #the shared client and cache exist before the stages use them from several threads
+    get_client()
+    get_cache()
+    success = False
+    published = False
+    try:
+        results = graph.run(plan)
+        #the zip stage closes the sink, False when the version was already published
+        published = plan.actions.get('zip') == RUN and bool(results.get('zip'))
+        if plan.actions.get('zip') != RUN:
+            #nothing was written to the sink
+            sink.abort()
+        success = True
+    except BaseException:
+        sink.abort()
+        raise
+    finally:
+        get_client().log_stats()
+        get_cache().log_stats()
+        for file_name, rows in sink.row_counts().items():
+            metrics.set_rows(file_name, rows)
+        metrics.write_reports(success=success)
+    if published:
+        logger.info('Archive successfully created. End.')
+    else:
+        logger.info('No new archive published, %s kept. End.', DATASET_ZIP)
 
 def trips_and_stop_times_debug(list_of_lines: list):
     '''
@@ -490,6 +744,7 @@ def trips_and_stop_times_debug(list_of_lines: list):
 def debug_generate_schedule_json(ext_id: str):
     """ 
     call the schedules url with a line id and return a schedule
+    the response goes through the cache, so --offline dumps the cached copy
     """
     payload = json.dumps({"ext_id":ext_id})
     response = fetch_data_from_sofiatraffic(SCHEDULES_URL,payload=payload)
@@ -498,23 +753,72 @@ def debug_generate_schedule_json(ext_id: str):
         for chunk in response.iter_content(chunk_size=128):
             fd.write(chunk)
 
+def comma_list(text: str):
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+def parse_args(argv):
+    """
+    the command line, argv without the program name
+    """
+    parser = argparse.ArgumentParser(
+        prog='app.py', description='generate the gtfs dataset of Sofia from the sofiatraffic.bg APIs')
+    parser.add_argument('--offline', action='store_true',
+                        help='build everything from the response cache without network calls')
+    parser.add_argument('--no-txt', dest='write_txt', action='store_false', default=WRITE_TXT,
+                        help='write only the .zip, without the .txt copies')
+    parser.add_argument('--frequencies', action='store_true', default=COMPACT_FREQUENCIES,
+                        help='replace the regular-headway trips with frequencies.txt entries')
+    parser.add_argument('--sqlite', action='store_true', default=SQLITE_EXPORT,
+                        help='write an indexed sqlite copy of the feed too')
+    parser.add_argument('--parquet', dest='columnar', action='store_true', default=COLUMNAR_OUTPUT,
+                        help='write typed Parquet copies of stops, routes, trips and stop_times')
+    parser.add_argument('--timetable', action='store_true', default=TIMETABLE_OUTPUT,
+                        help='build the memory-mapped next-departures index')
+    parser.add_argument('--stages', type=comma_list, metavar='STAGE,...',
+                        help='run only these stages, the other files are kept from the published '
+                             'archive (--dry-run lists the stages)')
+    parser.add_argument('--lines', type=comma_list, metavar='EXT_ID,...',
+                        help='rebuild only the trips of these lines, i.e. A84,TM20, and keep the '
+                             'other lines from the published archive')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the stages that would run with their estimated seconds')
+    debug = parser.add_mutually_exclusive_group()
+    debug.add_argument('--debugschedule', metavar='EXT_ID',
+                       help='save the schedule of a line to gtfs/EXT_ID_schedule.json')
+    debug.add_argument('--debugtrip', nargs=2, metavar=('EXT_ID', 'TRIP_ID'),
+                       help='print the timetable of one trip of a line')
+    return parser.parse_args(argv)
+
 def main (argv):
     """"
-    call generate_gtfs()
-    """
-    if len(argv) == 1:
-    #check if we need to clear an old archive
-        generate_gtfs()
-    elif (len(argv) > 1) and (len(argv) < 3):
-        if str(argv[1]) == '--debugschedule':
-            debug_generate_schedule_json(argv[2])
-    elif len(argv) > 2:
-        if str(argv[1]) == '--debugtrip':
-            schedule = get_schedule(str(argv[2]))
-            generate_timetables_for_schedule(schedule, argv[3])
+    call generate_gtfs() with the options of the command line, see parse_args
+    (python app.py --help); --debugschedule and --debugtrip call the debug helpers instead
+    exits with 1 when the generated feed does not pass validation and with 2
+    when the stages asked for cannot be run
+    """
+    args = parse_args(argv[1:])
+    if args.offline:
+        set_offline()
+    if args.debugschedule:
+        debug_generate_schedule_json(args.debugschedule)
+    elif args.debugtrip:
+        ext_id, trip_id = args.debugtrip
+        schedule = get_schedule(ext_id)
+        generate_timetables_for_schedule(schedule, trip_id)
+    else:
+        try:
+            generate_gtfs(args.write_txt, args.frequencies, args.sqlite, args.columnar,
+                          args.timetable, args.stages, args.lines, args.dry_run)
+        except ValidationError as error:
+            logger.error('%s, the previous archive was kept', error)
+            return 1
+        except PlanError as error:
+            logger.error('%s', error)
+            return 2
     #trips_and_stop_times_debug([])
     #debug_generate_schedule_json('A84')
     #debug_line('A84')
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
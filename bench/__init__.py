@@ -0,0 +1,4 @@
+'''
+Benchmarks for the generator, run from the repository root, i.e.
+python -m bench.bench_parse
+'''
@@ -0,0 +1,111 @@
+'''
+What logging costs the transform, with the handlers called synchronously
+(as the run used to) and behind a queue (logs.py, LOG_QUEUE).
+Every mode runs in a fresh interpreter with the console and the DEBUG log
+file of a run, the console going to /dev/null:
+    off    - no handlers, the debug records are not even created
+    before - the handlers attached as the run used to, called in the logging thread
+    sync   - configure_logging without the queue
+    queue  - configure_logging, the records queued for the listener thread
+It measures the transform of a synthetic schedule, which logs per line
+and per route, and one debug record per stop time, the way the transform
+used to log every time. For each it reports the cpu seconds of the
+logging thread (what the hot loop pays, the listener runs on another
+thread), the wall seconds and, for the queue, the time until the listener
+has written everything.
+    python -m bench.bench_logging [--trips 400] [--repeat 5]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ('off', 'before', 'sync', 'queue')
+LINE = {'line_id': 1, 'ext_id': 'A84'}
+
+
+def child(mode: str, trips: int, repeat: int):
+    '''
+    the measurements of one mode, in this process
+    '''
+    import logging
+    from bench.synthetic import schedule_bytes
+    from feed import transform_schedule
+    from logs import configure_logging, stop_logging
+
+    if mode == 'before':
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s",
+                                      datefmt="%Y-%m-%d %H:%M")
+        root_logger = logging.getLogger()
+        root_logger.setLevel("DEBUG")
+        for handler, level in ((logging.StreamHandler(), "INFO"),
+                               (logging.FileHandler('bench.log', encoding="utf-8"), "DEBUG")):
+            handler.setLevel(level)
+            handler.setFormatter(formatter)
+            root_logger.addHandler(handler)
+    elif mode != 'off':
+        configure_logging('bench.log', queued=mode == 'queue')
+    logger = logging.getLogger('feed')
+    content = schedule_bytes(LINE['ext_id'], 1, routes=4, stops=40, trips=trips)
+    transform = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        tables = transform_schedule(LINE, content)
+        transform.append(time.perf_counter() - started)
+    rows = [row.split(',', 4) for row in tables['stop_times'].splitlines()]
+    records, cpu = [], []
+    for _ in range(repeat):
+        started, thread_cpu = time.perf_counter(), time.thread_time()
+        for trip_id, arrival, _, stop_id, sequence in rows:
+            logger.debug('trip %s: %s at stop %s (%s)', trip_id, arrival, stop_id, sequence)
+        records.append(time.perf_counter() - started)
+        cpu.append(time.thread_time() - thread_cpu)
+    started = time.perf_counter()
+    stop_logging()
+    drain = time.perf_counter() - started
+    size = os.path.getsize('bench.log') if os.path.exists('bench.log') else 0
+    return {'transform_s': min(transform), 'records': len(rows), 'records_s': min(records),
+            'records_cpu_s': min(cpu), 'drain_s': drain, 'log_mb': size / 2**20}
+
+
+def run_mode(mode: str, trips: int, repeat: int):
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as workdir:
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench.bench_logging', '--child', mode, '--trips', str(trips),
+             '--repeat', str(repeat)],
+            cwd=workdir, env=dict(os.environ, PYTHONPATH=package), check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=400,
+                        help='trips per route of the synthetic schedule')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(child(args.child, args.trips, args.repeat)))
+        return
+    results = {mode: run_mode(mode, args.trips, args.repeat) for mode in MODES}
+    base = results['off']
+    print('%d stop times, best of %d' % (base['records'], args.repeat))
+    print('%-6s %12s %9s  %s' % ('', 'transform', '', 'one record per stop time'))
+    print('%-6s %12s %9s %12s %12s %10s %9s' % ('mode', 'wall s', 'overhead', 'us/record cpu',
+                                              'us/record', 'drain s', 'log MB'))
+    for mode, result in results.items():
+        print('%-6s %12.3f %8.1f%% %12.2f %12.2f %10.3f %9.1f' % (
+            mode, result['transform_s'],
+            (result['transform_s'] / base['transform_s'] - 1) * 100,
+            result['records_cpu_s'] / result['records'] * 1e6,
+            result['records_s'] / result['records'] * 1e6, result['drain_s'], result['log_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Compare the streaming parse of a getSchedule response with the .json() path.
+The body is stored in a response cache entry the way a download is, then
+transformed twice:
+    json       - response.json(), the whole line decoded before the first row
+    streaming  - the worker path, the routes read from the entry one by one (ijson)
+For every size of line, in routes of the same size, it reports the time to
+the first route, the total transform time and the peak memory allocated
+(tracemalloc) by the parse alone and by the parse + transform, whose rows
+grow with the line anyway. The streaming parse holds one route at a time.
+    python -m bench.bench_parse [--routes 2 8 24] [--trips 400]
+'''
+import argparse
+import gc
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+
+from bench.synthetic import schedule_bytes
+from cache import ResponseCache
+from feed import iter_routes, route_digest, streaming_available, transform_routes
+from transform import transform_response
+
+LINE = {'line_id': 1, 'ext_id': 'A84'}
+MODES = ('json', 'streaming')
+
+
+def routes_of(response, mode: str):
+    if mode == 'json':
+        return ((route_digest(route), route) for route in response.json()['routes'])
+    return _streamed(response)
+
+
+def _streamed(response):
+    with response.open() as body:
+        yield from iter_routes(body)
+
+
+def transform(response, mode: str):
+    if mode == 'json':
+        return transform_routes(LINE, routes_of(response, mode))
+    return transform_response(LINE, response)
+
+
+def traced(func):
+    '''
+    the peak memory allocated while func runs, in MB
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def measure(response, mode: str):
+    start = time.perf_counter()
+    next(iter(routes_of(response, mode)))
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    tables = transform(response, mode)
+    total = time.perf_counter() - start
+    #memory is traced apart, tracemalloc slows the parse down
+    return {'first_route_s': first, 'total_s': total,
+            'parse_mb': traced(lambda: deque(routes_of(response, mode), maxlen=0)),
+            'peak_mb': traced(lambda: transform(response, mode)),
+            'stop_times': tables['stop_times'].count('\n')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--routes', type=int, nargs='+', default=[2, 8, 24],
+                        help='routes of the synthetic schedules')
+    parser.add_argument('--trips', type=int, default=400, help='trips per route')
+    args = parser.parse_args()
+    if not streaming_available():
+        print('ijson is not installed, the streaming path decodes the whole body too')
+    print('%-10s %8s %10s %11s %9s %9s %9s %10s' % ('mode', 'body MB', 'stop_times',
+                                                    'first s', 'total s', 'parse MB',
+                                                    'peak MB', 'route MB'))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ResponseCache(cache_dir)
+        for routes in args.routes:
+            content = schedule_bytes(LINE['ext_id'], 1, routes=routes, stops=40, trips=args.trips)
+            response = cache.put_stream('http://bench/getSchedule', str(routes), (content,))
+            body_mb = len(content) / 2**20
+            del content
+            for mode in MODES:
+                result = measure(response, mode)
+                print('%-10s %8.1f %10d %11.4f %9.3f %9.1f %9.1f %10.1f' % (
+                    mode, body_mb, result['stop_times'], result['first_route_s'],
+                    result['total_s'], result['parse_mb'], result['peak_mb'], body_mb / routes))
+
+
+if __name__ == '__main__':
+    main()
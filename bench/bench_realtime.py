@@ -0,0 +1,94 @@
+'''
+Can the virtual-table poller keep up with city-wide polling on one core?
+Starts the stand-in server in another process, pins this one to a single
+core and polls every stop of the timetable index for a few cycles,
+reporting per cycle the wall time, the cpu time of the poller and the
+calls per second.
+    python -m bench.bench_realtime [gtfs/timetable.bin] [--cycles 3] [--interval 30]
+the index must be built (python -m timetable build) from a feed generated
+from the fixture set the server serves
+'''
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+PORT = 8791
+CLOCK = '08:00'
+
+
+def start_server(port: int, clock: str, fixture_dir: str = None):
+    '''
+    the stand-in server in a process of its own, once it answers
+    '''
+    command = [sys.executable, '-m', 'bench.server', '--port', str(port), '--clock', clock]
+    if fixture_dir:
+        command += ['--dir', fixture_dir]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get('http://127.0.0.1:%s/bg/public-transport' % port, timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('the stand-in server did not start')
+
+
+async def measure(poller, cycles: int, interval: float):
+    rows = []
+    for _ in range(cycles):
+        started, cpu = time.monotonic(), time.process_time()
+        requests_before = poller.stats['requests']
+        message = await poller.cycle(deadline=0.9 * interval)
+        wall = time.monotonic() - started
+        rows.append((wall, time.process_time() - cpu, poller.stats['requests'] - requests_before,
+                     len(message['entity'])))
+        if wall < interval:
+            await asyncio.sleep(interval - wall)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', nargs='?', default='gtfs/timetable.bin')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=30.0)
+    parser.add_argument('--rate-limit', type=float, default=200.0)
+    parser.add_argument('--fixtures', help='the fixture set of the server')
+    args = parser.parse_args()
+    server = start_server(PORT, CLOCK, args.fixtures)
+    #the server keeps the other cores
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {sorted(os.sched_getaffinity(0))[0]})
+    #the poller reads the API urls at import
+    os.environ['SOFIATRAFFIC_URL'] = 'http://127.0.0.1:%s' % PORT
+    from realtime import VirtualTablePoller, ScheduleMatcher, clock_offset
+    from timetable import Timetable
+    try:
+        timetable = Timetable(args.index)
+        stops = [timetable.stop_ids[index] for index in range(len(timetable.stop_ids))]
+        poller = VirtualTablePoller(stops, ScheduleMatcher(timetable), rate_limit=args.rate_limit,
+                                    clock=clock_offset(CLOCK))
+        rows = asyncio.run(measure(poller, args.cycles, args.interval))
+        poller.log_stats()
+        poller.close()
+    finally:
+        server.kill()
+    print('%d stops, interval %.0f s, one core' % (len(stops), args.interval))
+    for number, (wall, cpu, calls, trips) in enumerate(rows, 1):
+        print('cycle %d  wall %6.2f s  cpu %6.2f s  %6.0f calls/s  %5.2f ms cpu/stop  '
+              '%d trips updated' % (number, wall, cpu, calls / wall, cpu / len(stops) * 1000,
+                                    trips))
+    cpu = sum(row[1] for row in rows) / len(rows)
+    print('keeps up' if cpu < args.interval else 'falls behind',
+          '- %.0f%% of the interval in cpu' % (cpu / args.interval * 100))
+
+
+if __name__ == '__main__':
+    main()
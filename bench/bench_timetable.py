@@ -0,0 +1,82 @@
+'''
+Build time, cold-start load time and query rate of the next-departures index.
+    python -m bench.bench_timetable [gtfs/SofiaTraffic.zip] [--queries 100000]
+The cold start is measured in a fresh interpreter: import, open (mmap) and
+the first answer, i.e. what a service pays on restart. The queries ask for
+the next 5 departures from random stops at random times, with and without
+a service filter.
+'''
+import argparse
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from const import DATASET_ZIP
+from timetable import Timetable, build_index
+
+COLD_START = '''
+import time
+started = time.perf_counter()
+from timetable import Timetable
+timetable = Timetable(%r)
+timetable.next_departures(timetable.stop_ids[0], 8 * 3600)
+print(time.perf_counter() - started)
+'''
+
+
+def cold_start(index_path: str, runs: int = 5):
+    '''
+    best seconds from a new process to the first answer
+    '''
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START % str(index_path)],
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output))
+    return min(timings)
+
+
+def query_rate(timetable: Timetable, queries: int, service: str = None):
+    '''
+    next_departures calls per second and the departures returned
+    '''
+    rng = random.Random(1)
+    stop_ids = [timetable.stop_ids[index] for index in range(len(timetable.stop_ids))]
+    asks = [(rng.choice(stop_ids), rng.randrange(4 * 3600, 24 * 3600)) for _ in range(queries)]
+    found = 0
+    started = time.perf_counter()
+    for stop_id, after in asks:
+        found += len(timetable.next_departures(stop_id, after, 5, service))
+    return queries / (time.perf_counter() - started), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archive', nargs='?', default=DATASET_ZIP)
+    parser.add_argument('--queries', type=int, default=100000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = Path(temp_dir) / 'timetable.bin'
+        started = time.perf_counter()
+        departures = build_index(args.archive, index_path)
+        print('build      %7.3f s  %d departures  %.1f MB' % (
+            time.perf_counter() - started, departures, index_path.stat().st_size / 2**20))
+        started = time.perf_counter()
+        timetable = Timetable(index_path)
+        print('open       %7.3f ms' % ((time.perf_counter() - started) * 1000))
+        print('cold start %7.3f ms  (new process: import, open, first query)' % (
+            cold_start(index_path) * 1000))
+        rate, found = query_rate(timetable, args.queries)
+        print('queries    %7.0f /s  %d departures' % (rate, found))
+        service = timetable.service_ids[0]
+        rate, found = query_rate(timetable, args.queries, service)
+        print('by service %7.0f /s  %d departures (%s)' % (rate, found, service))
+        timetable.close()
+
+
+if __name__ == '__main__':
+    main()
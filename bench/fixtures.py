@@ -0,0 +1,119 @@
+'''
+Recorded API responses for the benchmarks.
+A fixture set is a directory holding getAllStops.json.gz, getLines.json.gz
+and getSchedule/<ext_id>.json.gz, the bodies exactly as the API sent them.
+    python -m bench.fixtures record [--dir DIR]       record from the live API
+    python -m bench.fixtures synthesize [--lines N]  generate a synthetic set
+load_fixtures can scale a set up, cloning every line under a new ext_id.
+'''
+import argparse
+import gzip
+import json
+import logging
+import urllib.parse
+from pathlib import Path
+
+from bench.synthetic import make_lines, make_stops, schedule_bytes
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_DIR = 'bench/fixtures'
+
+
+def _write(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, 'wb') as fd:
+        fd.write(content)
+
+
+def _read(path: Path):
+    with gzip.open(path, 'rb') as fd:
+        return fd.read()
+
+
+def _schedule_path(fixture_dir: Path, ext_id: str):
+    return fixture_dir / 'getSchedule' / (urllib.parse.quote(ext_id, safe='')+'.json.gz')
+
+
+def record(fixture_dir: str = FIXTURE_DIR):
+    '''
+    download stops, lines and every schedule from sofiatraffic.bg
+    '''
+    import app
+    fixture_dir = Path(fixture_dir)
+    _write(fixture_dir / 'getAllStops.json.gz', app.get_all_stops().content)
+    lines = app.get_all_lines()
+    _write(fixture_dir / 'getLines.json.gz', lines.content)
+    for line in lines.json():
+        _write(_schedule_path(fixture_dir, line['ext_id']),
+               app.get_schedule(line['ext_id']).content)
+    logger.info('recorded %s lines to %s', len(lines.json()), fixture_dir)
+
+
+def synthesize(fixture_dir: str = FIXTURE_DIR, lines: int = 150, stops: int = 3000):
+    '''
+    write a synthetic fixture set, the same on every call
+    '''
+    fixture_dir = Path(fixture_dir)
+    list_of_lines = make_lines(lines)
+    _write(fixture_dir / 'getAllStops.json.gz',
+           json.dumps(make_stops(stops), ensure_ascii=False).encode('utf-8'))
+    _write(fixture_dir / 'getLines.json.gz',
+           json.dumps(list_of_lines, ensure_ascii=False).encode('utf-8'))
+    for line in list_of_lines:
+        #metro and trams run more often than the buses
+        trips = 140 if line['type'] in (2, 3) else 70
+        _write(_schedule_path(fixture_dir, line['ext_id']),
+               schedule_bytes(line['ext_id'], line['line_id'], trips=trips))
+    logger.info('synthesized %s lines in %s', lines, fixture_dir)
+
+
+def _clone_schedule(content: bytes, suffix: str, id_offset: int):
+    schedule = json.loads(content)
+    for route in schedule['routes']:
+        route['ext_id'] = str(route['ext_id']) + suffix
+        route['id'] += id_offset
+        route['line_id'] += id_offset
+    return json.dumps(schedule, ensure_ascii=False).encode('utf-8')
+
+
+def load_fixtures(fixture_dir: str = FIXTURE_DIR, scale: int = 1):
+    '''
+    return {'getAllStops': bytes, 'getLines': bytes, 'getSchedule': {ext_id: bytes}}
+    scale > 1 adds scale-1 copies of every line with its own ext_id and ids
+    '''
+    fixture_dir = Path(fixture_dir)
+    lines = json.loads(_read(fixture_dir / 'getLines.json.gz'))
+    schedules = {line['ext_id']: _read(_schedule_path(fixture_dir, line['ext_id']))
+                 for line in lines}
+    id_offset = max(line['line_id'] for line in lines)
+    scaled_lines = list(lines)
+    for copy in range(1, scale):
+        suffix = 'x' + str(copy)
+        for line in lines:
+            clone = dict(line, ext_id=line['ext_id'] + suffix,
+                         line_id=line['line_id'] + copy * id_offset)
+            scaled_lines.append(clone)
+            schedules[clone['ext_id']] = _clone_schedule(schedules[line['ext_id']], suffix,
+                                                         copy * id_offset)
+    return {'getAllStops': _read(fixture_dir / 'getAllStops.json.gz'),
+            'getLines': json.dumps(scaled_lines, ensure_ascii=False).encode('utf-8'),
+            'getSchedule': schedules}
+
+
+def main():
+    logging.basicConfig(level='INFO')
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=('record', 'synthesize'))
+    parser.add_argument('--dir', default=FIXTURE_DIR)
+    parser.add_argument('--lines', type=int, default=150, help='synthetic lines')
+    args = parser.parse_args()
+    if args.action == 'record':
+        record(args.dir)
+    else:
+        synthesize(args.dir, args.lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''
+Offline benchmark of generate_gtfs against the stand-in server.
+    python -m bench.run [--scale 5] [--latency 0.02] [--compare bench/results/old.json]
+Runs the stages of generate_gtfs one after the other in a scratch directory:
+    fetch      - stops, lines and all the schedules through the client
+    transform  - schedules to trips/stop_times blocks
+    write      - every file into the archive sink through the generator's own
+                 writers, the schedules read back from the response cache and
+                 the rows from the fragments the transform stage stored
+    zip        - finishing the compression and writing the archive
+and reports wall/cpu time, throughput in stop_times rows/s, peak RSS and
+request counts. The results are saved as json in bench/results/, --compare
+prints the change against an earlier result and fails on regressions.
+A synthetic fixture set is generated on first use when none was recorded.
+'''
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench.fixtures import FIXTURE_DIR, load_fixtures, synthesize
+from bench.server import StandInServer
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = 'bench/results'
+#slower than this share of the earlier result counts as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+class Stage:
+    '''
+    times a block of code, wall and cpu (including the worker processes)
+    '''
+
+    def __init__(self, results: dict, name: str):
+        self.results = results
+        self.name = name
+        self.rows = 0
+
+    @staticmethod
+    def _cpu():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu_start = self._cpu()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self._wall
+        self.results[self.name] = {'wall_s': round(wall, 4),
+                                   'cpu_s': round(self._cpu() - self._cpu_start, 4),
+                                   'rows': self.rows,
+                                   'rows_per_s': round(self.rows / wall, 1) if wall else None}
+        logger.info('%-9s %8.3f s wall %8.3f s cpu %10s rows', self.name, wall,
+                    self.results[self.name]['cpu_s'], self.rows)
+
+
+def peak_rss_mb():
+    '''
+    peak resident set size of this process and of its largest child, in MB
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': round(own / 1024, 1), 'children': round(children / 1024, 1)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    '''
+    one benchmark run, returns the result dict
+    '''
+    fixture_dir = Path(args.fixtures).resolve()
+    if not (fixture_dir / 'getLines.json.gz').exists():
+        synthesize(str(fixture_dir))
+    server = StandInServer(load_fixtures(str(fixture_dir), args.scale), latency=args.latency,
+                           jitter=args.jitter, error_rate=args.error_rate).start()
+    #the generator reads the API urls and its relative paths at import
+    os.environ['SOFIATRAFFIC_URL'] = server.url
+    workdir = tempfile.mkdtemp(prefix='gtfs-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app
+        from client import get_client
+        from fetch import RateLimiter, fetch_in_order
+        from fragments import FragmentStore
+        from transform import transform_in_order
+        from sink import FeedSink
+        from const import DATASET_DIR, DATASET_ZIP
+
+        Path(DATASET_DIR).mkdir(parents=True, exist_ok=True)
+        stages = {}
+        #the client spaces every request, hedges and retries included
+        get_client().limiter = RateLimiter(args.rate_limit)
+        with Stage(stages, 'fetch') as stage:
+            app.get_all_stops()
+            list_of_lines = app.get_all_lines().json()
+            schedules = list(fetch_in_order(lambda line: app.get_schedule(line['ext_id']),
+                                            list_of_lines, args.fetch_workers))
+            stage.rows = len(schedules)
+        with Stage(stages, 'transform') as stage:
+            stage.rows = sum(tables['stop_times'].count('\n') for _, tables in
+                             transform_in_order(schedules, FragmentStore(), args.transform_workers))
+        rows = stage.rows
+        del schedules
+        sink = FeedSink(DATASET_ZIP)
+        with Stage(stages, 'write') as stage:
+            app.generate_agency_txt(sink)
+            app.generate_stops_txt(sink)
+            app.generate_routes_txt(sink, list_of_lines)
+            app.generate_calendar_txt(sink)
+            #nothing is fetched or transformed again, the stages above left it all on disk
+            app.generate_trips_and_stop_times_txt(sink, list_of_lines, args.fetch_workers,
+                                                  args.transform_workers, frequencies=False)
+            app.generate_feed_info_txt(sink)
+            stage.rows = rows
+        with Stage(stages, 'zip') as stage:
+            sink.close()
+            stage.rows = rows
+        client = get_client()
+        return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': git_commit(),
+                'config': {'scale': args.scale, 'lines': len(list_of_lines),
+                           'latency': args.latency, 'jitter': args.jitter,
+                           'error_rate': args.error_rate, 'fetch_workers': args.fetch_workers,
+                           'rate_limit': args.rate_limit,
+                           'transform_workers': args.transform_workers},
+                'stages': stages,
+                'total_wall_s': round(sum(stage['wall_s'] for stage in stages.values()), 4),
+                'peak_rss_mb': peak_rss_mb(),
+                'archive_bytes': Path(DATASET_ZIP).stat().st_size,
+                'requests': {'server': dict(server.counts),
+                             'client': dict(client.stats, handshakes=client.handshakes)}}
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(result: dict, baseline: dict):
+    '''
+    print the change of every stage against baseline, return the regressed stages
+    '''
+    regressions = []
+    if result['config'] != baseline['config']:
+        print('note: the runs used different settings', baseline['config'], result['config'])
+    for name, stage in result['stages'].items():
+        old = baseline['stages'].get(name)
+        if not old or not old['wall_s']:
+            continue
+        change = stage['wall_s'] / old['wall_s'] - 1
+        flag = ''
+        if change > REGRESSION_THRESHOLD:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-9s %8.3f s -> %8.3f s  %+6.1f%%%s' % (name, old['wall_s'], stage['wall_s'],
+                                                     change * 100, flag))
+    return regressions
+
+
+def main():
+    logging.basicConfig(level='INFO', format='%(message)s')
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=FIXTURE_DIR)
+    parser.add_argument('--scale', type=int, default=1, help='copies of every fixture line')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failed calls')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests/s, 0 - none')
+    parser.add_argument('--transform-workers', type=int, default=4)
+    parser.add_argument('--results', default=RESULTS_DIR)
+    parser.add_argument('--compare', help='an earlier result to compare with')
+    args = parser.parse_args()
+    #quiet the generator, only the stage timings are of interest
+    logging.getLogger('app').setLevel('WARNING')
+    logging.getLogger('feed').setLevel('ERROR')
+    result = run(args)
+    results_dir = Path(args.results)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    path = results_dir / (result['timestamp'].replace(':', '')+'.json')
+    with open(path, 'wt', encoding='utf-8') as fd:
+        json.dump(result, fd, indent=2)
+    print(json.dumps({key: result[key] for key in ('total_wall_s', 'peak_rss_mb', 'requests')}))
+    print('results saved to', path)
+    if args.compare:
+        with open(args.compare, 'rt', encoding='utf-8') as fd:
+            if compare(result, json.load(fd)):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+'''
+A local stand-in for the sofiatraffic.bg APIs serving a fixture set.
+    python -m bench.server [--port 8080] [--latency 0.05] [--error-rate 0.01]
+then run the generator with SOFIATRAFFIC_URL=http://127.0.0.1:8080
+The server hands out the XSRF and session cookies like the real site,
+answers 419 to calls without them and can add latency and inject errors.
+getVirtualTable answers with the next arrivals at a stop taken from the
+fixture schedules, each trip running late by an amount that drifts
+minute by minute; --clock HH:MM pretends another time of day.
+'''
+import argparse
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from bench.fixtures import FIXTURE_DIR, load_fixtures
+
+logger = logging.getLogger(__name__)
+
+XSRF_TOKEN = 'bench-xsrf-token'
+SESSION_TOKEN = 'bench-session'
+
+
+#arrivals listed per line and how far ahead the virtual table looks, in seconds
+VIRTUAL_TABLE_ARRIVALS = 3
+VIRTUAL_TABLE_HORIZON = 3600
+
+
+class VirtualTables:
+    '''
+    the scheduled departures of every stop code in the fixture schedules,
+    built on the first getVirtualTable call
+    '''
+
+    def __init__(self, fixtures: dict, clock: float = 0.0, timezone: str = 'Europe/Sofia'):
+        self.fixtures = fixtures
+        self.clock = clock
+        self.timezone = ZoneInfo(timezone)
+        self._stops = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        lines = {line['ext_id']: line for line in json.loads(self.fixtures['getLines'])}
+        departures = {}
+        for ext_id, content in self.fixtures['getSchedule'].items():
+            line = lines.get(ext_id)
+            if line is None:
+                continue
+            for route in json.loads(content)['routes']:
+                for segment in route['segments']:
+                    stop = segment['stop']
+                    rows = departures.setdefault(stop['code'], {}).setdefault(
+                        line['line_id'], (line, [], [], []))
+                    for item in stop['times']:
+                        hours, minutes, seconds = str(item['time']).split(':')
+                        rows[1].append(int(hours) * 3600 + int(minutes) * 60 + int(seconds))
+                        rows[2].append(bool(item['weekend']))
+                        rows[3].append(zlib.crc32(str(item['id']).encode()))
+        stops = {}
+        for code, by_line in departures.items():
+            stops[code] = []
+            for line, seconds, weekend, keys in by_line.values():
+                order = np.argsort(seconds, kind='stable')
+                stops[code].append((line, np.array(seconds)[order], np.array(weekend)[order],
+                                    np.array(keys, dtype=np.int64)[order]))
+        return stops
+
+    def arrivals(self, code: str):
+        '''
+        the lines serving a stop with the minutes until their next arrivals
+        '''
+        with self._lock:
+            if self._stops is None:
+                self._stops = self._build()
+        now = datetime.datetime.now(self.timezone) + datetime.timedelta(
+            seconds=self.clock)
+        seconds_now = now.hour * 3600 + now.minute * 60 + now.second
+        weekend = now.weekday() >= 5
+        minute = int(time.time() + self.clock) // 60
+        table = []
+        for line, seconds, weekends, keys in self._stops.get(code, ()):
+            #every trip runs 1 to 7 minutes late, a little more or less every minute
+            first = int(seconds.searchsorted(seconds_now - 600))
+            last = int(seconds.searchsorted(seconds_now + VIRTUAL_TABLE_HORIZON))
+            service = weekends[first:last] == weekend
+            delays = 60 + keys[first:last] % 360 + (keys[first:last] + minute) % 5 * 15
+            predicted = (seconds[first:last] + delays)[service]
+            predicted = np.sort(predicted[predicted >= seconds_now])[:VIRTUAL_TABLE_ARRIVALS]
+            if len(predicted):
+                table.append({'line_id': line['line_id'], 'ext_id': line['ext_id'],
+                              'type': line['type'],
+                              'details': [{'t': int(minutes)} for minutes in
+                                          (predicted - seconds_now) // 60]})
+        return table
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    latency - seconds added to every API call, jitter - up to that many more
+    error_rate - share of the API calls answered with a 500
+    clock - seconds added to the time of day of the virtual tables
+    '''
+    daemon_threads = True
+
+    def __init__(self, fixtures: dict, port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 clock: float = 0.0):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.virtual_tables = VirtualTables(fixtures, clock)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'token_pages': 0, 'errors': 0, 'bytes': 0}
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def count(self, key: str, value: int = 1):
+        with self._lock:
+            self.counts[key] += value
+
+    def roll(self):
+        '''
+        delay of the next call and whether it fails
+        '''
+        with self._lock:
+            return (self.latency + self._random.random() * self.jitter,
+                    self._random.random() < self.error_rate)
+
+    def start(self):
+        '''
+        serve on a background thread
+        '''
+        thread = threading.Thread(target=self.serve_forever, name='stand-in', daemon=True)
+        thread.start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #headers and body are separate writes, without this every keep-alive call waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes', len(body))
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/bg/public-transport':
+            self._send(404, b'{}')
+            return
+        self.server.count('token_pages')
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'XSRF-TOKEN='+XSRF_TOKEN+'; Path=/')
+        self.send_header('Set-Cookie', 'sofia_traffic_session='+SESSION_TOKEN+'; Path=/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count('requests')
+        if self.headers.get('X-XSRF-TOKEN') != XSRF_TOKEN:
+            self._send(419, b'{"message": "CSRF token mismatch."}')
+            return
+        delay, fail = self.server.roll()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            self.server.count('errors')
+            self._send(500, b'{"message": "Server Error"}')
+            return
+        endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+        fixtures = self.server.fixtures
+        if endpoint in ('getAllStops', 'getLines'):
+            self._send(200, fixtures[endpoint])
+        elif endpoint == 'getSchedule':
+            body = fixtures['getSchedule'].get(json.loads(payload).get('ext_id'))
+            if body is None:
+                self._send(404, b'{}')
+            else:
+                self._send(200, body)
+        elif endpoint == 'getVirtualTable':
+            table = self.server.virtual_tables.arrivals(str(json.loads(payload).get('stop')))
+            self._send(200, json.dumps(table).encode('utf-8'))
+        else:
+            self._send(404, b'{}')
+
+
+def main():
+    logging.basicConfig(level='INFO')
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=FIXTURE_DIR)
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--clock', help='hh:mm, the time of day of the virtual tables')
+    args = parser.parse_args()
+    #const reads SOFIATRAFFIC_URL on import, the generator may be run in this process after the server
+    from realtime import clock_offset
+    server = StandInServer(load_fixtures(args.dir, args.scale), args.port, args.latency,
+                           args.jitter, args.error_rate, clock=clock_offset(args.clock))
+    logger.info('serving %s on %s', args.dir, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Synthetic sofiatraffic.bg payloads with the same structure as the real ones,
+for benchmarking without the live API. The output only depends on the arguments.
+'''
+import json
+import random
+
+
+def make_schedule(ext_id: str, line_id: int, routes: int = 2, stops: int = 30,
+                  trips: int = 120, seed: int = 0):
+    '''
+    a getSchedule response: routes x stops segments, each stop with trips times
+    '''
+    rnd = random.Random(str(seed)+ext_id)
+    schedule_routes = []
+    for direction in range(routes):
+        route_id = line_id * 10 + direction
+        first_departure = 4 * 3600 + rnd.randrange(0, 1800)
+        headway = rnd.choice((300, 420, 600, 900, 1200))
+        departures = [first_departure + index * headway for index in range(trips)]
+        lon = 23.25 + rnd.random() * 0.15
+        lat = 42.64 + rnd.random() * 0.1
+        segments = []
+        elapsed = 0
+        for sequence in range(stops):
+            next_lon = lon + (rnd.random() - 0.5) * 0.006
+            next_lat = lat + (rnd.random() - 0.5) * 0.006
+            code = '%04d' % ((line_id * 37 + direction * 500 + sequence * 13) % 3000)
+            times = []
+            for index, departure in enumerate(departures):
+                seconds = (departure + elapsed) % 86400
+                times.append({'id': route_id * 1000 + index,
+                              'weekend': index % 3 == 0,
+                              'code': None,
+                              'time': '%02d:%02d:00' % (seconds // 3600, seconds // 60 % 60),
+                              'item_id': 10000 + index,
+                              'route_id': route_id,
+                              'stop_id': sequence})
+            segments.append({'id': route_id * 100 + sequence,
+                             'route_id': route_id,
+                             'sequence': sequence,
+                             'start_stop_id': sequence,
+                             'end_stop_id': sequence + 1,
+                             'polyline': 'LINESTRING (%.9f %.9f, %.9f %.9f, %.9f %.9f)' % (
+                                 lon, lat, (lon+next_lon)/2, (lat+next_lat)/2 + 0.0002,
+                                 next_lon, next_lat),
+                             'length': round(rnd.uniform(250, 700), 2),
+                             'stop': {'id': sequence,
+                                      'ext_id': 'A'+code,
+                                      'code': code,
+                                      'type': 1,
+                                      'is_active': 1,
+                                      'longitude': lon,
+                                      'latitude': lat,
+                                      'description': None,
+                                      'times': times}})
+            elapsed += rnd.choice((60, 120, 120, 180))
+            lon, lat = next_lon, next_lat
+        schedule_routes.append({'id': route_id,
+                                'line_id': line_id,
+                                'name': 'Ж.К. ЛЮЛИН 5, МЕТРОСТАНЦИЯ %d' % direction,
+                                'type': 1,
+                                'ext_id': ext_id + str(direction),
+                                'route_ref': 0,
+                                'details': {'id': route_id, 'route_id': route_id, 'type': 0,
+                                            'is_active': 1,
+                                            'polyline': 'LINESTRING (%.9f %.9f, %.9f %.9f)' % (
+                                                segments[0]['stop']['longitude'],
+                                                segments[0]['stop']['latitude'], lon, lat),
+                                            'description': None,
+                                            'continious_pickup': None,
+                                            'continious_drop_off': None},
+                                'segments': segments})
+    return {'line': {'id': line_id, 'ext_id': ext_id, 'is_active': 1,
+                     'has_single_directon': 0, 'type': 1},
+            'routes': schedule_routes}
+
+
+def schedule_bytes(ext_id: str, line_id: int, **kwargs):
+    '''
+    make_schedule serialized like the API does
+    '''
+    return json.dumps(make_schedule(ext_id, line_id, **kwargs), ensure_ascii=False).encode('utf-8')
+
+
+def make_lines(count: int = 150, seed: int = 0):
+    '''
+    a getLines response with count lines of all the vehicle types
+    '''
+    rnd = random.Random(seed)
+    prefixes = {1: 'A', 2: 'TM', 3: 'M', 4: 'TB', 5: 'N'}
+    lines = []
+    for line_id in range(1, count + 1):
+        line_type = rnd.choice((1, 1, 1, 2, 4, 5, 3))
+        lines.append({'line_id': line_id,
+                      'name': str(line_id),
+                      'ext_id': prefixes[line_type] + str(line_id),
+                      'type': line_type,
+                      'color': '#%06X' % rnd.randrange(0x1000000),
+                      'icon': '/images/transport_types/bus.png'})
+    return lines
+
+
+def make_stops(count: int = 3000, seed: int = 0):
+    '''
+    a getAllStops response, coordinates are strings as in the API
+    '''
+    rnd = random.Random(seed)
+    stops = []
+    for index in range(count):
+        stops.append({'id': index + 1,
+                      'code': '%04d' % index,
+                      'name': 'СПИРКА %d, ЦЕНТЪР' % index,
+                      'latitude': '%.10f' % (42.64 + rnd.random() * 0.1),
+                      'longitude': '%.10f' % (23.25 + rnd.random() * 0.15),
+                      'type': rnd.choice((1, 2, 4))})
+    return stops
@@ -0,0 +1,246 @@
+'''
+An on-disk cache of the sofiatraffic.bg API responses.
+Every response body is stored gzip-compressed under the cache directory,
+keyed by the endpoint and the payload of the call. Entries expire after
+ttl seconds and the least recently used ones are evicted once the cache
+grows past max_bytes. In offline mode the expired entries are still served
+and a missing entry is an error instead of a network call.
+A download is written to its entry as it arrives and hashed on the way
+(put_stream); the response handed back reads the entry file, so a body is
+never held in memory whole unless .content or .json() asks for it.
+'''
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+from metrics import get_metrics
+from const import (
+    CACHE_DIR,
+    CACHE_TTL,
+    CACHE_MAX_BYTES,
+    CACHE_CHUNK_SIZE,
+)
+logger = logging.getLogger(__name__)
+
+
+class CacheMissError(LookupError):
+    '''
+    raised in offline mode when a response is not in the cache
+    '''
+
+
+class CachedResponse:
+    '''
+    The parts of requests.Response the generator uses, backed by a cached body:
+    the bytes themselves or the gzip-compressed entry at path
+    sha256 is the hash of the body when it is already known
+    '''
+
+    def __init__(self, url: str, content: bytes = None, path=None, sha256: str = None):
+        self.url = url
+        self._content = content
+        self.path = path
+        self._sha256 = sha256
+        self.status_code = 200
+        self.from_cache = True
+
+    @property
+    def content(self):
+        if self._content is None:
+            with self.open() as fd:
+                return fd.read()
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def open(self):
+        '''
+        the body as a binary file, read from the entry as it goes
+        '''
+        if self._content is None:
+            return gzip.open(self.path, 'rb')
+        return io.BytesIO(self._content)
+
+    def iter_content(self, chunk_size: int = 1):
+        with self.open() as fd:
+            yield from iter(lambda: fd.read(chunk_size), b'')
+
+    def sha256(self):
+        '''
+        hex sha256 of the body, read once when the download did not hash it
+        '''
+        if self._sha256 is None:
+            sha = hashlib.sha256()
+            for chunk in self.iter_content(CACHE_CHUNK_SIZE):
+                sha.update(chunk)
+            self._sha256 = sha.hexdigest()
+        return self._sha256
+
+
+class ResponseCache:
+    '''
+    gzip-compressed response bodies in cache_dir/<endpoint>/<key>.json.gz
+    the file mtime is the time of the download, the atime (touched on reads)
+    orders the entries for eviction
+    '''
+
+    def __init__(self, cache_dir: str = CACHE_DIR, ttl: float = CACHE_TTL,
+                 max_bytes: int = CACHE_MAX_BYTES, offline: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._size = None
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def endpoint(url: str):
+        '''
+        the last part of the url path, i.e. getSchedule
+        '''
+        return urllib.parse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+    def path_for(self, url: str, payload):
+        '''
+        file holding the response of url for payload
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        key = hashlib.sha256(url.encode('utf-8')+b'\n'+(payload or b'')).hexdigest()
+        return self.cache_dir / self.endpoint(url) / (key+'.json.gz')
+
+    def get(self, url: str, payload):
+        '''
+        return a CachedResponse for the call or None if it is missing or expired
+        in offline mode the age of the entry is ignored and a miss raises
+        the entry is read through once to hash it, a broken one is a miss
+        '''
+        path = self.path_for(url, payload)
+        try:
+            age = time.time() - path.stat().st_mtime
+            if not self.offline and age > self.ttl:
+                raise FileNotFoundError(path)
+            response = CachedResponse(url, path=path)
+            response.sha256()
+            #bump the access time for the lru eviction, keep the download time
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+            self._count('misses')
+            if self.offline:
+                raise CacheMissError('no cached response for '+self.endpoint(url)+
+                                     ' '+str(payload)) from None
+            return None
+        self._count('hits')
+        return response
+
+    def put(self, url: str, payload, content: bytes):
+        '''
+        store a response body
+        '''
+        return self.put_stream(url, payload, (content,))
+
+    def put_stream(self, url: str, payload, chunks):
+        '''
+        store a response body from its chunks as they arrive, hashing it on the
+        way, and return a CachedResponse reading the entry; the file is replaced
+        atomically so a concurrent reader never sees half an entry
+        '''
+        path = self.path_for(url, payload)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name+'.'+str(threading.get_ident())+'.tmp')
+        sha = hashlib.sha256()
+        try:
+            with gzip.open(temp_path, 'wb', compresslevel=6) as fd:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    fd.write(chunk)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(temp_path, path)
+        with self._lock:
+            self.stats['stores'] += 1
+            if self._size is not None:
+                self._size += path.stat().st_size - old_size
+        self.evict()
+        return CachedResponse(url, path=path, sha256=sha.hexdigest())
+
+    def _entries(self):
+        return [entry for entry in self.cache_dir.glob('*/*.json.gz') if entry.is_file()]
+
+    def size(self):
+        '''
+        total size of the cached files in bytes
+        '''
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            return self._size
+
+    def evict(self):
+        '''
+        remove the least recently used entries until the cache fits in max_bytes
+        '''
+        if self.size() <= self.max_bytes:
+            return
+        with self._lock:
+            entries = sorted(((entry.stat(), entry) for entry in self._entries()),
+                             key=lambda item: item[0].st_atime)
+            self._size = sum(stat.st_size for stat, _ in entries)
+            for stat, entry in entries:
+                if self._size <= self.max_bytes:
+                    break
+                entry.unlink(missing_ok=True)
+                self._size -= stat.st_size
+                self.stats['evictions'] += 1
+        logger.debug('response cache trimmed to %s bytes', self._size)
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def log_stats(self):
+        '''
+        log the cache counters for the run, they go in the run metrics too
+        '''
+        get_metrics().add('cache', dict(self.stats, bytes=self.size()))
+        logger.info('response cache: %s hits, %s misses, %s stored, %s evicted, %s bytes',
+                    self.stats['hits'], self.stats['misses'], self.stats['stores'],
+                    self.stats['evictions'], self.size())
+
+
+_cache = None
+
+
+def get_cache():
+    '''
+    return the shared response cache, creating it on first use
+    '''
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+
+def set_offline(offline: bool = True):
+    '''
+    serve every call from the cache and never touch the network
+    '''
+    get_cache().offline = offline
@@ -0,0 +1,311 @@
+'''
+A long-lived client for the sofiatraffic.bg APIs.
+The API expects the XSRF token and the session cookie handed out by the
+public transport page. Instead of opening a new session for every call
+the client keeps one pooled requests.Session, fetches the tokens once
+and only refreshes them when the server rejects them or rotates them.
+Failed calls are retried with backoff, slow ones are hedged with a second
+request and every worker pauses while the upstream keeps failing.
+Every request the client sends, hedges, retries and token refreshes
+included, waits on one rate limiter, so the upstream never sees more
+than rate_limit calls per second.
+A caller can take the body of a successful call as it comes off the socket
+(post(store=...)), i.e. straight into the response cache; a download broken
+half way is retried like a failed call.
+'''
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetch import RateLimiter
+from metrics import get_metrics
+from resilience import backoff_delay, LatencyTracker, CircuitBreaker
+
+from const import (
+    CACHE_CHUNK_SIZE,
+    FETCH_RATE_LIMIT,
+    PUBLIC_TRANSPORT_URL,
+    REQUEST_TIMEOUT,
+    HTTP_POOL_SIZE,
+    RETRY_ATTEMPTS,
+    HEDGE_MAX_SHARE,
+)
+logger = logging.getLogger(__name__)
+
+# status codes returned when the tokens are missing or expired
+# 419 is what laravel sends back on a CSRF token mismatch
+TOKEN_REJECTED_CODES = (401, 419)
+XSRF_COOKIE = 'XSRF-TOKEN'
+SESSION_COOKIE = 'sofia_traffic_session'
+# responses worth another try, the rest are returned to the caller as they are
+RETRY_CODES = (429, 500, 502, 503, 504)
+
+
+class SofiaTrafficClient:
+    '''
+    Owns a pooled session and the token headers for sofiatraffic.bg
+    stats counts the requests, token refreshes and cookie rotations,
+    retries and hedged requests,
+    handshakes is the number of connections opened by the pool
+    the client is shared between the fetch worker threads
+    '''
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE,
+                 timeout: tuple = REQUEST_TIMEOUT, attempts: int = RETRY_ATTEMPTS,
+                 rate_limit: float = FETCH_RATE_LIMIT):
+        self.timeout = timeout
+        self.attempts = max(1, attempts)
+        self.limiter = RateLimiter(rate_limit)
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=2 * pool_size,
+                                              thread_name_prefix='hedge')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.headers = None
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'token_refreshes': 0, 'token_rotations': 0,
+                      'retries': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    def refresh_tokens(self, rejected: dict = None):
+        '''
+        load the public transport page to (re)issue the XSRF and session cookies
+        and rebuild the header block sent with every API call
+        rejected is the header block the server refused, if another thread
+        has already replaced it the tokens are not fetched again
+        '''
+        with self._lock:
+            if self.headers is not None and self.headers is not rejected:
+                return self.headers
+            self._send('get', PUBLIC_TRANSPORT_URL, retry=False).raise_for_status()
+            self.stats['token_refreshes'] += 1
+            self.headers = self._build_headers(self.session.cookies.get_dict())
+            logger.debug('sofiatraffic.bg tokens refreshed')
+            return self.headers
+
+    @staticmethod
+    def _build_headers(tokens: dict):
+        '''
+        custom headers mimicking the browser calls to the API
+        '''
+        return {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0",
+                "Accept": "application/json, text/plain, */*",
+                "Accept-Language": "en-GB,en;q=0.9",
+                "Accept-Encoding": "gzip, deflate, br",
+                "X-Requested-With": "XMLHttpRequest",
+                "Content-Type": "application/json",
+                "X-XSRF-TOKEN": urllib.parse.unquote(tokens[XSRF_COOKIE]),
+                "Cookie": SESSION_COOKIE+'='+
+                urllib.parse.unquote(tokens[SESSION_COOKIE]),
+                "Sec-Fetch-Dest": "empty",
+                "Sec-Fetch-Mode": "cors",
+                "Sec-Fetch-Site": "same-origin",
+                "Priority": "u=1",
+                "Pragma": "no-cache",
+                "Cache-Control": "no-cache",
+                "Referrer": "https://www.sofiatraffic.bg/bg/public-transport",
+                "TE": "trailers"}
+
+    def _check_rotation(self, response):
+        '''
+        the server may hand out new cookies with any response,
+        keep the headers in line with the cookie jar
+        '''
+        if XSRF_COOKIE in response.cookies or SESSION_COOKIE in response.cookies:
+            with self._lock:
+                headers = self._build_headers(self.session.cookies.get_dict())
+                if headers != self.headers:
+                    self.headers = headers
+                    self.stats['token_rotations'] += 1
+                    logger.debug('sofiatraffic.bg tokens rotated')
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _send(self, method: str, url: str, retry: bool, timeout: tuple = None, store=None,
+              **kwargs):
+        '''
+        one http call, recorded in the run metrics with its latency and status,
+        sent once the rate limiter allows it
+        store - called with the chunks of a 200 body as they are received, its
+        result is kept as response.stored and the body is not kept in memory
+        '''
+        self.limiter.wait()
+        start = time.perf_counter()
+        size = 0
+
+        def chunks():
+            nonlocal size
+            for chunk in response.iter_content(CACHE_CHUNK_SIZE):
+                size += len(chunk)
+                yield chunk
+
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout,
+                                            stream=store is not None, **kwargs)
+            if store is None:
+                size = len(response.content)
+            elif response.status_code == 200:
+                with response:
+                    response.stored = store(chunks())
+            else:
+                size = len(response.content)
+        except requests.RequestException as error:
+            get_metrics().observe_request(url, type(error).__name__,
+                                          time.perf_counter() - start, retry=retry)
+            raise
+        latency = time.perf_counter() - start
+        get_metrics().observe_request(url, response.status_code, latency, size, retry=retry)
+        if response.status_code == 200:
+            self.latency.observe(_endpoint(url), latency)
+        return response
+
+    def _hedged_post(self, url: str, retry: bool, store=None, **kwargs):
+        '''
+        POST with a read timeout learned from the recent calls to the endpoint,
+        if no answer comes within their p95 a second request is sent and
+        the first response wins
+        '''
+        endpoint = _endpoint(url)
+        timeout = (self.timeout[0], self.latency.read_timeout(endpoint, self.timeout[1]))
+        delay = self.latency.hedge_delay(endpoint)
+        if delay is None:
+            return self._send('post', url, retry, timeout, store, **kwargs)
+        primary = self._hedge_pool.submit(self._send, 'post', url, retry, timeout, store,
+                                          **kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        with self._lock:
+            #hedges are extra load on the upstream, keep them to a share of the calls
+            if self.stats['hedges'] >= HEDGE_MAX_SHARE * self.stats['requests']:
+                allowed = False
+            else:
+                allowed = True
+                self.stats['hedges'] += 1
+        if not allowed:
+            return primary.result()
+        logger.debug('%s slower than %.2f s, hedging', endpoint, delay)
+        hedge = self._hedge_pool.submit(self._send, 'post', url, True, timeout, store, **kwargs)
+        done, _ = wait((primary, hedge), return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None:
+            #the other one may still succeed
+            winner = hedge if winner is primary else primary
+        if winner is hedge:
+            self._count('hedge_wins')
+        return winner.result()
+
+    def _attempt(self, url: str, payload, retry: bool, store=None):
+        '''
+        one try of a POST, refreshing the tokens once if they are rejected
+        '''
+        headers = self.headers
+        if headers is None:
+            headers = self.refresh_tokens()
+        response = self._hedged_post(url, retry, store, headers=headers, data=payload)
+        self._count('requests')
+        if response.status_code in TOKEN_REJECTED_CODES:
+            logger.info('tokens rejected with %s, refreshing', response.status_code)
+            headers = self.refresh_tokens(rejected=headers)
+            response = self._hedged_post(url, True, store, headers=headers, data=payload)
+            self._count('requests')
+        return response
+
+    def post(self, url: str, payload, store=None):
+        '''
+        Send a POST request to url and return the response.
+        If the tokens are rejected they are refreshed and the call repeated once.
+        Timeouts, connection errors, broken downloads and 429/5xx answers are
+        retried up to attempts times with a jittered exponential backoff, after
+        that the error is raised.
+        store - see _send, with a 200 answer response.stored holds its result
+        '''
+        error = None
+        response = None
+        for attempt in range(self.attempts):
+            self.breaker.before_call()
+            try:
+                response = self._attempt(url, payload, retry=attempt > 0, store=store)
+                error = None
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as call_error:
+                response = None
+                error = call_error
+            except BaseException:
+                #the other workers may be waiting for this call to probe the upstream
+                self.breaker.failure()
+                raise
+            if response is not None and response.status_code not in RETRY_CODES:
+                self.breaker.success()
+                self._check_rotation(response)
+                return response
+            self.breaker.failure()
+            if attempt + 1 < self.attempts:
+                delay = backoff_delay(attempt)
+                logger.info('%s failed (%s), retrying in %.1f s', _endpoint(url),
+                            error or response.status_code, delay)
+                self._count('retries')
+                time.sleep(delay)
+        if error is not None:
+            raise error
+        response.raise_for_status()
+        return response
+
+    @property
+    def handshakes(self):
+        '''
+        number of TCP/TLS connections opened by the connection pools so far
+        '''
+        count = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                count += pools[key].num_connections
+        return count
+
+    def log_stats(self):
+        '''
+        log the connection and token counters for the run, they go in the run metrics too
+        '''
+        get_metrics().add('client', dict(self.stats, handshakes=self.handshakes,
+                                         breaker_opens=self.breaker.opens))
+        logger.info('sofiatraffic.bg: %s requests, %s handshakes, %s token refreshes, %s token rotations',
+                    self.stats['requests'], self.handshakes,
+                    self.stats['token_refreshes'], self.stats['token_rotations'])
+        logger.info('sofiatraffic.bg: %s retries, %s hedged requests (%s won), circuit opened %s times',
+                    self.stats['retries'], self.stats['hedges'], self.stats['hedge_wins'],
+                    self.breaker.opens)
+
+    def close(self):
+        '''
+        close the pooled connections
+        '''
+        self._hedge_pool.shutdown(wait=False)
+        self.session.close()
+
+
+def _endpoint(url: str):
+    return urllib.parse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+_client = None
+
+
+def get_client():
+    '''
+    return the shared client, creating it on first use
+    '''
+    global _client
+    if _client is None:
+        _client = SofiaTrafficClient()
+    return _client
@@ -0,0 +1,148 @@
+'''
+Typed columnar copies of the biggest tables for the analytics jobs.
+The rows written to stops.txt, routes.txt, trips.txt and stop_times.txt are
+also converted to Parquet files with typed columns: times as integer
+seconds since midnight (past 24:00 for the trips after midnight), ids
+repeated on many rows dictionary-encoded, coordinates as floats. The text
+is taken in batches of about COLUMNAR_BATCH_BYTES, each parsed with the
+Arrow csv reader and written as a row group, so the memory use stays
+bounded whatever the size of the table. Needs the optional pyarrow package.
+'''
+import io
+import logging
+import os
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from const import COLUMNAR_BATCH_BYTES
+
+logger = logging.getLogger(__name__)
+
+TIME = 'time'
+DICTIONARY = 'dictionary'
+#the column kinds of the converted tables, the other columns stay strings
+COLUMNS = {
+    'stops.txt': {'stop_id': 'string', 'stop_code': 'string', 'stop_lat': 'float64',
+                  'stop_lon': 'float64'},
+    'routes.txt': {'route_id': 'int32', 'agency_id': DICTIONARY, 'route_short_name': 'string',
+                   'route_type': 'int8', 'route_color': 'string'},
+    'trips.txt': {'route_id': 'int32', 'service_id': DICTIONARY, 'trip_id': 'string',
+                  'trip_headsign': DICTIONARY, 'shape_id': DICTIONARY},
+    'stop_times.txt': {'trip_id': DICTIONARY, 'arrival_time': TIME, 'departure_time': TIME,
+                       'stop_id': DICTIONARY, 'stop_sequence': 'int32', 'timepoint': 'int8'},
+}
+
+
+def columnar_available():
+    '''
+    True when the pyarrow package is installed
+    '''
+    return pa is not None
+
+
+def _arrow_type(kind: str):
+    if kind == TIME:
+        return pa.int32()
+    if kind == DICTIONARY:
+        return pa.dictionary(pa.int32(), pa.string())
+    return getattr(pa, kind)()
+
+
+def parse_times(column):
+    '''
+    hh:mm:ss strings to int32 seconds, empty strings to nulls
+    '''
+    column = pc.if_else(pc.equal(column, ''), pa.scalar(None, pa.string()), column)
+    hours = pc.cast(pc.utf8_slice_codeunits(column, 0, -6), pa.int32())
+    minutes = pc.cast(pc.utf8_slice_codeunits(column, -5, -3), pa.int32())
+    seconds = pc.cast(pc.utf8_slice_codeunits(column, -2), pa.int32())
+    return pc.add(pc.add(pc.multiply(hours, 3600), pc.multiply(minutes, 60)), seconds)
+
+
+class TableWriter:
+    '''
+    converts the csv text of a member to a Parquet file, header first
+    the file keeps a temporary name until publish
+    '''
+
+    def __init__(self, name: str, path, batch_bytes: int = COLUMNAR_BATCH_BYTES):
+        self.path = Path(path)
+        self.kinds = COLUMNS[name]
+        self.batch_bytes = batch_bytes
+        self.header = None
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+        self._parts = []
+        self._buffered = 0
+        self._pending = ''
+
+    def _temp_path(self):
+        return self.path.with_name(self.path.name+'.tmp')
+
+    def write(self, text: str):
+        self._parts.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.batch_bytes:
+            self._flush()
+
+    def _flush(self, last: bool = False):
+        text = self._pending+''.join(self._parts)
+        self._parts = []
+        self._buffered = 0
+        #only whole rows, the rest waits for the next batch
+        end = len(text) if last else text.rfind('\n') + 1
+        text, self._pending = text[:end], text[end:]
+        if self.header is None:
+            first, _, text = text.partition('\n')
+            if not first:
+                return
+            self.header = [field.strip() for field in first.split(',')]
+            self.schema = pa.schema([(field, _arrow_type(self.kinds.get(field, 'string')))
+                                     for field in self.header])
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = pq.ParquetWriter(self._temp_path(), self.schema, compression='zstd')
+        if not text.strip():
+            return
+        table = pa_csv.read_csv(
+            io.BytesIO(text.encode('utf-8')),
+            read_options=pa_csv.ReadOptions(column_names=self.header),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={field: pa.string() for field in self.header},
+                strings_can_be_null=False, quoted_strings_can_be_null=False))
+        columns = []
+        for field in self.schema:
+            column = table.column(field.name)
+            kind = self.kinds.get(field.name, 'string')
+            if kind == TIME:
+                column = parse_times(column)
+            elif kind == DICTIONARY:
+                column = pc.dictionary_encode(column)
+            elif kind != 'string':
+                column = pc.cast(pc.if_else(pc.equal(column, ''),
+                                            pa.scalar(None, pa.string()), column), field.type)
+            columns.append(column)
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        self.rows += table.num_rows
+
+    def close(self):
+        self._flush(last=True)
+        if self._writer is not None and self._writer.is_open:
+            self._writer.close()
+
+    def publish(self):
+        if self._writer is not None:
+            os.replace(self._temp_path(), self.path)
+
+    def discard(self):
+        if self._writer is not None:
+            if self._writer.is_open:
+                self._writer.close()
+            self._temp_path().unlink(missing_ok=True)
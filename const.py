@@ -1,7 +1,115 @@
 '''
 A list of constants used by the project
 '''
-SCHEDULES_URL = 'https://sofiatraffic.bg/bg/trip/getSchedule'
-VIRTUAL_TABLE_URL = 'https://sofiatraffic.bg/bg/trip/getVirtualTable'
-LINES_URL = 'https://sofiatraffic.bg/bg/trip/getLines'
-STOPS_URL = 'https://sofiatraffic.bg/bg/trip/getAllStops'
+import os
+
+# the SOFIATRAFFIC_URL environment variable points the APIs to another server, i.e. bench.server
+BASE_URL = os.environ.get('SOFIATRAFFIC_URL', 'https://sofiatraffic.bg').rstrip('/')
+SCHEDULES_URL = BASE_URL+'/bg/trip/getSchedule'
+VIRTUAL_TABLE_URL = BASE_URL+'/bg/trip/getVirtualTable'
+LINES_URL = BASE_URL+'/bg/trip/getLines'
+STOPS_URL = BASE_URL+'/bg/trip/getAllStops'
+PUBLIC_TRANSPORT_URL = BASE_URL+'/bg/public-transport'
+# (connect, read) timeouts in seconds for the API calls
+REQUEST_TIMEOUT = (3.05, 27)
+# number of keep-alive connections kept in the session pool
+HTTP_POOL_SIZE = 10
+# parallel schedule downloads and the overall request rate limit (requests/s, 0 - no limit)
+FETCH_WORKERS = 8
+FETCH_RATE_LIMIT = 10.0
+# on-disk cache of the API responses: location, max age in seconds and max size in bytes
+CACHE_DIR = 'cache'
+CACHE_TTL = 6 * 3600
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# the bodies are streamed from the socket into the cache and read back in chunks of this size
+CACHE_CHUNK_SIZE = 64 * 1024
+# per-line store of generated rows, bump the version when the transform output changes
+FRAGMENT_DIR = 'fragments'
+FRAGMENT_VERSION = '8'
+# output: the dataset directory, the archive, whether to keep plain .txt copies of its members
+DATASET_DIR = 'gtfs'
+DATASET_ZIP = 'gtfs/SofiaTraffic.zip'
+WRITE_TXT = True
+# deflate level (0-9) of the archive, threads compressing its members and the chunk size they work on
+ZIP_COMPRESSION_LEVEL = 6
+ZIP_WORKERS = 4
+ZIP_CHUNK_SIZE = 1024 * 1024
+# shapes.txt: max deviation in meters of the simplified geometry, segments kept simplified per process
+SHAPE_TOLERANCE = 1.0
+SHAPE_CACHE_SIZE = 8192
+# transfers.txt between the stops within this many meters (0 - none), walking at this speed in m/s
+# along a path this many times longer than the straight line
+TRANSFER_RADIUS = 250.0
+WALK_SPEED = 1.2
+WALK_DETOUR = 1.3
+# stops closer than this many meters with the same code or name are reported as suspected duplicates
+DUPLICATE_RADIUS = 30.0
+DUPLICATE_STOPS_REPORT = 'gtfs/duplicate_stops.json'
+# typed Parquet copies of stops, routes, trips and stop_times (--parquet, needs pyarrow),
+# the directory and the csv text converted per row group
+COLUMNAR_OUTPUT = False
+COLUMNAR_DIR = 'gtfs/parquet'
+COLUMNAR_BATCH_BYTES = 16 * 1024 * 1024
+# sqlite copy of the feed (--sqlite): the database and the rows inserted per executemany
+SQLITE_EXPORT = False
+SQLITE_DB = 'gtfs/SofiaTraffic.sqlite'
+SQLITE_BATCH = 50000
+# content-addressed versions of the published archive (python -m versions): the store, the versions
+# kept, the temporary files each member is split into when two versions are compared and the days
+# before the dates of the published calendar run out that an unchanged version is published again
+VERSIONS_DIR = 'gtfs/versions'
+VERSIONS_KEEP = 10
+DIFF_PARTITIONS = 16
+VERSION_REFRESH_DAYS = 2
+# next-departures index of the finished feed (--timetable), memory-mapped by timetable.Timetable
+TIMETABLE_OUTPUT = False
+TIMETABLE_INDEX = 'gtfs/timetable.bin'
+# live virtual tables (python -m realtime): seconds between polls of all the stops, concurrent calls
+# and their rate limit (requests/s), the time zone of the schedules, how late in seconds an arrival
+# may run to be matched to a scheduled trip, the smallest delay change reported and the feed written
+REALTIME_INTERVAL = 30.0
+REALTIME_CONCURRENCY = 10
+REALTIME_RATE_LIMIT = 200.0
+REALTIME_TIMEZONE = 'Europe/Sofia'
+REALTIME_MATCH_WINDOW = 1800
+REALTIME_DELAY_STEP = 60
+REALTIME_FEED = 'gtfs/realtime.json'
+# frequencies.txt: compact runs of at least this many trips with a constant headway (--frequencies)
+COMPACT_FREQUENCIES = False
+FREQUENCY_MIN_TRIPS = 3
+# threads running the stages of a run that do not depend on each other (stages.py)
+STAGE_WORKERS = 4
+# processes turning the schedules into rows, 1 - transform in the main process (debugging)
+TRANSFORM_WORKERS = 4
+# logging: the log file, whether the handlers run on a background thread behind a queue (logs.py),
+# the levels of the console and of the file and the contexts named in a summary of repeated events
+LOG_FILE = 'gtfs_gen.log'
+LOG_QUEUE = True
+LOG_CONSOLE_LEVEL = 'INFO'
+LOG_FILE_LEVEL = 'DEBUG'
+LOG_SUMMARY_TOP = 5
+# run metrics: json report, Prometheus textfile (point it to the node exporter textfile directory)
+METRICS_JSON = 'gtfs/metrics.json'
+METRICS_PROM = 'gtfs/sofia_gtfs.prom'
+# upper bounds in seconds of the API latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 27.0)
+# retries of a failed API call and the base and max of the jittered exponential backoff in seconds
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 8.0
+# latency budget: recent calls kept per endpoint, calls seen before hedging,
+# the quantile after which a call is hedged and the max share of hedged calls,
+# the read timeout as a multiple of the recent p95 and its lower bound in seconds
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_QUANTILE = 0.95
+HEDGE_MAX_SHARE = 0.1
+LATENCY_BUDGET_FACTOR = 4.0
+MIN_READ_TIMEOUT = 2.0
+# circuit breaker: consecutive failures that pause all calls, first and longest pause in seconds
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 10.0
+BREAKER_MAX_COOLDOWN = 120.0
+# validation of the archive before it is published: the json report and the sample rows kept per problem
+VALIDATION_REPORT = 'gtfs/validation.json'
+VALIDATION_SAMPLES = 10
@@ -0,0 +1,425 @@
+'''
+A compact in-memory model of the generated feed.
+The schedule of a line is parsed from its cached response file one route at
+a time (with the optional ijson package), so the nested times of the whole
+line are never decoded at once. A line schedule is turned into a table of trips and an array-backed table
+of stop times instead of csv strings: the trip ids, headsigns and stop codes
+are computed once and referenced by index, times are kept as seconds since
+midnight. The stop times of a line are then sorted, deduplicated and moved
+past midnight as numpy column operations and serialized in bulk with a csv
+writer.
+The trips of a route reference its shape, see shapes.py.
+Stop codes and headsigns are interned per process. Every route is hashed
+without its ids before it is transformed: a route repeated within a line,
+or already written by an earlier line, is not transformed again, see
+interning.py.
+'''
+import bisect
+import csv
+import hashlib
+import io
+import json
+import logging
+from array import array
+from string import capwords
+
+import numpy as np
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from shapes import ShapeBuilder
+from frequencies import compact_trips
+from interning import get_interner
+
+logger = logging.getLogger(__name__)
+
+TRIPS_HEADER = "route_id,service_id,trip_id,trip_headsign,shape_id\n"
+STOP_TIMES_HEADER = "trip_id,arrival_time,departure_time,stop_id,stop_sequence,timepoint\n"
+SERVICE_WEEKDAY = 'weekday_service'
+SERVICE_HOLIDAY = 'holiday_service'
+#arrival and departure times are approximate
+TIMEPOINT = 0
+DAY = 86400
+#trips starting before this time (00:xx) belong to the service day before
+NIGHT_ROLLOVER = 3600
+#a trip going this far back in time between two stops has passed midnight
+MIDNIGHT_JUMP = 12 * 3600
+
+
+class Trip:
+    '''
+    a row of trips.txt
+    '''
+    __slots__ = ('route_id', 'service_id', 'trip_id', 'trip_headsign', 'shape_id')
+
+    def __init__(self, route_id, service_id: str, trip_id: str, trip_headsign: str,
+                 shape_id: str = None):
+        self.route_id = route_id
+        self.service_id = service_id
+        self.trip_id = trip_id
+        self.trip_headsign = trip_headsign
+        self.shape_id = shape_id
+
+    def row(self):
+        return (self.route_id, self.service_id, self.trip_id, self.trip_headsign,
+                self.shape_id or '')
+
+
+class StopTimeTable:
+    '''
+    the stop_times.txt rows of a line as parallel arrays
+    trip and stop are indexes into trip_ids and stop_codes,
+    the stop codes are shared by all the lines of the process
+    trip_route holds the index in route_ids of the route of every trip
+    '''
+    __slots__ = ('trip_ids', 'trip_route', 'route_ids', 'stop_codes', '_stop_codes', 'trip',
+                 'stop', 'sequence', 'seconds', 'columns', 'duplicates', 'backwards',
+                 'anomalies')
+
+    def __init__(self):
+        self.trip_ids = []
+        self.trip_route = array('q')
+        self.route_ids = []
+        self._stop_codes = get_interner('stop_codes')
+        self.stop_codes = self._stop_codes.values
+        self.trip = array('q')
+        self.stop = array('q')
+        self.sequence = array('q')
+        self.seconds = array('q')
+        self.columns = None
+        self.duplicates = 0
+        self.backwards = 0
+        #[[route id, stop code, rows]] of the dropped and of the raised rows
+        self.anomalies = {'duplicates': [], 'backwards': []}
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def add_route(self, route_id):
+        '''
+        register a route id and return its index
+        '''
+        self.route_ids.append(route_id)
+        return len(self.route_ids) - 1
+
+    def add_trip(self, trip_id: str, route: int = 0):
+        '''
+        register a trip id of the route at index route and return its index
+        '''
+        self.trip_ids.append(trip_id)
+        self.trip_route.append(route)
+        return len(self.trip_ids) - 1
+
+    def stop_ref(self, code):
+        '''
+        index of a stop code, each code is stored once
+        '''
+        return self._stop_codes.memo(code, str)
+
+    def append(self, trip: int, stop: int, sequence: int, seconds: int):
+        self.trip.append(trip)
+        self.stop.append(stop)
+        self.sequence.append(sequence)
+        self.seconds.append(seconds)
+
+    def normalize(self):
+        '''
+        turn the collected times into trips:
+        - sort by trip and stop sequence
+        - drop repeated (trip, stop_sequence) entries, sofiatraffic.bg lists some times twice
+        - move the times after midnight past 24:00, for the whole trip if it
+          starts before NIGHT_ROLLOVER, from the stop where it jumps back otherwise
+        - keep the times of a trip from going backwards
+        '''
+        trip, stop, sequence, seconds = (np.frombuffer(column, dtype=np.int64) for column in
+                                         (self.trip, self.stop, self.sequence, self.seconds))
+        order = np.lexsort((seconds, sequence, trip))
+        trip, stop, sequence, seconds = trip[order], stop[order], sequence[order], seconds[order]
+        keep = np.ones(len(trip), dtype=bool)
+        keep[1:] = (trip[1:] != trip[:-1]) | (sequence[1:] != sequence[:-1])
+        self.duplicates = int(len(keep) - np.count_nonzero(keep))
+        if self.duplicates:
+            self.anomalies['duplicates'] = self._by_route_and_stop(trip[~keep], stop[~keep])
+        trip, stop, sequence, seconds = trip[keep], stop[keep], sequence[keep], seconds[keep]
+        if len(trip):
+            same_trip = trip[1:] == trip[:-1]
+            starts = np.flatnonzero(np.concatenate(([True], ~same_trip)))
+            lengths = np.diff(np.append(starts, len(trip)))
+            jumps = np.zeros(len(trip), dtype=np.int64)
+            jumps[1:] = same_trip & (np.diff(seconds) < -MIDNIGHT_JUMP)
+            days = np.cumsum(jumps)
+            days -= np.repeat(days[starts], lengths)
+            days += np.repeat(seconds[starts] < NIGHT_ROLLOVER, lengths)
+            seconds = seconds + days * DAY
+            #a running maximum per trip, the trips are spaced apart so they do not mix
+            offset = np.repeat(np.arange(len(starts), dtype=np.int64) * 4 * DAY, lengths)
+            monotonic = np.maximum.accumulate(seconds + offset) - offset
+            raised = monotonic != seconds
+            self.backwards = int(np.count_nonzero(raised))
+            if self.backwards:
+                self.anomalies['backwards'] = self._by_route_and_stop(trip[raised], stop[raised])
+            seconds = monotonic
+        self.columns = (trip, stop, sequence, seconds)
+        return self
+
+    def _by_route_and_stop(self, trip: np.ndarray, stop: np.ndarray):
+        '''
+        [[route id, stop code, rows]] of the rows of trip and stop, counted by route and stop
+        '''
+        if not self.route_ids:
+            return []
+        route = np.frombuffer(self.trip_route, dtype=np.int64)[trip]
+        pairs, counts = np.unique(np.column_stack((route, stop)), axis=0, return_counts=True)
+        return [[self.route_ids[route], self.stop_codes[stop], count]
+                for (route, stop), count in zip(pairs.tolist(), counts.tolist())]
+
+    def rows(self, start: int = 0, end: int = None):
+        '''
+        trip_id,arrival_time,departure_time,stop_id,stop_sequence,timepoint
+        of the normalized rows from start to end
+        '''
+        if self.columns is None:
+            self.normalize()
+        trip_ids = self.trip_ids
+        stop_codes = self.stop_codes
+        for trip, stop, sequence, seconds in zip(*(column[start:end].tolist()
+                                                   for column in self.columns)):
+            time_str = format_time(seconds)
+            yield (trip_ids[trip], time_str, time_str, stop_codes[stop], sequence, TIMEPOINT)
+
+
+_parsed_times = {}
+
+
+def parse_time(time_str: str):
+    '''
+    hh:mm[:ss] to seconds since midnight, memoized like format_time
+    '''
+    seconds = _parsed_times.get(time_str)
+    if seconds is None:
+        parts = time_str.split(':')
+        seconds = int(parts[0]) * 3600 + int(parts[1]) * 60
+        if len(parts) > 2:
+            seconds += int(parts[2])
+        _parsed_times[time_str] = seconds
+    return seconds
+
+
+_formatted_times = {}
+
+
+def format_time(seconds: int):
+    '''
+    seconds since midnight to hh:mm:ss, hours may go past 24
+    there are at most a few tens of thousands of distinct values so they are memoized
+    '''
+    time_str = _formatted_times.get(seconds)
+    if time_str is None:
+        time_str = _formatted_times[seconds] = '%02d:%02d:%02d' % (
+            seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return time_str
+
+
+def headsign(name):
+    '''
+    the trip headsign shown for a route, commas trip the validator
+    '''
+    return capwords(str(name).replace(',', ' '))
+
+
+def route_digest(route: dict):
+    '''
+    sha256 of what the rows of a route are made of: the headsign, the stops in
+    order with their times and the geometry. The ids of the route, its segments
+    and times differ from line to line and are left out; a time is hashed with
+    the number of its trip in the order of first appearance instead of its id
+    '''
+    sha = hashlib.sha256(str(route.get('name')).encode('utf-8'))
+    sha.update(str((route.get('details') or {}).get('polyline')).encode('utf-8'))
+    #(weekend, secondary, time id) -> (trip number, weekend, secondary)
+    trips = {}
+    for segment in route.get('segments') or ():
+        stop = segment.get('stop') or {}
+        parts = [stop.get('code'), bool(stop.get('is_active')),
+                 segment.get('polyline'), segment.get('length')]
+        for value in stop.get('times') or ():
+            key = (bool(value['weekend']), bool(value.get('secondary')), value['id'])
+            trip = trips.get(key)
+            if trip is None:
+                trip = trips[key] = (len(trips),) + key[:2]
+            parts.append(value['time'])
+            parts.append(trip)
+        sha.update(repr(parts).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def iter_routes(body):
+    '''
+    (route_digest, route) for every route of a getSchedule response body, a
+    binary file or bytes, so a route is known before it is transformed.
+    With ijson the routes are parsed from the file one at a time and only
+    the route being transformed is in memory, whatever the size of the line;
+    without it the whole body is decoded first.
+    '''
+    if isinstance(body, (bytes, bytearray)):
+        body = io.BytesIO(body)
+    if ijson is None:
+        routes = json.load(body).get('routes') or ()
+    else:
+        #floats as json decodes them, the digests and rows do not depend on the parser
+        routes = ijson.items(body, 'routes.item', use_float=True)
+    for route in routes:
+        yield route_digest(route), route
+        #not held while the next route is parsed
+        del route
+
+
+def streaming_available():
+    '''
+    True when the ijson package is installed
+    '''
+    return ijson is not None
+
+
+def transform_schedule(line: dict, body, frequencies: bool = False,
+                       skip=frozenset()):
+    '''
+    turn a getSchedule response body, a binary file or bytes, into trips.txt,
+    stop_times.txt and shapes.txt rows
+    returns {'trips': str, 'stop_times': str, 'shapes': {shape_id: str}}
+    with frequencies the regular-headway trips are compacted into
+    'frequencies' rows, 'compaction' holds what that saved
+    skip - the digests (see iter_routes) of the routes written by the lines
+    before, they are left out and listed in 'skipped'
+    '''
+    return transform_routes(line, iter_routes(body), frequencies, skip)
+
+
+def transform_routes(line: dict, routes, frequencies: bool = False, skip=frozenset()):
+    '''
+    build the trips and stop times of a line from the (digest, route) pairs of its schedule
+    '''
+    trips = []
+    stop_times = StopTimeTable()
+    shapes = {}
+    headsigns = get_interner('headsigns')
+    #(digest, first trip, end trip) of the routes kept
+    route_spans = []
+    route_digests = set()
+    skipped = []
+    repeated = 0
+    logger.debug("processing line %s", line["ext_id"])
+    route_id = line["line_id"]
+    for digest, route in routes:
+        if digest in route_digests:
+            #the same route listed twice in the schedule, i.e. M3
+            repeated += 1
+            route = None
+            continue
+        route_digests.add(digest)
+        if digest in skip:
+            logger.debug('route %s already written by another line', route["id"])
+            skipped.append(digest)
+            route = None
+            continue
+        ##!!! Don't forget to check if the route is active
+        #try if route["details"].["is_active"]:
+        logger.debug('Processing route %s', route["id"])
+        #per route fields, computed once
+        route_headsign = headsigns.values[headsigns.memo(route["name"], headsign)]
+        weekday_prefix = str(route["ext_id"])+'weekday'
+        weekend_prefix = str(route["ext_id"])+'weekend'
+        #(weekend, time id) -> index in stop_times.trip_ids, ordered by first appearance
+        route_trips = {}
+        route_ref = stop_times.add_route(route["id"])
+        route_first_trip = len(trips)
+        sequence = 1
+        shape = ShapeBuilder()
+        for segment in route["segments"]:
+            stop = segment["stop"]
+            if stop["is_active"]:
+                stop_ref = stop_times.stop_ref(stop["code"])
+                for value in stop.get("times") or ():
+                    #separate secondaries - what are they actually?
+                    time_id = str(value['id'])
+                    if value.get('secondary'):
+                        time_id = 'sec'+time_id
+                    key = (bool(value['weekend']), time_id)
+                    trip_ref = route_trips.get(key)
+                    if trip_ref is None:
+                        if key[0]:
+                            trip = Trip(route_id, SERVICE_HOLIDAY, weekend_prefix+time_id,
+                                        route_headsign)
+                        else:
+                            trip = Trip(route_id, SERVICE_WEEKDAY, weekday_prefix+time_id,
+                                        route_headsign)
+                        trips.append(trip)
+                        trip_ref = route_trips[key] = stop_times.add_trip(trip.trip_id, route_ref)
+                    #times after midnight are moved past 24:00 in StopTimeTable.normalize
+                    stop_times.append(trip_ref, stop_ref, sequence, parse_time(str(value['time'])))
+            sequence += 1
+            shape.add_segment(segment)
+        #every trip of a route follows its shape
+        shape_id, shape_rows = shape.finish(route)
+        if shape_id:
+            shapes[shape_id] = shape_rows
+            for trip in trips[route_first_trip:]:
+                trip.shape_id = shape_id
+        route_spans.append((digest, route_first_trip, len(trips)))
+        logger.debug("Logged %s trips", len(route_trips))
+        logger.debug('Processing route %s complete', route["id"])
+        #the parsed route is not held while the next one is parsed
+        route = segment = stop = value = None
+    stop_times.normalize()
+    if repeated:
+        logger.warning("line %s: %s repeated routes kept once", line["ext_id"], repeated)
+    #the duplicates and the times going backwards are summarized for the whole run, see logs.py
+    logger.debug("processing line %s complete: %s duplicate stop times dropped, "
+                 "%s times going backwards raised", line["ext_id"], stop_times.duplicates,
+                 stop_times.backwards)
+    tables = {'anomalies': stop_times.anomalies, 'skipped': skipped}
+    dropped = None
+    frequency_rows = []
+    if frequencies:
+        dropped, frequency_rows, compaction = compact_trips(trips, stop_times)
+        tables['compaction'] = compaction
+    #the text of every route is written in turn and its end offsets kept,
+    #so a route repeated in another line can be cut out, see RouteRegistry
+    blocks = {'trips': [], 'stop_times': [], 'frequencies': []}
+    ends = dict.fromkeys(blocks, 0)
+    spans = []
+    trip_column = stop_times.columns[0]
+    frequency_refs = [row[0] for row in frequency_rows]
+    for digest, first, end in route_spans:
+        first_row, end_row = np.searchsorted(trip_column, (first, end)).tolist()
+        route_frequencies = frequency_rows[bisect.bisect_left(frequency_refs, first):
+                                           bisect.bisect_left(frequency_refs, end)]
+        for block, text in (
+                ('trips', write_rows(trips[ref].row() for ref in range(first, end)
+                                     if dropped is None or not dropped[ref])),
+                ('stop_times', write_rows(stop_times.rows(first_row, end_row))),
+                ('frequencies', write_rows(
+                    (trips[ref].trip_id, format_time(start), format_time(finish), headway, exact)
+                    for ref, start, finish, headway, exact in route_frequencies))):
+            blocks[block].append(text)
+            ends[block] += len(text)
+        spans.append([digest, ends['trips'], ends['stop_times'], ends['frequencies']])
+    tables.update(trips=''.join(blocks['trips']),
+                  stop_times=''.join(blocks['stop_times']),
+                  shapes=shapes,
+                  routes=spans)
+    if frequencies:
+        tables['frequencies'] = ''.join(blocks['frequencies'])
+        compaction['bytes'] -= len(tables['frequencies'].encode('utf-8'))
+    return tables
+
+
+def write_rows(rows):
+    '''
+    serialize rows to csv text in one pass
+    '''
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue()
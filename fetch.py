@@ -0,0 +1,91 @@
+'''
+Concurrent download helpers.
+The schedules are fetched on a bounded thread pool and handed back in the
+order they were requested, so the generated files are identical to a
+sequential run. The request rate is limited by the client, see client.py.
+'''
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from const import (
+    FETCH_WORKERS,
+)
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    '''
+    Spaces calls evenly so that no more than rate calls per second are made
+    across all the threads sharing the limiter. rate <= 0 disables the limit.
+    '''
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        '''
+        block until the caller is allowed to make the next call
+        '''
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AsyncRateLimiter:
+    '''
+    RateLimiter for the coroutines of one event loop, waiting without blocking it
+    '''
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = time.monotonic()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def fetch_in_order(func, items: list, workers: int = FETCH_WORKERS):
+    '''
+    call func(item) for every item on a pool of workers threads
+    and yield (item, result) in the order of items.
+    At most 2*workers calls are in flight or waiting to be consumed,
+    so a slow writer does not pile up all the responses in memory.
+    workers <= 1 runs the calls one after the other in the calling thread.
+    '''
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    window = 2 * workers
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch') as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= window:
+                    done_item, future = pending.popleft()
+                    yield done_item, future.result()
+            while pending:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+        finally:
+            #stop queued downloads if the consumer gives up early
+            for _, future in pending:
+                future.cancel()
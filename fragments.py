@@ -0,0 +1,87 @@
+'''
+A per-line store of the generated rows.
+For every line the store keeps a hash of the schedule payload (and of the
+line entry, since its fields end up in the rows) next to the rows that were
+generated from it. When the hash of a new download matches, the stored rows
+are reused and the line does not go through the transform again.
+'''
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from pathlib import Path
+
+from metrics import get_metrics
+from const import (
+    FRAGMENT_DIR,
+    FRAGMENT_VERSION,
+)
+logger = logging.getLogger(__name__)
+
+
+class FragmentStore:
+    '''
+    fragments are kept in fragment_dir/<ext_id>.json.gz as
+    {"hash": ..., "tables": {"trips": ..., "stop_times": ...}}
+    '''
+
+    def __init__(self, fragment_dir: str = FRAGMENT_DIR, variant: str = ''):
+        self.fragment_dir = Path(fragment_dir)
+        #the transform options the rows depend on, i.e. frequency compaction
+        self.variant = variant
+        self.fragment_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.stats = {'skipped': 0, 'rebuilt': 0}
+
+    def digest(self, line: dict, body_sha256: str):
+        '''
+        content hash of a schedule payload (the sha256 of the body, taken as it
+        was downloaded), the line entry, the transform version and options
+        '''
+        sha = hashlib.sha256((FRAGMENT_VERSION+self.variant).encode('utf-8'))
+        sha.update(json.dumps(line, sort_keys=True).encode('utf-8'))
+        sha.update(body_sha256.encode('ascii'))
+        return sha.hexdigest()
+
+    def path_for(self, ext_id: str):
+        return self.fragment_dir / (urllib.parse.quote(str(ext_id), safe='')+'.json.gz')
+
+    def load(self, ext_id: str, digest: str):
+        '''
+        return the stored tables of the line if they were built from digest, else None
+        '''
+        try:
+            with gzip.open(self.path_for(ext_id), 'rt', encoding='utf-8') as fd:
+                fragment = json.load(fd)
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile, ValueError):
+            return None
+        if fragment.get('hash') != digest:
+            return None
+        self._count('skipped')
+        return fragment['tables']
+
+    def save(self, ext_id: str, digest: str, tables: dict):
+        '''
+        store the freshly built tables of the line
+        '''
+        path = self.path_for(ext_id)
+        temp_path = path.with_name(path.name+'.tmp')
+        with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=6) as fd:
+            json.dump({'hash': digest, 'tables': tables}, fd, ensure_ascii=False)
+        os.replace(temp_path, path)
+        self._count('rebuilt')
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def log_stats(self):
+        '''
+        log how many lines were reused and how many went through the transform
+        '''
+        get_metrics().add('lines', self.stats)
+        logger.info('lines: %s unchanged and skipped, %s rebuilt',
+                    self.stats['skipped'], self.stats['rebuilt'])
@@ -0,0 +1,89 @@
+'''
+Optional compaction of regular-headway trips into frequencies.txt.
+After the stop times of a line are normalized, its trips are grouped by
+route, service, headsign, shape, stop pattern and travel-time profile
+(the times relative to the first stop). Within a group, runs of at least
+min_trips departures at a constant headway are replaced by their first
+trip, kept as the template, and a frequencies.txt entry with
+exact_times=1, so consumers rebuild the very same departures.
+'''
+import logging
+
+import numpy as np
+
+from const import FREQUENCY_MIN_TRIPS
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIES_HEADER = "trip_id,start_time,end_time,headway_secs,exact_times\n"
+#the departures are the scheduled ones, not an approximate headway
+EXACT_TIMES = 1
+#hh:mm:ss twice, the timepoint, five commas and the newline of a stop_times.txt row
+_STOP_TIME_FIXED_BYTES = 8 + 8 + 1 + 6
+
+
+def compact_trips(trips: list, stop_times, min_trips: int = FREQUENCY_MIN_TRIPS):
+    '''
+    trips - the Trip rows of a line, indexed like stop_times.trip_ids
+    stop_times - a normalized StopTimeTable, its columns are filtered in place
+    return a mask of the trips dropped, the frequency rows as
+    (template trip, start seconds, end seconds, headway, exact_times)
+    ordered by trip and the savings
+    '''
+    saved = {'trips': 0, 'stop_times': 0, 'bytes': 0}
+    trip, stop, sequence, seconds = stop_times.columns
+    dropped = np.zeros(len(trips), dtype=bool)
+    if not len(trip):
+        return dropped, [], saved
+    starts = np.flatnonzero(np.concatenate(([True], trip[1:] != trip[:-1])))
+    ends = np.append(starts[1:], len(trip))
+    groups = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        ref = int(trip[start])
+        first = seconds[start]
+        row = trips[ref]
+        key = (row.route_id, row.service_id, row.trip_headsign, row.shape_id,
+               stop[start:end].tobytes(), sequence[start:end].tobytes(),
+               (seconds[start:end] - first).tobytes())
+        groups.setdefault(key, []).append((int(first), ref))
+    frequency_rows = []
+    for departures in groups.values():
+        if len(departures) < min_trips:
+            continue
+        departures.sort()
+        times = [departure for departure, _ in departures]
+        first = 0
+        while first < len(departures) - 1:
+            headway = times[first+1] - times[first]
+            last = first + 1
+            while last < len(departures) - 1 and times[last+1] - times[last] == headway:
+                last += 1
+            if headway > 0 and last - first + 1 >= min_trips:
+                #end_time is exclusive, the last departure is end_time - headway
+                frequency_rows.append((departures[first][1], times[first],
+                                       times[last] + headway, headway, EXACT_TIMES))
+                for _, ref in departures[first+1:last+1]:
+                    dropped[ref] = True
+                first = last + 1
+            else:
+                #a run starting inside this one would end at last too
+                first = last
+    if not frequency_rows:
+        return dropped, [], saved
+    frequency_rows.sort()
+    removed = dropped[trip]
+    saved['trips'] = int(np.count_nonzero(dropped))
+    saved['stop_times'] = int(np.count_nonzero(removed))
+    #the size of the rows that are not written, as the csv writer would write them
+    trip_id_bytes = np.array([len(trip_id.encode('utf-8')) for trip_id in stop_times.trip_ids],
+                             dtype=np.int64)
+    stop_code_bytes = np.array([len(code.encode('utf-8')) for code in stop_times.stop_codes],
+                               dtype=np.int64)
+    sequence_bytes = np.floor(np.log10(np.maximum(sequence[removed], 1))).astype(np.int64) + 1
+    saved['bytes'] = int(trip_id_bytes[trip[removed]].sum() + stop_code_bytes[stop[removed]].sum()
+                         + sequence_bytes.sum()
+                         + saved['stop_times'] * _STOP_TIME_FIXED_BYTES)
+    for ref in np.flatnonzero(dropped).tolist():
+        saved['bytes'] += len(','.join(str(field) for field in trips[ref].row()).encode('utf-8')) + 1
+    stop_times.columns = tuple(column[~removed] for column in stop_times.columns)
+    return dropped, frequency_rows, saved
@@ -0,0 +1,152 @@
+'''
+Interning of the values the schedules repeat over and over.
+    Interner       - a value to a small id, each distinct value stored once
+                     per process; the stop codes and headsigns of every line
+                     handled by a process share them
+    RouteRegistry  - the digests of the routes already written in this run,
+                     a route payload repeated in another line is transformed
+                     and written once (twice in one line, i.e. the M3
+                     duplicates, the transform keeps the first)
+'''
+import logging
+
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Interner:
+    '''
+    ids are handed out in the order the values are first seen
+    '''
+    __slots__ = ('name', 'values', '_ids')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.values = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def id(self, value):
+        '''
+        the id of value, registering it on first use
+        '''
+        ref = self._ids.get(value)
+        if ref is None:
+            ref = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return ref
+
+    def memo(self, key, compute):
+        '''
+        the id of compute(key), computed once per key
+        '''
+        ref = self._ids.get(key)
+        if ref is None:
+            ref = self._ids[key] = len(self.values)
+            self.values.append(compute(key))
+        return ref
+
+
+_interners = {}
+
+
+def get_interner(name: str):
+    '''
+    the interner of a kind of value, shared by everything in the process
+    '''
+    interner = _interners.get(name)
+    if interner is None:
+        interner = _interners[name] = Interner(name)
+    return interner
+
+
+class RouteRegistry:
+    '''
+    drops the routes of a line which an earlier line already wrote
+    the transform returns 'routes': [[digest, trips end, stop_times end, frequencies end]]
+    with the end offsets of every route in the text blocks of the line, and
+    'skipped': [digest] of the routes it did not transform since they were
+    seen() when the line was handed to it
+    carried - the trip ids already written without a digest, i.e. the rows of
+    the other lines kept from the published archive; a route whose trips are
+    among them is dropped too
+    '''
+    BLOCKS = ('trips', 'stop_times', 'frequencies')
+
+    def __init__(self, carried=()):
+        self._seen = {}
+        self.carried = set(carried)
+        self.stats = {'routes': 0, 'duplicates': 0, 'skipped': 0}
+
+    def seen(self):
+        '''
+        the digests of the routes written so far, the lines after can skip them
+        '''
+        return frozenset(self._seen)
+
+    def complete(self, tables: dict):
+        '''
+        whether every route left out of tables was written by an earlier line,
+        the stored tables of a line may have skipped a route another line no longer has
+        '''
+        return all(digest in self._seen for digest in tables.get('skipped', ()))
+
+    def unique(self, line: dict, tables: dict):
+        '''
+        tables without the routes seen in an earlier line, the lines come in order
+        '''
+        for digest in tables.get('skipped', ()):
+            self.stats['routes'] += 1
+            self.stats['duplicates'] += 1
+            self.stats['skipped'] += 1
+            logger.info('line %s repeats a route of line %s, written once',
+                        line['ext_id'], self._seen[digest])
+        spans = tables.get('routes') or ()
+        kept = []
+        start = 0
+        for digest, end, *_ in spans:
+            self.stats['routes'] += 1
+            first = self._seen.setdefault(digest, line['ext_id'])
+            if first != line['ext_id']:
+                logger.info('line %s repeats a route of line %s, written once',
+                            line['ext_id'], first)
+            elif self._carried(tables['trips'][start:end]):
+                logger.info('line %s repeats a route kept from the published archive, '
+                            'written once', line['ext_id'])
+            else:
+                first = None
+            kept.append(first is None)
+            if not kept[-1]:
+                self.stats['duplicates'] += 1
+            start = end
+        if all(kept):
+            return tables
+        unique = dict(tables)
+        for index, block in enumerate(self.BLOCKS, 1):
+            if block not in tables:
+                continue
+            text = tables[block]
+            parts = []
+            start = 0
+            for keep, span in zip(kept, spans):
+                if keep:
+                    parts.append(text[start:span[index]])
+                start = span[index]
+            unique[block] = ''.join(parts)
+        return unique
+
+    def _carried(self, trips: str):
+        #the trip ids of a route share its prefix, its first trip tells;
+        #route_id and service_id hold no comma, the trip_id is the third field
+        if not self.carried or not trips:
+            return False
+        return trips.split(',', 3)[2] in self.carried
+
+    def log_stats(self):
+        get_metrics().add('routes', self.stats)
+        logger.info('routes: %s written, %s repeated in other lines and skipped, '
+                    '%s of them not transformed', self.stats['routes'] - self.stats['duplicates'],
+                    self.stats['duplicates'], self.stats['skipped'])
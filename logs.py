@@ -0,0 +1,209 @@
+'''
+The logging of a run, kept out of the way of the code that logs.
+The console and the LOG_FILE handlers run on a background thread behind a
+queue (QueueHandler/QueueListener): logger.debug in a loop costs the
+creation of the record, the formatting and the file writes happen on the
+listener thread. That holds for arguments that cannot change, strings,
+numbers and tuples of them; a record with any other argument (a list, a
+dict, an object) is formatted when it is logged, so it shows the value of
+the call and not the one the listener finds later, and the caller pays
+for its formatting. The transform worker processes, which had no handlers,
+send their records over a multiprocessing queue to a second listener in
+the main process, so their debug detail reaches LOG_FILE too.
+Repeated events are counted by their context instead of being logged one
+by one and summarized once at the end (EventCounter), i.e. the duplicate
+stop times by line, route and stop.
+    configure_logging()          - once, at the start of the run
+    worker_logging(context)      - initializer and initargs of a process pool
+    stop_logging()               - flush what is queued, also run at exit
+With LOG_QUEUE = False the handlers are called synchronously in the main
+process, the workers still use their queue.
+'''
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from collections import Counter
+
+from const import (
+    LOG_FILE,
+    LOG_QUEUE,
+    LOG_CONSOLE_LEVEL,
+    LOG_FILE_LEVEL,
+    LOG_SUMMARY_TOP,
+)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+_lock = threading.Lock()
+_handlers = []
+_listeners = []
+_worker_queue = None
+
+
+_FROZEN = (str, int, float, bytes, type(None))
+
+
+def _frozen(value):
+    '''
+    whether value reads the same later, a scalar or a tuple of them
+    '''
+    if isinstance(value, tuple):
+        return all(_frozen(item) for item in value)
+    return isinstance(value, _FROZEN)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    puts the record on the queue, the listener formats it
+    the message of a record with mutable arguments is merged first
+    the records stay in the process, nothing needs to be made picklable
+    '''
+
+    def prepare(self, record):
+        if isinstance(record.msg, str) and _frozen(record.args):
+            return record
+        try:
+            record.msg = record.getMessage()
+        except (TypeError, ValueError):
+            #a broken format is reported by the handler formatting it
+            return record
+        record.args = None
+        return record
+
+    def handle(self, record):
+        #the queue is thread-safe, the handler lock is not needed
+        if self.filter(record):
+            self.queue.put_nowait(self.prepare(record))
+        return record
+
+
+def _listen(log_queue):
+    listener = logging.handlers.QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+def configure_logging(log_file: str = LOG_FILE, queued: bool = LOG_QUEUE,
+                      console_level: str = LOG_CONSOLE_LEVEL, file_level: str = LOG_FILE_LEVEL):
+    '''
+    attach the console and the log_file handlers to the root logger so the
+    helper modules (client etc.) are logged too, behind a queue when queued
+    called again it keeps the handlers of the first call
+    '''
+    with _lock:
+        if _handlers:
+            return
+        console_handler = logging.StreamHandler()
+        file_handler = logging.FileHandler(log_file, mode="a", encoding="utf-8")
+        console_handler.setLevel(console_level)
+        file_handler.setLevel(file_level)
+        formatter = logging.Formatter(LOG_FORMAT, style="%", datefmt=LOG_DATE_FORMAT)
+        for handler in (console_handler, file_handler):
+            handler.setFormatter(formatter)
+            _handlers.append(handler)
+        root_logger = logging.getLogger()
+        #records below both handlers' levels are not even created
+        root_logger.setLevel(min(console_handler.level, file_handler.level))
+        logging.getLogger("urllib3").setLevel("INFO")
+        if queued:
+            log_queue = queue.SimpleQueue()
+            root_logger.addHandler(_DeferredQueueHandler(log_queue))
+            _listen(log_queue)
+            atexit.register(stop_logging)
+        else:
+            for handler in _handlers:
+                root_logger.addHandler(handler)
+
+
+def worker_logging(context):
+    '''
+    (initializer, initargs) for a process pool of context: the records of the
+    workers go to the handlers of this process, (None, ()) before configure_logging
+    '''
+    global _worker_queue
+    with _lock:
+        if not _handlers:
+            return None, ()
+        if _worker_queue is None:
+            _worker_queue = context.Queue()
+            _listen(_worker_queue)
+    return init_worker, (_worker_queue, logging.getLogger().level)
+
+
+def init_worker(log_queue, level: int):
+    '''
+    send every record of a worker process to log_queue
+    '''
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(level)
+
+
+def stop_logging():
+    '''
+    write what is still queued and stop the listeners,
+    the handlers are called synchronously from then on
+    '''
+    global _worker_queue
+    with _lock:
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            if isinstance(handler, _DeferredQueueHandler):
+                root_logger.removeHandler(handler)
+                for target in _handlers:
+                    root_logger.addHandler(target)
+        while _listeners:
+            _listeners.pop().stop()
+        _worker_queue = None
+
+
+class EventCounter:
+    '''
+    a repeated event counted by its context (a tuple, i.e. line, route, stop)
+    and logged once: a summary with the most frequent contexts, and the
+    counts of every context grouped by its first fields at debug level
+    '''
+
+    def __init__(self, event: str, fields=('line', 'route', 'stop')):
+        self.event = event
+        self.fields = tuple(fields)
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, context: tuple, count: int = 1):
+        with self._lock:
+            self.counts[tuple(context)] += count
+
+    def log(self, logger, level=logging.WARNING, top: int = LOG_SUMMARY_TOP):
+        '''
+        nothing when the event never happened
+        '''
+        with self._lock:
+            counts = dict(self.counts)
+        if not counts:
+            return
+        groups = {}
+        for context, count in counts.items():
+            groups.setdefault(context[:-1], []).append((context[-1], count))
+        most = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]
+        logger.log(level, '%s: %s in %s %ss, most at %s', self.event, sum(counts.values()),
+                   len(groups), self.fields[-2] if len(self.fields) > 1 else 'context',
+                   ', '.join('%s (%s)' % (' '.join('%s %s' % pair for pair in
+                                                   zip(self.fields, context)), count)
+                             for context, count in most))
+        if logger.isEnabledFor(logging.DEBUG):
+            for group, values in sorted(groups.items()):
+                logger.debug('%s at %s: %s', self.event,
+                             ' '.join('%s %s' % pair for pair in zip(self.fields, group)),
+                             ', '.join('%s x%s' % value for value in sorted(values)))
+
+    def as_dict(self):
+        '''
+        for the run metrics: the total and the number of contexts
+        '''
+        with self._lock:
+            return {'total': sum(self.counts.values()), 'contexts': len(self.counts)}
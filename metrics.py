@@ -0,0 +1,246 @@
+'''
+Run instrumentation.
+Collects per stage wall and thread cpu time, the cpu time of the run
+and of its worker processes, per endpoint request latency
+histograms with status codes, retries and bytes received, and the row
+counts of the generated files. At the end of a run the metrics are written
+as a json report and as a Prometheus textfile for the node exporter.
+'''
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from pathlib import Path
+
+from const import (
+    METRICS_JSON,
+    METRICS_PROM,
+    LATENCY_BUCKETS,
+)
+logger = logging.getLogger(__name__)
+
+PREFIX = 'sofia_gtfs_'
+
+
+def _children_cpu_time():
+    '''
+    cpu time of the finished worker processes
+    '''
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+class Histogram:
+    '''
+    latency buckets, counts[i] holds the values in (buckets[i-1], buckets[i]]
+    and the last count the values above all the buckets
+    '''
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = 0
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        (le, count of values <= le) as Prometheus expects
+        '''
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            yield bound, running
+
+    def report(self):
+        return {'count': self.count, 'sum_s': round(self.total, 6),
+                'buckets': {_format_bound(bound): count for bound, count in self.cumulative()}}
+
+
+def _format_bound(bound: float):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class Metrics:
+    '''
+    the metrics of one run, shared by all the threads
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._cpu_started = (time.process_time(), _children_cpu_time())
+        self.stages = {}
+        self.endpoints = {}
+        self.rows = {}
+        self.extra = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        time the block as the stage name; the stages run at the same time, so
+        the cpu time is the one of the thread running the block, the threads
+        and processes it hands work to are only counted in the run's cpu
+        '''
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self._lock:
+                self.stages[name] = {'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4)}
+            logger.info('stage %s: %.2f s wall, %.2f s cpu in its thread', name, wall, cpu)
+
+    def observe_request(self, url: str, status, latency: float, size: int = 0,
+                        retry: bool = False):
+        '''
+        record one call to the API, status is the http code or the exception name
+        '''
+        endpoint = urllib.parse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'requests': 0, 'retries': 0, 'bytes': 0,
+                                                    'status': {}, 'latency': Histogram()}
+            stats['requests'] += 1
+            stats['retries'] += int(retry)
+            stats['bytes'] += size
+            stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+            stats['latency'].observe(latency)
+
+    def set_rows(self, file_name: str, rows: int):
+        with self._lock:
+            self.rows[file_name] = rows
+
+    def add(self, name: str, values: dict):
+        '''
+        attach other counters to the report, i.e. the client and cache stats
+        '''
+        with self._lock:
+            self.extra[name] = dict(values)
+
+    def cpu(self):
+        '''
+        cpu time of the run: all the threads of the process and the finished
+        worker processes
+        '''
+        process, children = self._cpu_started
+        return {'process_s': round(time.process_time() - process, 4),
+                'workers_s': round(_children_cpu_time() - children, 4)}
+
+    def report(self, success: bool = True):
+        cpu = self.cpu()
+        with self._lock:
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                    'duration_s': round(time.time() - self.started, 3),
+                    'success': success,
+                    'cpu': cpu,
+                    'stages': dict(self.stages),
+                    'endpoints': {endpoint: dict(stats, status=dict(stats['status']),
+                                                 latency=stats['latency'].report())
+                                  for endpoint, stats in self.endpoints.items()},
+                    'rows': dict(self.rows),
+                    **self.extra}
+
+    def prometheus(self, success: bool = True):
+        '''
+        the report in the Prometheus text exposition format
+        '''
+        report = self.report(success)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP '+PREFIX+name+' '+help_text)
+            lines.append('# TYPE '+PREFIX+name+' '+kind)
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append(PREFIX+name+('{'+label_text+'}' if label_text else '')+' '+
+                             repr(value))
+
+        metric('last_run_timestamp_seconds', 'gauge', 'Start of the last run.',
+               [((), self.started)])
+        metric('last_run_success', 'gauge', '1 if the last run completed.',
+               [((), int(success))])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run.',
+               [((), report['duration_s'])])
+        metric('stage_wall_seconds', 'gauge', 'Wall time of a generation stage.',
+               [((('stage', name),), stage['wall_s']) for name, stage in report['stages'].items()])
+        metric('run_cpu_seconds', 'gauge', 'Cpu time of the last run, in the process and in '
+               'the worker processes.',
+               [((('part', part[:-2]),), seconds) for part, seconds in report['cpu'].items()])
+        metric('stage_cpu_seconds', 'gauge', 'Cpu time of the thread running a generation stage.',
+               [((('stage', name),), stage['cpu_s']) for name, stage in report['stages'].items()])
+        with self._lock:
+            endpoints = list(self.endpoints.items())
+            lines.append('# HELP '+PREFIX+'request_duration_seconds Latency of the API calls.')
+            lines.append('# TYPE '+PREFIX+'request_duration_seconds histogram')
+            for endpoint, stats in endpoints:
+                for bound, count in stats['latency'].cumulative():
+                    lines.append(PREFIX+'request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                                 % (endpoint, _format_bound(bound), count))
+                lines.append(PREFIX+'request_duration_seconds_sum{endpoint="%s"} %r'
+                             % (endpoint, stats['latency'].total))
+                lines.append(PREFIX+'request_duration_seconds_count{endpoint="%s"} %d'
+                             % (endpoint, stats['latency'].count))
+        metric('requests', 'gauge', 'API calls by status code in the last run.',
+               [((('endpoint', endpoint), ('code', code)), count)
+                for endpoint, stats in report['endpoints'].items()
+                for code, count in stats['status'].items()])
+        metric('request_retries', 'gauge', 'Repeated API calls in the last run.',
+               [((('endpoint', endpoint),), stats['retries'])
+                for endpoint, stats in report['endpoints'].items()])
+        metric('response_bytes', 'gauge', 'Bytes received from the API in the last run.',
+               [((('endpoint', endpoint),), stats['bytes'])
+                for endpoint, stats in report['endpoints'].items()])
+        metric('rows', 'gauge', 'Rows written to a file of the dataset.',
+               [((('file', name),), rows) for name, rows in report['rows'].items()])
+        return '\n'.join(lines)+'\n'
+
+    def write_reports(self, json_path: str = METRICS_JSON, prom_path: str = METRICS_PROM,
+                      success: bool = True):
+        '''
+        write the json report and the Prometheus textfile, each replaced atomically
+        so the node exporter never reads half a file
+        '''
+        for path, text in ((json_path, json.dumps(self.report(success), indent=2)),
+                           (prom_path, self.prometheus(success))):
+            if not path:
+                continue
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_name(path.name+'.tmp')
+            with open(temp_path, 'wt', encoding='utf-8') as fd:
+                fd.write(text)
+            os.replace(temp_path, path)
+        logger.info('metrics written to %s and %s', json_path, prom_path)
+
+
+_metrics = None
+
+
+def get_metrics():
+    '''
+    return the metrics of the current run, creating them on first use
+    '''
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
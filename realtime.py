@@ -0,0 +1,469 @@
+'''
+Live delays from the virtual tables of the stops.
+The poller asks getVirtualTable for the next arrivals at every stop, many
+stops at a time on one event loop: the calls go through a client of its
+own (tokens, retries, circuit breaker) on a small thread pool, at most
+REALTIME_CONCURRENCY at once and REALTIME_RATE_LIMIT per second, and a
+stop asked for again while its call is in flight shares that call.
+A virtual table lists the lines serving the stop with the minutes until
+their next arrivals:
+    [{"line_id": 2, "ext_id": "M2", "type": 3, "details": [{"t": 4}, {"t": 11}]}]
+(a dict of such entries keyed by line is read the same way). The arrivals
+are matched to the scheduled departures of the route at the stop, looked
+up in the timetable index (timetable.py) built from the generated feed,
+which gives the trip and its delay. Every cycle is compared with the one
+before: only new arrivals, delays changed by at least REALTIME_DELAY_STEP
+and arrivals no longer announced are turned into updates. The trip
+updates are kept in a GTFS-Realtime-style feed (the FeedMessage layout as
+json) rewritten to REALTIME_FEED after every cycle; the updates of a
+cycle alone make a DIFFERENTIAL message.
+    python -m realtime [--stops 0593,0594] [--interval 30] [--cycles N] [--updates FILE]
+needs the timetable index, see python -m timetable build
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from client import SofiaTrafficClient
+from feed import DAY, SERVICE_WEEKDAY, SERVICE_HOLIDAY
+from fetch import AsyncRateLimiter
+from metrics import get_metrics
+from timetable import Timetable
+
+from const import (
+    VIRTUAL_TABLE_URL,
+    TIMETABLE_INDEX,
+    REALTIME_INTERVAL,
+    REALTIME_CONCURRENCY,
+    REALTIME_RATE_LIMIT,
+    REALTIME_TIMEZONE,
+    REALTIME_MATCH_WINDOW,
+    REALTIME_DELAY_STEP,
+    REALTIME_FEED,
+)
+logger = logging.getLogger(__name__)
+
+GTFS_REALTIME_VERSION = '2.0'
+#trips of the day before still running after midnight, their times are past 24:00
+AFTER_MIDNIGHT = 4 * 3600
+#an arrival is rather matched to a trip running late than to one running early
+EARLY_COST = 4
+#seconds after which an arrival gone from a virtual table has been served, not dropped
+DEPARTED_GRACE = 60
+
+
+def clock_offset(clock: str = None, timezone: str = REALTIME_TIMEZONE):
+    '''
+    seconds from the time of day in timezone to clock (hh:mm), 0 without one
+    '''
+    if not clock:
+        return 0.0
+    hours, minutes = clock.split(':')[:2]
+    now = datetime.datetime.now(ZoneInfo(timezone))
+    return (int(hours) * 3600 + int(minutes) * 60) - (now.hour * 3600 + now.minute * 60 + now.second)
+
+
+def parse_virtual_table(content: bytes):
+    '''
+    the arrivals of a getVirtualTable response as [(route_id, minutes)]
+    '''
+    table = json.loads(content) if content else []
+    lines = table.values() if isinstance(table, dict) else table
+    arrivals = []
+    for line in lines:
+        route_id = str(line.get('line_id', line.get('id')))
+        for detail in line.get('details') or ():
+            minutes = detail.get('t')
+            if minutes is not None and str(minutes).lstrip('-').isdigit():
+                arrivals.append((route_id, int(minutes)))
+    return arrivals
+
+
+def match_arrivals(predicted: list, scheduled: list, unmatched_cost: float):
+    '''
+    pair the predicted arrivals of a route at a stop with its scheduled departures,
+    both sorted, keeping their order and taking every departure once
+    lateness costs its seconds, earliness EARLY_COST times as much and an arrival
+    left without a departure unmatched_cost
+    return [(predicted index, scheduled index)]
+    '''
+    if not predicted or not scheduled:
+        return []
+    count, candidates = len(predicted), len(scheduled)
+    #cost[i][j] - the best matching of the first i arrivals to the first j departures
+    cost = [[0.0] * (candidates + 1)]
+    for i in range(1, count + 1):
+        previous = cost[-1]
+        row = [i * unmatched_cost]
+        for j in range(1, candidates + 1):
+            delay = predicted[i-1] - scheduled[j-1]
+            row.append(min(row[j-1], previous[j] + unmatched_cost,
+                           previous[j-1] + (delay if delay >= 0 else -delay * EARLY_COST)))
+        cost.append(row)
+    pairs = []
+    i, j = count, candidates
+    while i and j:
+        delay = predicted[i-1] - scheduled[j-1]
+        if cost[i][j] == cost[i-1][j-1] + (delay if delay >= 0 else -delay * EARLY_COST):
+            pairs.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif cost[i][j] == cost[i][j-1]:
+            j -= 1
+        else:
+            i -= 1
+    pairs.reverse()
+    return pairs
+
+
+class ScheduleMatcher:
+    '''
+    finds the scheduled trips behind the arrivals of a virtual table
+    '''
+
+    def __init__(self, timetable: Timetable, timezone: str = REALTIME_TIMEZONE,
+                 window: int = REALTIME_MATCH_WINDOW):
+        self.timetable = timetable
+        self.timezone = ZoneInfo(timezone)
+        self.window = window
+
+    def service_days(self, observed: float):
+        '''
+        [(service_id, yyyymmdd, seconds of its service day at observed)]
+        '''
+        now = datetime.datetime.fromtimestamp(observed, self.timezone)
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        days = [(now.date(), seconds)]
+        if seconds < AFTER_MIDNIGHT:
+            days.append((now.date() - datetime.timedelta(days=1), seconds + DAY))
+        return [(SERVICE_HOLIDAY if day.weekday() >= 5 else SERVICE_WEEKDAY,
+                 day.strftime('%Y%m%d'), offset) for day, offset in days]
+
+    def match(self, stop_id: str, arrivals: list, observed: float):
+        '''
+        arrivals - [(route_id, minutes)] at stop_id seen at observed
+        return {trip_id: (route_id, start_date, predicted epoch, delay)} and the unmatched count
+        '''
+        by_route = {}
+        for route_id, minutes in arrivals:
+            by_route.setdefault(route_id, []).append(minutes * 60)
+        matched = {}
+        unmatched = 0
+        days = self.service_days(observed)
+        for route_id, offsets in by_route.items():
+            offsets.sort()
+            #the departures of every running service day, in the seconds of the first one
+            scheduled = []
+            for service, start_date, now in days:
+                shift = now - days[0][2]
+                for seconds, trip_id, _, _ in self.timetable.departures(
+                        stop_id, now + offsets[0] - self.window,
+                        now + offsets[-1] + self.window // EARLY_COST + 1, route_id, service):
+                    scheduled.append((seconds - shift, trip_id, start_date))
+            scheduled.sort()
+            now = days[0][2]
+            pairs = match_arrivals([now + offset for offset in offsets],
+                                   [seconds for seconds, _, _ in scheduled], self.window)
+            unmatched += len(offsets) - len(pairs)
+            for arrival, departure in pairs:
+                seconds, trip_id, start_date = scheduled[departure]
+                delay = now + offsets[arrival] - seconds
+                matched[trip_id] = (route_id, start_date, int(observed) + offsets[arrival], delay)
+        return matched, unmatched
+
+
+class RealtimeFeed:
+    '''
+    the trip updates currently known, fed with the changes of every cycle
+    trips - {trip_id: {'route_id', 'start_date', 'timestamp', 'stops': {stop_id: (time, delay)}}}
+    '''
+
+    def __init__(self):
+        self.trips = {}
+
+    def apply(self, changes: list, observed: float):
+        '''
+        changes - [(stop_id, trip_id, route_id, start_date, time, delay)], time None when
+        the arrival is no longer announced
+        return a DIFFERENTIAL message with the trips changed
+        '''
+        touched = {}
+        for stop_id, trip_id, route_id, start_date, arrival, delay in changes:
+            trip = self.trips.get(trip_id)
+            if trip is None:
+                if arrival is None:
+                    continue
+                trip = self.trips[trip_id] = {'route_id': route_id, 'start_date': start_date,
+                                              'stops': {}}
+            trip['timestamp'] = int(observed)
+            updates = touched.setdefault(trip_id, {})
+            if arrival is None:
+                trip['stops'].pop(stop_id, None)
+                updates[stop_id] = None
+            else:
+                trip['stops'][stop_id] = updates[stop_id] = (arrival, delay)
+        entities = []
+        for trip_id, updates in touched.items():
+            trip = self.trips[trip_id]
+            if not trip['stops']:
+                del self.trips[trip_id]
+                entities.append({'id': trip_id, 'is_deleted': True})
+            else:
+                entities.append(self._entity(trip_id, trip, updates))
+        return self._message('DIFFERENTIAL', observed, entities)
+
+    def expire(self, observed: float):
+        '''
+        forget the arrivals that are long past, the vehicle has left
+        '''
+        for trip_id in list(self.trips):
+            stops = self.trips[trip_id]['stops']
+            for stop_id in [stop_id for stop_id, (arrival, _) in stops.items()
+                            if arrival < observed - REALTIME_MATCH_WINDOW]:
+                del stops[stop_id]
+            if not stops:
+                del self.trips[trip_id]
+
+    @staticmethod
+    def _entity(trip_id: str, trip: dict, stops: dict):
+        updates = []
+        for stop_id, value in sorted(stops.items(), key=lambda item: item[1] or (0, 0)):
+            if value is None:
+                updates.append({'stop_id': stop_id, 'schedule_relationship': 'NO_DATA'})
+            else:
+                updates.append({'stop_id': stop_id,
+                                'arrival': {'time': value[0], 'delay': value[1]}})
+        return {'id': trip_id,
+                'trip_update': {'trip': {'trip_id': trip_id, 'route_id': trip['route_id'],
+                                         'start_date': trip['start_date'],
+                                         'schedule_relationship': 'SCHEDULED'},
+                                'stop_time_update': updates,
+                                'timestamp': trip['timestamp']}}
+
+    @staticmethod
+    def _message(incrementality: str, observed: float, entities: list):
+        return {'header': {'gtfs_realtime_version': GTFS_REALTIME_VERSION,
+                           'incrementality': incrementality,
+                           'timestamp': int(observed)},
+                'entity': entities}
+
+    def full_dataset(self, observed: float):
+        return self._message('FULL_DATASET', observed, [
+            self._entity(trip_id, trip, trip['stops']) for trip_id, trip in self.trips.items()])
+
+    def write(self, path, observed: float):
+        '''
+        the FULL_DATASET message, replacing the previous one at once
+        '''
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name+'.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as fd:
+            json.dump(self.full_dataset(observed), fd, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+
+class VirtualTablePoller:
+    '''
+    polls the virtual tables of stops and keeps a RealtimeFeed up to date
+    clock - seconds added to the current time, to replay a schedule at another time of day
+    '''
+
+    def __init__(self, stops: list, matcher: ScheduleMatcher, client=None,
+                 concurrency: int = REALTIME_CONCURRENCY, rate_limit: float = REALTIME_RATE_LIMIT,
+                 delay_step: int = REALTIME_DELAY_STEP, clock: float = 0.0):
+        self.stops = list(stops)
+        self.matcher = matcher
+        #its own client, with room in the pool for the calls in flight and their hedges,
+        #whose retries and hedges keep to the rate of the poller too
+        self.client = client or SofiaTrafficClient(pool_size=2 * concurrency, rate_limit=rate_limit)
+        self.concurrency = concurrency
+        self.limiter = AsyncRateLimiter(rate_limit)
+        self.delay_step = delay_step
+        self.clock = clock
+        self.feed = RealtimeFeed()
+        #{stop_id: {trip_id: (route_id, start_date, time, delay)}} of the last cycle
+        self.snapshot = {}
+        self._inflight = {}
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix='virtual-table')
+        self._semaphore = None
+        self.stats = {'cycles': 0, 'requests': 0, 'coalesced': 0, 'errors': 0, 'stale': 0,
+                      'arrivals': 0, 'unmatched': 0, 'updates': 0, 'late_cycles': 0}
+
+    def now(self):
+        return time.time() + self.clock
+
+    def _call(self, stop_id: str):
+        '''
+        one getVirtualTable call on a pool thread, parsed there too
+        '''
+        response = self.client.post(VIRTUAL_TABLE_URL, json.dumps({'stop': stop_id}))
+        response.raise_for_status()
+        return parse_virtual_table(response.content)
+
+    async def _fetch(self, stop_id: str):
+        async with self._semaphore:
+            await self.limiter.wait()
+            observed = self.now()
+            self.stats['requests'] += 1
+            try:
+                arrivals = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._call, stop_id)
+            except Exception as error:
+                self.stats['errors'] += 1
+                logger.debug('virtual table of %s failed: %s', stop_id, error)
+                return None
+        return observed, arrivals
+
+    async def virtual_table(self, stop_id: str):
+        '''
+        (observed, [(route_id, minutes)]) of a stop, None when the call failed
+        a stop already being fetched is not asked for again
+        '''
+        task = self._inflight.get(stop_id)
+        if task is None:
+            task = self._inflight[stop_id] = asyncio.ensure_future(self._fetch(stop_id))
+            task.add_done_callback(lambda _: self._inflight.pop(stop_id, None))
+        else:
+            self.stats['coalesced'] += 1
+        return await asyncio.shield(task)
+
+    def diff(self, stop_id: str, current: dict, observed: float):
+        '''
+        the changes of a stop since the last cycle
+        '''
+        previous = self.snapshot.get(stop_id, {})
+        changes = []
+        for trip_id, (route_id, start_date, arrival, delay) in current.items():
+            old = previous.get(trip_id)
+            if old is None or abs(old[3] - delay) >= self.delay_step:
+                changes.append((stop_id, trip_id, route_id, start_date, arrival, delay))
+            else:
+                #the reported delay stays, the arrival is kept as first announced
+                current[trip_id] = old
+        for trip_id, (route_id, start_date, arrival, _) in previous.items():
+            if trip_id not in current and arrival > observed + DEPARTED_GRACE:
+                changes.append((stop_id, trip_id, route_id, start_date, None, None))
+        return changes
+
+    def _process(self, stop_id: str, observed: float, arrivals: list):
+        self.stats['arrivals'] += len(arrivals)
+        current, unmatched = self.matcher.match(stop_id, arrivals, observed)
+        self.stats['unmatched'] += unmatched
+        changes = self.diff(stop_id, current, observed)
+        self.snapshot[stop_id] = current
+        return changes
+
+    async def cycle(self, deadline: float = None):
+        '''
+        poll every stop once, return the DIFFERENTIAL message of the changes
+        the stops not answered within deadline seconds keep their previous state,
+        their calls go on and the next cycle takes their answers
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = {stop_id: asyncio.ensure_future(self.virtual_table(stop_id))
+                 for stop_id in self.stops}
+        _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        self.stats['stale'] += len(pending)
+        changes = []
+        for stop_id, task in tasks.items():
+            if task in pending or task.result() is None:
+                continue
+            observed, arrivals = task.result()
+            changes.extend(self._process(stop_id, observed, arrivals))
+        observed = self.now()
+        self.stats['cycles'] += 1
+        self.stats['updates'] += len(changes)
+        message = self.feed.apply(changes, observed)
+        self.feed.expire(observed)
+        return message
+
+    async def run(self, interval: float = REALTIME_INTERVAL, cycles: int = None,
+                  feed_path: str = REALTIME_FEED, on_update=None):
+        '''
+        a cycle every interval seconds, cycles times or for ever
+        the feed is written to feed_path and on_update(message) called after every cycle
+        '''
+        done = 0
+        while cycles is None or done < cycles:
+            started = time.monotonic()
+            #a tenth of the interval is left for the matching and the writing
+            message = await self.cycle(deadline=0.9 * interval)
+            self.feed.write(feed_path, self.now())
+            if on_update is not None:
+                on_update(message)
+            elapsed = time.monotonic() - started
+            logger.info('cycle %s: %s stops in %.2f s, %s trip updates, %s trips in the feed',
+                        self.stats['cycles'], len(self.stops), elapsed,
+                        len(message['entity']), len(self.feed.trips))
+            done += 1
+            if elapsed > interval:
+                self.stats['late_cycles'] += 1
+                logger.warning('cycle took %.1f s, longer than the %.1f s interval',
+                               elapsed, interval)
+            elif cycles is None or done < cycles:
+                await asyncio.sleep(interval - elapsed)
+
+    def log_stats(self):
+        get_metrics().add('realtime', self.stats)
+        logger.info('virtual tables: %s requests (%s coalesced, %s failed, %s too late for their '
+                    'cycle), %s arrivals (%s unmatched), %s stop updates in %s cycles, %s late',
+                    self.stats['requests'], self.stats['coalesced'], self.stats['errors'],
+                    self.stats['stale'], self.stats['arrivals'], self.stats['unmatched'],
+                    self.stats['updates'], self.stats['cycles'], self.stats['late_cycles'])
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+
+def main():
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stops', help='comma separated stop codes, all the stops by default')
+    parser.add_argument('--interval', type=float, default=REALTIME_INTERVAL)
+    parser.add_argument('--cycles', type=int)
+    parser.add_argument('--index', default=TIMETABLE_INDEX)
+    parser.add_argument('--feed', default=REALTIME_FEED)
+    parser.add_argument('--updates', help='append the DIFFERENTIAL messages to this file')
+    parser.add_argument('--clock', help='hh:mm, poll as if it were that time of day')
+    args = parser.parse_args()
+    if not Path(args.index).exists():
+        logger.error('%s not found, build it with python -m timetable build', args.index)
+        return 1
+    timetable = Timetable(args.index)
+    stops = (args.stops.split(',') if args.stops else
+             [timetable.stop_ids[index] for index in range(len(timetable.stop_ids))])
+    poller = VirtualTablePoller(stops, ScheduleMatcher(timetable), clock=clock_offset(args.clock))
+    updates = open(args.updates, 'a', encoding='utf-8') if args.updates else None
+
+    def write_update(message):
+        if updates is not None and message['entity']:
+            updates.write(json.dumps(message, separators=(',', ':'))+'\n')
+            updates.flush()
+
+    try:
+        asyncio.run(poller.run(args.interval, args.cycles, args.feed, write_update))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.log_stats()
+        poller.close()
+        if updates is not None:
+            updates.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+'''
+Building blocks that keep a run going when sofiatraffic.bg is slow or failing:
+    backoff_delay   - exponential backoff with full jitter between retries
+    LatencyTracker  - recent response times per endpoint, giving the point
+                      after which a call is hedged and the read timeout budget
+    CircuitBreaker  - pauses every worker while the upstream keeps failing
+'''
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+
+from const import (
+    RETRY_BACKOFF,
+    RETRY_BACKOFF_MAX,
+    LATENCY_WINDOW,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_QUANTILE,
+    LATENCY_BUDGET_FACTOR,
+    MIN_READ_TIMEOUT,
+    BREAKER_THRESHOLD,
+    BREAKER_COOLDOWN,
+    BREAKER_MAX_COOLDOWN,
+)
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BACKOFF, cap: float = RETRY_BACKOFF_MAX):
+    '''
+    seconds to wait before retry number attempt (0 based), a random value up to
+    base * 2^attempt so that the workers do not retry in lockstep
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    '''
+    the last window response times of every endpoint
+    '''
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES,
+                 quantile: float = HEDGE_QUANTILE):
+        self.window = window
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, latency: float):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def percentile(self, endpoint: str, quantile: float = None):
+        '''
+        the quantile of the recent latencies, None until min_samples were seen
+        '''
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        index = math.ceil((quantile or self.quantile) * len(ordered)) - 1
+        return ordered[max(0, min(index, len(ordered) - 1))]
+
+    def hedge_delay(self, endpoint: str):
+        '''
+        how long to wait for a call before sending a second one
+        '''
+        return self.percentile(endpoint)
+
+    def read_timeout(self, endpoint: str, default: float):
+        '''
+        the read timeout budget of a call, a multiple of the recent p95
+        kept between MIN_READ_TIMEOUT and default
+        '''
+        p95 = self.percentile(endpoint)
+        if p95 is None:
+            return default
+        return min(default, max(MIN_READ_TIMEOUT, LATENCY_BUDGET_FACTOR * p95))
+
+
+class CircuitBreaker:
+    '''
+    opens after threshold consecutive failures, every caller then waits for
+    the cooldown, after which a single probe call decides if it closes again
+    or stays open for twice as long (up to max_cooldown)
+    '''
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opens = 0
+        self._condition = threading.Condition()
+
+    def before_call(self):
+        '''
+        block while the breaker is open
+        '''
+        with self._condition:
+            while self.opened_at is not None:
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining <= 0 and not self.probing:
+                    #half open, let this caller probe the upstream
+                    self.probing = True
+                    return
+                self._condition.wait(remaining if remaining > 0 else None)
+
+    def success(self):
+        with self._condition:
+            self.failures = 0
+            if self.opened_at is not None:
+                logger.info('upstream recovered, resuming')
+            self.opened_at = None
+            self.probing = False
+            self.cooldown = self.base_cooldown
+            self._condition.notify_all()
+
+    def failure(self):
+        with self._condition:
+            self.failures += 1
+            if self.probing:
+                self.probing = False
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self.opened_at = time.monotonic()
+                logger.warning('upstream still failing, pausing for %.1f s', self.cooldown)
+            elif self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.opens += 1
+                logger.warning('%s failures in a row, pausing all calls for %.1f s',
+                               self.failures, self.cooldown)
+            self._condition.notify_all()
@@ -0,0 +1,146 @@
+'''
+shapes.txt from the geometry in the getSchedule responses.
+Every segment of a route (stop to next stop) carries a WKT LINESTRING and
+its length in meters. The segments are parsed as they stream by,
+simplified with a vectorized Douglas-Peucker in local meters, and joined
+into the shape of the route. shape_dist_traveled is the running sum of the
+segment lengths, spread over the points of a segment by their distance.
+A shape is identified by a hash of its content, so the same geometry gets
+the same shape_id in every route, direction and worker process, and is
+written only once. Segments shared by routes (the common corridors) are
+simplified once per process.
+'''
+import hashlib
+import logging
+from functools import lru_cache
+
+import numpy as np
+
+from const import (
+    SHAPE_TOLERANCE,
+    SHAPE_CACHE_SIZE,
+)
+logger = logging.getLogger(__name__)
+
+SHAPES_HEADER = "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n"
+#meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+#the latitude the longitudes are scaled at, Sofia
+REFERENCE_LATITUDE = 42.7
+
+
+def parse_linestring(wkt):
+    '''
+    LINESTRING (lon lat, lon lat, ...) to an (n, 2) array of lon, lat
+    an empty array for a missing or empty geometry
+    '''
+    if not wkt or '(' not in wkt:
+        return np.empty((0, 2))
+    body = wkt[wkt.index('(')+1:wkt.rindex(')')]
+    values = np.array(body.replace(',', ' ').split(), dtype=np.float64)
+    return values[:len(values) // 2 * 2].reshape(-1, 2)
+
+
+def to_meters(points: np.ndarray):
+    '''
+    lon, lat to x, y in meters on a plane around REFERENCE_LATITUDE,
+    accurate enough over the extent of a city
+    '''
+    scale = np.array((METERS_PER_DEGREE * np.cos(np.radians(REFERENCE_LATITUDE)),
+                      METERS_PER_DEGREE))
+    return points * scale
+
+
+def douglas_peucker(xy: np.ndarray, tolerance: float):
+    '''
+    indexes of the points kept by Douglas-Peucker, the first and the last always are
+    every split measures all the points of its range at once
+    '''
+    count = len(xy)
+    if count <= 2:
+        return np.arange(count)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = xy[first]
+        chord = xy[last] - start
+        offsets = xy[first+1:last] - start
+        norm = np.hypot(chord[0], chord[1])
+        if norm > 0:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / norm
+        else:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+@lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def simplify_segment(wkt: str, length, tolerance: float = SHAPE_TOLERANCE):
+    '''
+    the simplified points of a segment and their distance from its start in meters,
+    scaled so the last one is the length reported by the API
+    '''
+    points = parse_linestring(wkt)
+    if not len(points):
+        return points, np.empty(0)
+    xy = to_meters(points)
+    steps = np.hypot(*np.diff(xy, axis=0).T)
+    travelled = np.concatenate(([0.0], np.cumsum(steps)))
+    if length and travelled[-1] > 0:
+        travelled *= float(length) / travelled[-1]
+    kept = douglas_peucker(xy, tolerance)
+    return points[kept], travelled[kept]
+
+
+class ShapeBuilder:
+    '''
+    joins the segments of a route into a shape
+    '''
+    __slots__ = ('_points', '_distances', '_travelled')
+
+    def __init__(self):
+        self._points = []
+        self._distances = []
+        self._travelled = 0.0
+
+    def add_segment(self, segment: dict):
+        points, distances = simplify_segment(segment.get('polyline'), segment.get('length'))
+        if len(points):
+            self._points.append(points)
+            self._distances.append(distances + self._travelled)
+            self._travelled += distances[-1]
+        elif segment.get('length'):
+            self._travelled += float(segment['length'])
+
+    def finish(self, route: dict):
+        '''
+        (shape_id, rows text) of the route, (None, '') when it has no geometry
+        without segment polylines the route polyline is used
+        '''
+        if self._points:
+            points = np.concatenate(self._points)
+            distances = np.concatenate(self._distances)
+        else:
+            points, distances = simplify_segment((route.get('details') or {}).get('polyline'),
+                                                 None)
+        if not len(points):
+            return None, ''
+        #the segments meet at the stops, drop the repeated points
+        repeated = np.zeros(len(points), dtype=bool)
+        repeated[1:] = np.all(np.abs(np.diff(points, axis=0)) < 1e-7, axis=1)
+        points, distances = points[~repeated], distances[~repeated]
+        lines = ['%.6f,%.6f,%d,%.1f\n' % (lat, lon, sequence, distance)
+                 for sequence, ((lon, lat), distance)
+                 in enumerate(zip(points.tolist(), distances.tolist()), 1)]
+        body = ''.join(lines)
+        shape_id = 'sh'+hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+        return shape_id, ''.join(shape_id+','+line for line in lines)
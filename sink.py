@@ -0,0 +1,267 @@
+'''
+An output sink writing the dataset straight into the zip archive.
+The generators write their rows to members of the sink instead of files.
+Each member is cut into chunks that are deflated on a pool of worker
+threads (zlib releases the GIL) as independent blocks and concatenated
+into one deflate stream, so a big member like stop_times.txt is compressed
+on several cores while it is still being generated. The archive is
+assembled in a temporary file and renamed over the old one when the sink
+is closed, a failed run leaves the previous archive untouched.
+Optionally a plain .txt copy of every member is written next to it, and
+a typed Parquet copy of the biggest tables (see columnar.py), both also
+under a temporary name until the archive is complete.
+'''
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from columnar import COLUMNS, TableWriter
+from const import (
+    DATASET_ZIP,
+    ZIP_COMPRESSION_LEVEL,
+    ZIP_WORKERS,
+    ZIP_CHUNK_SIZE,
+)
+logger = logging.getLogger(__name__)
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+_ZIP32_LIMIT = 0xFFFFFFFF
+#utf-8 file names
+_FLAGS = 0x0800
+_DEFLATED = 8
+_VERSION = 20
+
+
+def _compress_chunk(data: bytes, level: int, last: bool):
+    '''
+    deflate a chunk on its own, ending on a byte boundary so that the
+    chunks of a member can be concatenated, the last one closes the stream
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class MemberWriter:
+    '''
+    a text stream for one member of the archive
+    '''
+
+    def __init__(self, sink, name: str, txt_path=None, columnar_path=None):
+        self.sink = sink
+        self.name = name
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.rows = 0
+        self.data = tempfile.TemporaryFile(dir=sink.temp_dir)
+        #the copy takes its name only once the archive is written
+        self.txt_path = txt_path
+        self.txt = open(self._txt_temp_path(), 'wb') if txt_path else None
+        self.columnar = TableWriter(name, columnar_path) if columnar_path else None
+        self._parts = []
+        self._buffered = 0
+        self._pending = deque()
+        self.closed = False
+
+    def _txt_temp_path(self):
+        return self.txt_path.with_name(self.txt_path.name+'.tmp')
+
+    def write(self, text: str):
+        if self.columnar:
+            self.columnar.write(text)
+        self._parts.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.sink.chunk_size:
+            self._flush_chunk(last=False)
+
+    def writelines(self, lines):
+        for text in lines:
+            self.write(text)
+
+    def _flush_chunk(self, last: bool):
+        data = ''.join(self._parts).encode('utf-8')
+        self._parts = []
+        self._buffered = 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.rows += data.count(b'\n')
+        if self.txt:
+            self.txt.write(data)
+        self._pending.append(self.sink.submit(data, last))
+        #keep a bounded number of chunks in flight
+        while self._pending and (last or len(self._pending) > 2 * self.sink.workers
+                                 or self._pending[0].done()):
+            compressed = self._pending.popleft().result()
+            self.data.write(compressed)
+            self.compressed_size += len(compressed)
+
+    def close(self):
+        if self.closed:
+            return
+        self._flush_chunk(last=True)
+        if self.txt:
+            self.txt.close()
+        if self.columnar:
+            self.columnar.close()
+        self.closed = True
+
+    def publish_txt(self):
+        if self.txt_path:
+            os.replace(self._txt_temp_path(), self.txt_path)
+        if self.columnar:
+            self.columnar.publish()
+
+    def discard(self):
+        for future in self._pending:
+            future.cancel()
+        if self.txt:
+            self.txt.close()
+            self._txt_temp_path().unlink(missing_ok=True)
+        if self.columnar:
+            self.columnar.discard()
+        self.data.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class FeedSink:
+    '''
+    collects the members and writes zip_path when closed
+    txt_dir - where to keep a plain copy of every member, None for no copies
+    columnar_dir - where to keep the Parquet copies, None for none (needs pyarrow)
+    '''
+
+    def __init__(self, zip_path: str = DATASET_ZIP, txt_dir: str = None,
+                 level: int = ZIP_COMPRESSION_LEVEL, workers: int = ZIP_WORKERS,
+                 chunk_size: int = ZIP_CHUNK_SIZE, columnar_dir: str = None):
+        self.zip_path = Path(zip_path)
+        self.txt_dir = Path(txt_dir) if txt_dir else None
+        self.columnar_dir = Path(columnar_dir) if columnar_dir else None
+        self.level = level
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.temp_dir = self.zip_path.parent
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.members = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='deflate')
+
+    def submit(self, data: bytes, last: bool):
+        return self._executor.submit(_compress_chunk, data, self.level, last)
+
+    def open(self, name: str):
+        '''
+        start a new member, write to it as to a text file
+        '''
+        txt_path = self.txt_dir / name if self.txt_dir else None
+        columnar_path = None
+        if self.columnar_dir and name in COLUMNS:
+            columnar_path = self.columnar_dir / (name.rsplit('.', 1)[0]+'.parquet')
+        member = MemberWriter(self, name, txt_path, columnar_path)
+        with self._lock:
+            self.members.append(member)
+        return member
+
+    def close(self, check=None):
+        '''
+        write the archive to a temporary file and move it over zip_path
+        check - called with the path of the finished temporary archive before
+        it is moved, an exception keeps the previous archive in place and so
+        does False, without an error (nothing to publish)
+        returns whether the archive was published
+        '''
+        for member in self.members:
+            member.close()
+        self._executor.shutdown()
+        temp_path = self.zip_path.with_name(self.zip_path.name+'.tmp')
+        try:
+            with open(temp_path, 'wb') as fd:
+                self._write_archive(fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            if check is not None and check(temp_path) is False:
+                for member in self.members:
+                    member.discard()
+                logger.info('%s not published, the previous archive was kept', self.zip_path)
+                return False
+            os.replace(temp_path, self.zip_path)
+            for member in self.members:
+                member.publish_txt()
+        finally:
+            temp_path.unlink(missing_ok=True)
+            for member in self.members:
+                member.data.close()
+        logger.info('%s written: %s members, %s bytes', self.zip_path, len(self.members),
+                    self.zip_path.stat().st_size)
+        return True
+
+    def row_counts(self):
+        '''
+        rows written to every member, without the header
+        '''
+        return {member.name: max(member.rows - 1, 0) for member in self.members}
+
+    def abort(self):
+        '''
+        drop everything written so far, the previous archive stays in place
+        '''
+        for member in self.members:
+            member.discard()
+        self._executor.shutdown(cancel_futures=True)
+
+    def _write_archive(self, fd):
+        now = time.localtime()
+        dos_time = (now.tm_hour << 11) | (now.tm_min << 5) | (now.tm_sec // 2)
+        dos_date = ((now.tm_year - 1980) << 9) | (now.tm_mon << 5) | now.tm_mday
+        central = []
+        for member in self.members:
+            if max(member.size, member.compressed_size, fd.tell()) > _ZIP32_LIMIT:
+                raise ValueError('zip64 is not supported, '+member.name+' is too large')
+            name = member.name.encode('utf-8')
+            offset = fd.tell()
+            fd.write(_LOCAL_HEADER.pack(0x04034b50, _VERSION, _FLAGS, _DEFLATED,
+                                        dos_time, dos_date, member.crc,
+                                        member.compressed_size, member.size,
+                                        len(name), 0))
+            fd.write(name)
+            member.data.seek(0)
+            while True:
+                block = member.data.read(1 << 20)
+                if not block:
+                    break
+                fd.write(block)
+            central.append(_CENTRAL_HEADER.pack(0x02014b50, _VERSION, _VERSION, _FLAGS,
+                                                _DEFLATED, dos_time, dos_date, member.crc,
+                                                member.compressed_size, member.size,
+                                                len(name), 0, 0, 0, 0, 0o100644 << 16,
+                                                offset) + name)
+        central_offset = fd.tell()
+        for entry in central:
+            fd.write(entry)
+        fd.write(_END_OF_CENTRAL_DIR.pack(0x06054b50, 0, 0, len(central), len(central),
+                                          fd.tell() - central_offset, central_offset, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
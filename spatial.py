@@ -0,0 +1,180 @@
+'''
+A grid index over the stop coordinates for the relations between stops.
+The stops are projected to meters (shapes.to_meters) and bucketed in square
+cells as wide as the search radius, so the stops near a stop are in its
+cell or in the 8 around it. The pairs are found for all the stops at once:
+sorted by cell, every stop finds the range of each neighbouring cell with a
+binary search, O(n log n) instead of comparing every two stops.
+    transfers.txt    - a timed transfer between every two stops within
+                       TRANSFER_RADIUS, the walk estimated from the distance
+    duplicate stops  - stops within DUPLICATE_RADIUS sharing a code or a name,
+                       i.e. one platform listed once per vehicle type
+                       (TM0593 and A0593), reported in DUPLICATE_STOPS_REPORT
+'''
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+from shapes import to_meters
+from const import (
+    TRANSFER_RADIUS,
+    WALK_SPEED,
+    WALK_DETOUR,
+    DUPLICATE_RADIUS,
+    DUPLICATE_STOPS_REPORT,
+)
+logger = logging.getLogger(__name__)
+
+TRANSFERS_HEADER = "from_stop_id,to_stop_id,transfer_type,min_transfer_time\n"
+#the transfer needs min_transfer_time seconds
+TIMED_TRANSFER = 2
+#the cells of a cell's row and the one after it, each pair of cells is visited once
+NEIGHBOUR_CELLS = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+class StopGrid:
+    '''
+    the stops at lon, lat bucketed in cells of cell meters
+    '''
+
+    def __init__(self, lon: np.ndarray, lat: np.ndarray, cell: float):
+        self.cell = cell
+        self.xy = to_meters(np.column_stack((lon, lat)))
+        cells = np.floor(self.xy / cell).astype(np.int64)
+        if len(cells):
+            cells -= cells.min(axis=0)
+        #one key per cell, with room for the row before and after every column
+        self.width = int(cells[:, 1].max()) + 3 if len(cells) else 1
+        keys = cells[:, 0] * self.width + cells[:, 1] + 1
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def pairs(self, radius: float):
+        '''
+        the stops at most radius meters apart as (first, second, meters) arrays,
+        each pair once with first < second
+        '''
+        if radius > self.cell:
+            raise ValueError('the radius is larger than the cells of the grid')
+        count = len(self.keys)
+        positions = np.arange(count)
+        firsts, seconds = [], []
+        for dx, dy in NEIGHBOUR_CELLS:
+            targets = self.keys + dx * self.width + dy
+            starts = np.searchsorted(self.keys, targets, side='left')
+            if dx == 0 and dy == 0:
+                #the stops after this one in its own cell
+                starts = positions + 1
+            ends = np.searchsorted(self.keys, targets, side='right')
+            counts = np.maximum(ends - starts, 0)
+            total = int(counts.sum())
+            if not total:
+                continue
+            first = np.repeat(positions, counts)
+            #the offset of every candidate within the range of its stop
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            firsts.append(first)
+            seconds.append(starts[first] + offsets)
+        if not firsts:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        first = self.order[np.concatenate(firsts)]
+        second = self.order[np.concatenate(seconds)]
+        meters = np.hypot(*(self.xy[first] - self.xy[second]).T)
+        close = meters <= radius
+        first, second, meters = first[close], second[close], meters[close]
+        swap = first > second
+        first[swap], second[swap] = second[swap], first[swap]
+        return first, second, meters
+
+
+def _base_code(stop: dict):
+    '''
+    the code of a stop without the vehicle type prefix of its ext_id
+    '''
+    return re.sub(r'^[^\d]+', '', str(stop.get('ext_id') or stop['code']))
+
+
+def _name(stop: dict):
+    return ' '.join(str(stop.get('name') or '').replace(',', ' ').upper().split())
+
+
+class StopRelations:
+    '''
+    the transfers and the suspected duplicates among the getAllStops stops
+    '''
+
+    def __init__(self, list_of_stops: list, transfer_radius: float = TRANSFER_RADIUS,
+                 duplicate_radius: float = DUPLICATE_RADIUS):
+        self.stops = []
+        lon, lat = [], []
+        for stop in list_of_stops:
+            try:
+                stop_lon, stop_lat = float(stop['longitude']), float(stop['latitude'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.stops.append(stop)
+            lon.append(stop_lon)
+            lat.append(stop_lat)
+        radius = max(transfer_radius, duplicate_radius)
+        self.grid = StopGrid(np.array(lon), np.array(lat), radius or 1.0)
+        self.transfer_radius = transfer_radius
+        self.duplicate_radius = duplicate_radius
+        self.first, self.second, self.meters = self.grid.pairs(radius)
+        self.duplicates = self._duplicates()
+
+    def _duplicates(self):
+        '''
+        [{'stop_id', 'duplicate_of', 'meters', 'reason'}] of the close stops alike
+        '''
+        duplicates = []
+        close = self.meters <= self.duplicate_radius
+        for first, second, meters in zip(self.first[close].tolist(), self.second[close].tolist(),
+                                         self.meters[close].tolist()):
+            stop, other = self.stops[first], self.stops[second]
+            if str(stop['code']) == str(other['code']):
+                reason = 'same stop_id'
+            elif _base_code(stop) == _base_code(other):
+                reason = 'same code'
+            elif _name(stop) and _name(stop) == _name(other):
+                reason = 'same name'
+            else:
+                continue
+            duplicates.append({'stop_id': str(other['code']), 'duplicate_of': str(stop['code']),
+                               'meters': round(meters, 1), 'reason': reason})
+        return duplicates
+
+    def transfer_rows(self):
+        '''
+        transfers.txt rows both ways between the stops within the transfer radius,
+        ordered by the stops
+        '''
+        #stops listed twice under one stop_id give one transfer, the shortest walk
+        walks = {}
+        close = self.meters <= self.transfer_radius
+        times = np.ceil(self.meters[close] * WALK_DETOUR / WALK_SPEED).astype(np.int64)
+        for first, second, seconds in zip(self.first[close].tolist(), self.second[close].tolist(),
+                                          times.tolist()):
+            from_id, to_id = str(self.stops[first]['code']), str(self.stops[second]['code'])
+            if from_id == to_id:
+                continue
+            for pair in ((from_id, to_id), (to_id, from_id)):
+                if seconds < walks.get(pair, seconds + 1):
+                    walks[pair] = seconds
+        return [(from_id, to_id, TIMED_TRANSFER, seconds)
+                for (from_id, to_id), seconds in sorted(walks.items())]
+
+    def write_report(self, path=DUPLICATE_STOPS_REPORT):
+        '''
+        the suspected duplicates as json, replacing the previous report at once
+        '''
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name+'.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as fd:
+            json.dump(self.duplicates, fd, ensure_ascii=False, indent=1)
+        os.replace(temp_path, path)
@@ -0,0 +1,120 @@
+'''
+An SQLite copy of the generated feed for quick lookups.
+Every member of the archive becomes a table of the same name, loaded in
+batches with executemany inside one transaction, with the journal and
+syncing off while loading. The indexes are built once the rows are in:
+    stop_times(stop_id, departure_time)   trips through a stop after a time
+    stop_times(trip_id, stop_sequence)    the stops of a trip
+    trips(route_id)                       the trips of a route
+The database is written under a temporary name and moved over the old one.
+    sqlite3 gtfs/SofiaTraffic.sqlite "select trip_id, departure_time from stop_times
+        where stop_id = '0593' and departure_time >= '18:00:00'"
+'''
+import csv
+import io
+import logging
+import os
+import sqlite3
+import time
+import zipfile
+from itertools import islice
+from pathlib import Path
+
+from const import (
+    DATASET_ZIP,
+    SQLITE_DB,
+    SQLITE_BATCH,
+)
+logger = logging.getLogger(__name__)
+
+#column types, the other columns are text; times stay hh:mm:ss so they compare as text
+COLUMN_TYPES = {
+    'stop_sequence': 'INTEGER',
+    'timepoint': 'INTEGER',
+    'stop_lat': 'REAL',
+    'stop_lon': 'REAL',
+    'route_type': 'INTEGER',
+    'shape_pt_lat': 'REAL',
+    'shape_pt_lon': 'REAL',
+    'shape_pt_sequence': 'INTEGER',
+    'shape_dist_traveled': 'REAL',
+    'headway_secs': 'INTEGER',
+    'exact_times': 'INTEGER',
+    'transfer_type': 'INTEGER',
+    'min_transfer_time': 'INTEGER',
+}
+INDEXES = (
+    ('stop_times_stop_departure', 'stop_times', ('stop_id', 'departure_time')),
+    ('stop_times_trip_sequence', 'stop_times', ('trip_id', 'stop_sequence')),
+    ('trips_route', 'trips', ('route_id',)),
+)
+
+
+def _quote(name: str):
+    return '"'+name.replace('"', '""')+'"'
+
+
+def load_member(connection, archive, name: str, batch: int = SQLITE_BATCH):
+    '''
+    create the table of a member and insert its rows, return the row count
+    '''
+    table = name.rsplit('.', 1)[0]
+    with archive.open(name) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        header = [field.strip() for field in next(reader, [])]
+        if not header:
+            return 0
+        connection.execute('DROP TABLE IF EXISTS '+_quote(table))
+        connection.execute('CREATE TABLE %s (%s)' % (_quote(table), ', '.join(
+            _quote(field)+' '+COLUMN_TYPES.get(field, 'TEXT') for field in header)))
+        insert = 'INSERT INTO %s VALUES (%s)' % (_quote(table), ', '.join('?' * len(header)))
+        count = 0
+        while True:
+            rows = list(islice(reader, batch))
+            if not rows:
+                break
+            connection.executemany(insert, rows)
+            count += len(rows)
+    return count
+
+
+def export_sqlite(zip_path: str = DATASET_ZIP, db_path: str = SQLITE_DB,
+                  batch: int = SQLITE_BATCH):
+    '''
+    load every member of the archive at zip_path into the database at db_path
+    return the row count of every table
+    '''
+    started = time.perf_counter()
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = db_path.with_name(db_path.name+'.tmp')
+    temp_path.unlink(missing_ok=True)
+    counts = {}
+    connection = sqlite3.connect(temp_path, isolation_level=None)
+    try:
+        #a fresh file that is thrown away on failure, no need for a journal while loading
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('BEGIN')
+        with zipfile.ZipFile(zip_path) as archive:
+            for name in archive.namelist():
+                if name.endswith('.txt'):
+                    counts[name.rsplit('.', 1)[0]] = load_member(connection, archive, name, batch)
+        for index, table, columns in INDEXES:
+            if table in counts:
+                connection.execute('CREATE INDEX %s ON %s (%s)' % (
+                    _quote(index), _quote(table), ', '.join(_quote(column) for column in columns)))
+        connection.execute('COMMIT')
+        #planner statistics from a sample of every index
+        connection.execute('PRAGMA analysis_limit = 1000')
+        connection.execute('ANALYZE')
+        connection.execute('PRAGMA journal_mode = DELETE')
+    except BaseException:
+        connection.close()
+        temp_path.unlink(missing_ok=True)
+        raise
+    connection.close()
+    os.replace(temp_path, db_path)
+    logger.info('%s written: %s rows in %s tables in %.2f s', db_path, sum(counts.values()),
+                len(counts), time.perf_counter() - started)
+    return counts
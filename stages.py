@@ -0,0 +1,228 @@
+'''
+The stages of a run as a graph.
+Every stage names the stages it needs and starts as soon as they are done,
+on a pool of STAGE_WORKERS threads, so the stages that do not depend on
+each other (the stops and the lines from the API, the static files) run
+at the same time. A subset of the stages can be run: the stages it needs
+are run too, unless they can be carried over from the previous run (a
+member of the published archive is copied instead of rebuilt), and the
+stages marked always (the archive itself) follow any stage they depend on.
+The plan is known before anything runs, with the cost of every stage
+estimated from the timings of the previous run (METRICS_JSON):
+    graph = StageGraph()
+    graph.add(Stage('lines', fetch_lines))
+    graph.add(Stage('routes.txt', write_routes, needs=('lines',)))
+    plan = graph.plan(['routes.txt'])
+    print(plan.describe())
+    results = graph.run(plan)
+'''
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import get_metrics
+from const import (
+    STAGE_WORKERS,
+    METRICS_JSON,
+)
+logger = logging.getLogger(__name__)
+
+RUN = 'run'
+CARRY = 'carry'
+
+
+class PlanError(ValueError):
+    '''
+    the stages asked for cannot be run
+    '''
+
+
+def carried_name(name: str):
+    '''
+    the name the timing of a carried stage is recorded under
+    '''
+    return name+' (carried)'
+
+
+class Stage:
+    '''
+    run - called with the results of the stages so far (a dict by stage name),
+          returns the result of the stage
+    needs - the names of the stages to finish first
+    carry - called like run to take the result of the previous run instead,
+            None when the stage has to run whenever it is needed
+    can_carry - whether carry can be used in this run (the previous output exists)
+    always - run whenever a stage it needs runs, i.e. the archive after a member
+    '''
+
+    def __init__(self, name: str, run, needs=(), carry=None, can_carry=None,
+                 always: bool = False):
+        self.name = name
+        self.run = run
+        self.needs = tuple(needs)
+        self.carry = carry
+        self.can_carry = can_carry
+        self.always = always
+
+    def carriable(self):
+        return self.carry is not None and (self.can_carry is None or self.can_carry())
+
+
+class Plan:
+    '''
+    the stages to go through in a topological order with RUN or CARRY,
+    and the estimated seconds of each
+    '''
+
+    def __init__(self, graph, actions: dict, costs: dict):
+        self.graph = graph
+        self.actions = actions
+        self.costs = costs
+        self.order = [name for name in graph.order() if name in actions]
+
+    def finish_times(self):
+        '''
+        the estimated second every stage is done at, with unlimited workers
+        '''
+        finish = {}
+        for name in self.order:
+            start = max((finish[need] for need in self.graph.stages[name].needs
+                         if need in finish), default=0.0)
+            finish[name] = start + (self.costs.get(name) or 0.0)
+        return finish
+
+    def describe(self):
+        '''
+        the plan as text, one stage per line
+        '''
+        finish = self.finish_times()
+        lines = ['%-26s %-6s %9s %9s  %s' % ('stage', 'action', 'est. s', 'done at', 'needs')]
+        for name in self.order:
+            cost = self.costs.get(name)
+            lines.append('%-26s %-6s %9s %9.2f  %s' % (
+                name, self.actions[name], '?' if cost is None else '%.2f' % cost, finish[name],
+                ', '.join(self.graph.stages[name].needs)))
+        lines.append('estimated %.2f s on the critical path, %.2f s of work' % (
+            max(finish.values(), default=0.0), sum(cost or 0.0 for cost in self.costs.values())))
+        return '\n'.join(lines)
+
+
+def previous_timings(path: str = METRICS_JSON):
+    '''
+    {stage: wall seconds} and {file: rows} of the previous run, empty without one
+    '''
+    try:
+        with open(path, encoding='utf-8') as fd:
+            report = json.load(fd)
+    except (OSError, ValueError):
+        return {}, {}
+    return ({name: stage['wall_s'] for name, stage in report.get('stages', {}).items()},
+            report.get('rows', {}))
+
+
+class StageGraph:
+    '''
+    the stages by name, added with their needs first
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage: Stage):
+        for need in stage.needs:
+            if need not in self.stages:
+                raise PlanError('stage %s needs %s, which is not in the graph'
+                                 % (stage.name, need))
+        if stage.name in self.stages:
+            raise PlanError('stage %s is already in the graph' % stage.name)
+        self.stages[stage.name] = stage
+        return stage
+
+    def order(self):
+        #the stages can only need earlier stages, the order they were added in is topological
+        return list(self.stages)
+
+    def plan(self, selected=None, costs: dict = None):
+        '''
+        the Plan for the selected stage names, all of them when None
+        costs - estimated seconds by stage name, previous_timings() when None;
+        a carried stage is estimated from its carried_name
+        '''
+        if selected is None:
+            selected = self.order()
+        unknown = [name for name in selected if name not in self.stages]
+        if unknown:
+            raise PlanError('no stage %s, the stages are: %s'
+                             % (', '.join(unknown), ', '.join(self.stages)))
+        actions = {}
+
+        def require(names):
+            pending = list(names)
+            while pending:
+                name = pending.pop()
+                if actions.get(name) == RUN:
+                    continue
+                actions[name] = RUN
+                for need in self.stages[name].needs:
+                    if need in actions or need in selected:
+                        continue
+                    if self.stages[need].carriable():
+                        actions[need] = CARRY
+                    else:
+                        pending.append(need)
+
+        require(selected)
+        for name in self.order():
+            stage = self.stages[name]
+            if stage.always and name not in actions and \
+                    any(actions.get(need) == RUN for need in stage.needs):
+                require([name])
+        if costs is None:
+            costs = previous_timings()[0]
+        return Plan(self, actions, {name: costs.get(carried_name(name) if action == CARRY else name)
+                                    for name, action in actions.items()})
+
+    def run(self, plan: Plan, workers: int = STAGE_WORKERS):
+        '''
+        go through the plan, every stage as soon as the ones it needs are done
+        returns the results by stage name; the first error is raised once
+        the stages already started have finished, the others are not started
+        '''
+        metrics = get_metrics()
+        results = {}
+        done = set()
+        waiting = list(plan.order)
+        running = {}
+
+        def call(name):
+            stage = self.stages[name]
+            action = plan.actions[name]
+            with metrics.stage(name if action == RUN else carried_name(name)):
+                return (stage.run if action == RUN else stage.carry)(results)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='stage') as pool:
+            error = None
+            while waiting or running:
+                if error is None:
+                    for name in list(waiting):
+                        if all(need in done or need not in plan.actions
+                               for need in self.stages[name].needs):
+                            waiting.remove(name)
+                            running[pool.submit(call, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException as exc:
+                        #the first error is raised, the ones after it would be lost
+                        if error is None:
+                            error = exc
+                        else:
+                            logger.error('stage %s failed too: %r', name, exc)
+                    done.add(name)
+            if error is not None:
+                raise error
+        return results
@@ -0,0 +1,7 @@
+'''
+the modules of the project are imported from the repository root
+'''
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
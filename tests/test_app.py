@@ -0,0 +1,29 @@
+'''
+a --lines run carrying the other lines from the published archive
+'''
+import csv
+import io
+import zipfile
+
+from app import carry_other_lines
+from feed import TRIPS_HEADER
+
+
+def test_carry_from_an_archive_without_shapes(tmp_path):
+    #the layout of the archives published before shapes.txt
+    path = tmp_path / 'old.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('trips.txt', 'route_id,service_id,trip_id,trip_headsign\r\n'
+                                      '43,weekday_service,TM1w1,Center\r\n'
+                                      '44,weekend_service,TM2e1,"Airport, T2"\r\n')
+        archive.writestr('stop_times.txt', 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\r\n'
+                                           'TM1w1,10:00:00,10:00:00,0001,1\r\n'
+                                           'TM2e1,11:00:00,11:00:00,0002,1\r\n')
+    trips, stop_times, shapes = io.StringIO(), io.StringIO(), io.StringIO()
+    trip_ids, shape_ids = carry_other_lines(trips, stop_times, shapes, None, {'43'}, path)
+    assert trip_ids == {'TM2e1'} and shape_ids == set()
+    rows = list(csv.reader(io.StringIO(trips.getvalue())))
+    assert rows == [['44', 'weekend_service', 'TM2e1', 'Airport, T2', '']]
+    assert len(rows[0]) == len(TRIPS_HEADER.split(','))
+    assert stop_times.getvalue() == 'TM2e1,11:00:00,11:00:00,0002,1,\n'
+    assert shapes.getvalue() == ''
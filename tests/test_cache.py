@@ -0,0 +1,40 @@
+'''
+responses streamed into the cache and the routes read back from the entry
+'''
+import hashlib
+
+from bench.synthetic import schedule_bytes
+from cache import ResponseCache
+from feed import transform_schedule
+from transform import transform_response
+
+URL = 'http://stand-in/getSchedule'
+LINE = {'line_id': 1, 'ext_id': 'A1'}
+
+
+def test_streamed_entry_is_hashed_and_read_back(tmp_path):
+    content = schedule_bytes('A1', 1, routes=3, stops=6, trips=8)
+    cache = ResponseCache(tmp_path)
+    chunks = (content[start:start+1000] for start in range(0, len(content), 1000))
+    stored = cache.put_stream(URL, 'A1', chunks)
+    assert stored.sha256() == hashlib.sha256(content).hexdigest()
+    cached = cache.get(URL, 'A1')
+    assert cached.sha256() == stored.sha256()
+    assert cached.content == content
+    assert transform_response(LINE, cached)['stop_times'] == \
+        transform_schedule(LINE, content)['stop_times']
+
+
+def test_broken_download_leaves_no_entry(tmp_path):
+    cache = ResponseCache(tmp_path)
+
+    def chunks():
+        yield b'{"routes": ['
+        raise ConnectionError('reset')
+
+    try:
+        cache.put_stream(URL, 'A1', chunks())
+    except ConnectionError:
+        pass
+    assert cache.get(URL, 'A1') is None
+    assert not list(tmp_path.rglob('*.tmp'))
@@ -0,0 +1,37 @@
+'''
+every request the client sends waits on its rate limiter
+'''
+import client
+from client import SofiaTrafficClient
+
+URL = 'http://stand-in/getSchedule'
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+
+class Answer:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.content = b'{}'
+        self.cookies = {}
+
+
+def test_retries_wait_on_the_limiter(monkeypatch):
+    monkeypatch.setattr(client, 'backoff_delay', lambda attempt: 0)
+    answers = iter([Answer(503), Answer(503), Answer(200)])
+    api = SofiaTrafficClient(pool_size=1, attempts=3)
+    api.headers = {}
+    api.limiter = CountingLimiter()
+    monkeypatch.setattr(api.session, 'request', lambda *args, **kwargs: next(answers))
+    try:
+        assert api.post(URL, '{}').status_code == 200
+    finally:
+        api.close()
+    assert api.limiter.waits == 3
+    assert api.stats['retries'] == 2
@@ -0,0 +1,155 @@
+'''
+routes written once: repeated within a line, repeated in a later line,
+and cut out of the text blocks by their offsets
+'''
+import copy
+import csv
+import io
+import json
+
+from bench.synthetic import make_schedule
+from cache import CachedResponse
+from feed import iter_routes, transform_schedule
+from fragments import FragmentStore
+from interning import RouteRegistry
+from transform import transform_in_order
+
+
+def line_of(ext_id, line_id):
+    return {'line_id': line_id, 'name': ext_id, 'ext_id': ext_id, 'type': 1, 'color': '#000000'}
+
+
+def routes_of(ext_id, line_id, routes=3):
+    return make_schedule(ext_id, line_id, routes=routes, stops=6, trips=8)['routes']
+
+
+def content(routes):
+    return json.dumps({'line': {}, 'routes': routes}, ensure_ascii=False).encode('utf-8')
+
+
+def digests(routes):
+    return [digest for digest, _ in iter_routes(content(routes))]
+
+
+def relabel(route, line_id, route_id):
+    '''
+    the route as another line lists it: the same stops and times under its own ids
+    '''
+    route = copy.deepcopy(route)
+    route.update(id=route_id, line_id=line_id, ext_id='R%s' % route_id)
+    for segment in route['segments']:
+        segment.update(id=segment['id'] + 100000, route_id=route_id)
+        for value in segment['stop']['times']:
+            value.update(id=value['id'] + 100000, route_id=route_id)
+    return route
+
+
+def trip_ids(tables):
+    return [row[2] for row in csv.reader(io.StringIO(tables['trips']))]
+
+
+def test_iter_routes_matches_json():
+    routes = routes_of('A1', 1)
+    body = b' { "routes" : ' + json.dumps(routes).encode('utf-8') + b' , "line" : {"id": 1} }'
+    pairs = list(iter_routes(body))
+    assert [route for _, route in pairs] == routes
+    assert len({digest for digest, _ in pairs}) == len(routes)
+
+
+def test_route_repeated_in_line_is_kept_once():
+    routes = routes_of('M3', 3, routes=2)
+    once = transform_schedule(line_of('M3', 3), content(routes))
+    twice = transform_schedule(line_of('M3', 3), content(routes + [routes[0]]))
+    for block in ('trips', 'stop_times'):
+        assert twice[block] == once[block]
+    assert [span[0] for span in twice['routes']] == digests(routes)
+    assert twice['skipped'] == []
+
+
+def test_route_of_an_earlier_line_is_dropped(tmp_path):
+    first = routes_of('A1', 1)
+    #the second line lists the last route of the first one too
+    second = routes_of('A2', 2, routes=2) + [first[-1]]
+    schedules = [(line_of('A1', 1), CachedResponse('', content(first))),
+                 (line_of('A2', 2), CachedResponse('', content(second)))]
+    routes = RouteRegistry()
+    out = dict((line['ext_id'], tables) for line, tables in
+               transform_in_order(schedules, FragmentStore(tmp_path), workers=1, routes=routes))
+    alone = transform_schedule(line_of('A2', 2), content(second[:-1]))
+    assert out['A2']['trips'] == alone['trips']
+    assert out['A2']['stop_times'] == alone['stop_times']
+    ids = trip_ids(out['A1']) + trip_ids(out['A2'])
+    assert len(ids) == len(set(ids))
+    #the second line was handed the routes of the first and did not transform the repeated one
+    assert out['A2']['skipped'] == digests(first)[-1:]
+    assert routes.stats == {'routes': 6, 'duplicates': 1, 'skipped': 1}
+
+
+def test_stored_line_skipping_a_route_no_longer_written(tmp_path):
+    first = routes_of('A1', 1)
+    second = routes_of('A2', 2, routes=2) + [first[-1]]
+    store = FragmentStore(tmp_path)
+
+    def run(schedules):
+        return dict((line['ext_id'], tables) for line, tables in
+                    transform_in_order(schedules, store, workers=1, routes=RouteRegistry()))
+
+    run([(line_of('A1', 1), CachedResponse('', content(first))),
+         (line_of('A2', 2), CachedResponse('', content(second)))])
+    #the first line dropped the route, the stored rows of the second one left it out
+    out = run([(line_of('A1', 1), CachedResponse('', content(first[:-1]))),
+               (line_of('A2', 2), CachedResponse('', content(second)))])
+    assert out['A2']['skipped'] == []
+    assert out['A2']['trips'] == transform_schedule(line_of('A2', 2), content(second))['trips']
+
+
+def test_unique_cuts_spans_like_the_transform_skips_them():
+    earlier = routes_of('A1', 1)
+    line = line_of('A2', 2)
+    routes = routes_of('A2', 2, routes=2)
+    routes.insert(1, earlier[0])
+    full = transform_schedule(line, content(routes), frequencies=True)
+    assert full['frequencies']
+    registry = RouteRegistry()
+    registry.unique(line_of('A1', 1), transform_schedule(line_of('A1', 1), content(earlier)))
+    skipped = transform_schedule(line, content(routes), frequencies=True, skip=registry.seen())
+    cut = registry.unique(line, full)
+    for block in ('trips', 'stop_times', 'frequencies'):
+        assert cut[block] == skipped[block]
+    assert cut['frequencies'] and len(cut['trips']) < len(full['trips'])
+    assert skipped['skipped'] == digests(earlier)[:1]
+
+
+def test_route_of_a_carried_line_is_dropped():
+    #a --lines run of A2 keeps the rows of A1, which already hold the shared route
+    carried = routes_of('A1', 1)
+    second = routes_of('A2', 2, routes=2) + [carried[-1]]
+    registry = RouteRegistry(trip_ids(transform_schedule(line_of('A1', 1), content(carried))))
+    cut = registry.unique(line_of('A2', 2), transform_schedule(line_of('A2', 2), content(second)))
+    alone = transform_schedule(line_of('A2', 2), content(second[:-1]))
+    assert cut['trips'] == alone['trips']
+    assert cut['stop_times'] == alone['stop_times']
+    assert registry.stats == {'routes': 3, 'duplicates': 1, 'skipped': 0}
+
+
+def test_route_of_an_earlier_line_under_other_ids_is_dropped(tmp_path):
+    first = routes_of('A1', 1)
+    second = routes_of('A2', 2, routes=2) + [relabel(first[-1], 2, 29)]
+    assert digests(second)[-1] == digests(first)[-1]
+    schedules = [(line_of('A1', 1), CachedResponse('', content(first))),
+                 (line_of('A2', 2), CachedResponse('', content(second)))]
+    routes = RouteRegistry()
+    out = dict((line['ext_id'], tables) for line, tables in
+               transform_in_order(schedules, FragmentStore(tmp_path), workers=1, routes=routes))
+    assert out['A2']['trips'] == transform_schedule(line_of('A2', 2), content(second[:-1]))['trips']
+    assert routes.stats == {'routes': 6, 'duplicates': 1, 'skipped': 1}
+
+
+def test_routes_with_other_times_or_trips_differ():
+    route = routes_of('A1', 1)[0]
+    later = copy.deepcopy(route)
+    later['segments'][0]['stop']['times'][0]['time'] = '23:59:00'
+    regrouped = copy.deepcopy(route)
+    times = regrouped['segments'][-1]['stop']['times']
+    times[0]['id'], times[1]['id'] = times[1]['id'], times[0]['id']
+    assert len(set(digests([route, later, regrouped]))) == 3
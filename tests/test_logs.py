@@ -0,0 +1,29 @@
+'''
+the queued records show the arguments as they were when logged
+'''
+import logging
+import queue
+
+from logs import _DeferredQueueHandler
+
+
+def queued(msg, *args):
+    log_queue = queue.SimpleQueue()
+    record = logging.getLogger('test').makeRecord('test', logging.DEBUG, __file__, 1,
+                                                  msg, args, None)
+    _DeferredQueueHandler(log_queue).handle(record)
+    return log_queue.get_nowait()
+
+
+def test_mutable_arguments_are_formatted_when_logged():
+    stops = {'A1': 3}
+    record = queued('stops %s of %s', stops, 'A1')
+    stops['A1'] = 4
+    assert record.getMessage() == "stops {'A1': 3} of A1"
+    assert record.args is None
+
+
+def test_scalar_arguments_are_left_to_the_listener():
+    record = queued('trip %s at %s (%s)', 'A1', 1.5, (2, 'x'))
+    assert record.args == ('A1', 1.5, (2, 'x'))
+    assert record.getMessage() == "trip A1 at 1.5 ((2, 'x'))"
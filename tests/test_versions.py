@@ -0,0 +1,92 @@
+'''
+the version of an archive and the delta between two of them
+'''
+import zipfile
+
+from versions import VersionStore, build_manifest, diff_archives
+
+TRIPS = 'route_id,service_id,trip_id,trip_headsign,shape_id\n'
+STOP_TIMES = 'trip_id,arrival_time,departure_time,stop_id,stop_sequence,timepoint\n'
+CALENDAR = 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+OLD = {
+    'trips.txt': TRIPS + '1,weekday_service,t1,Center,\n'
+                         '1,weekday_service,t2,Center,\n'
+                         '2,weekday_service,t3,Airport,\n',
+    'stop_times.txt': STOP_TIMES + 't1,10:00:00,10:00:00,0001,1,0\n'
+                                   't1,10:05:00,10:05:00,0002,2,0\n'
+                                   't2,11:00:00,11:00:00,0001,1,0\n'
+                                   't3,12:00:00,12:00:00,0003,1,0\n',
+    'stops.txt': 'stop_id,stop_name\n0001,A\n0002,B\n0003,C\n',
+    'calendar.txt': CALENDAR + 'weekday_service,1,1,1,1,1,0,0,20261017,20261024\n',
+}
+NEW = {
+    #t2 removed, t3 changed headsign, t4 added on route 2, t1 one time moved
+    'trips.txt': TRIPS + '1,weekday_service,t1,Center,\n'
+                         '2,weekday_service,t3,Airport T2,\n'
+                         '2,weekday_service,t4,Airport,\n',
+    'stop_times.txt': STOP_TIMES + 't1,10:00:00,10:00:00,0001,1,0\n'
+                                   't1,10:06:00,10:06:00,0002,2,0\n'
+                                   't3,12:00:00,12:00:00,0003,1,0\n'
+                                   't4,13:00:00,13:00:00,0003,1,0\n',
+    'stops.txt': OLD['stops.txt'],
+    'calendar.txt': OLD['calendar.txt'],
+}
+
+
+def archive(path, members):
+    with zipfile.ZipFile(path, 'w') as fd:
+        for name, text in members.items():
+            fd.writestr(name, text)
+    return path
+
+
+def test_version_ignores_row_order_and_dates(tmp_path):
+    reordered = dict(OLD, **{'trips.txt': TRIPS + ''.join(
+        reversed(OLD['trips.txt'].splitlines(keepends=True)[1:]))})
+    next_week = dict(OLD, **{'calendar.txt': CALENDAR +
+                             'weekday_service,1,1,1,1,1,0,0,20261024,20261031\n'})
+    old = build_manifest(archive(tmp_path / 'old.zip', OLD))
+    assert build_manifest(archive(tmp_path / 'reordered.zip', reordered))['version'] == old['version']
+    later = build_manifest(archive(tmp_path / 'later.zip', next_week))
+    assert later['version'] == old['version']
+    assert (old['valid_until'], later['valid_until']) == ('20261024', '20261031')
+    assert build_manifest(archive(tmp_path / 'new.zip', NEW))['version'] != old['version']
+
+
+def test_diff_lists_trips_per_route(tmp_path):
+    delta = diff_archives(archive(tmp_path / 'old.zip', OLD), archive(tmp_path / 'new.zip', NEW),
+                          partitions=4)
+    assert delta['tables'] == {'trips.txt': {'added': 2, 'removed': 2},
+                               'stop_times.txt': {'added': 2, 'removed': 2}}
+    assert delta['routes'] == {
+        '1': {'trips': {'added': [], 'changed': ['1,weekday_service,t1,Center,'], 'removed': ['t2']},
+              'stop_times': {'added': ['t1,10:06:00,10:06:00,0002,2,0'],
+                             'removed': ['t1,10:05:00,10:05:00,0002,2,0',
+                                         't2,11:00:00,11:00:00,0001,1,0']}},
+        '2': {'trips': {'added': ['2,weekday_service,t4,Airport,'],
+                        'changed': ['2,weekday_service,t3,Airport T2,'], 'removed': []},
+              'stop_times': {'added': ['t4,13:00:00,13:00:00,0003,1,0'], 'removed': []}}}
+
+
+def test_diff_of_other_members_counts_rows(tmp_path):
+    new = dict(OLD, **{'stops.txt': 'stop_id,stop_name\n0001,A\n0003,C\n0004,D\n0005,E\n'})
+    delta = diff_archives(archive(tmp_path / 'old.zip', OLD), archive(tmp_path / 'new.zip', new))
+    assert delta['tables'] == {'stops.txt': {'added': 2, 'removed': 1}}
+    assert delta['routes'] == {}
+
+
+def test_unchanged_version_is_not_recorded_again(tmp_path):
+    store = VersionStore(tmp_path / 'versions')
+    old_zip = archive(tmp_path / 'old.zip', OLD)
+    old = build_manifest(old_zip)
+    assert not store.unchanged(old)
+    assert store.record(old_zip, old) is None
+    assert store.unchanged(old, refresh_days=-10**5)
+    new_zip = archive(tmp_path / 'new.zip', NEW)
+    new = build_manifest(new_zip)
+    assert not store.unchanged(new)
+    delta = store.record(new_zip, new)
+    assert (delta['from'], delta['to']) == (old['version'], new['version'])
+    assert [manifest['version'] for manifest in store.versions()] == [old['version'], new['version']]
+    assert diff_archives(new_zip, new_zip) == {'from': new['version'], 'to': new['version'],
+                                               'tables': {}, 'routes': {}}
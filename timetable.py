@@ -0,0 +1,351 @@
+'''
+A next-departures index over the generated timetable.
+The departures of every stop are kept sorted by time in flat arrays:
+    seconds  int32  departure time, past 24:00 after midnight
+    trip     int32  index into the trip ids
+    route    int32  index into the route ids
+    service  uint8  index into the service ids
+with stop_offsets giving the slice of every stop, so the next departures
+from a stop are a binary search away. The index is saved as one binary
+file (a json header with the section offsets, then 8 byte aligned arrays
+and string tables) that is memory-mapped when loaded: opening it costs
+the header only, the pages are read as the queries touch them.
+    python -m timetable build [gtfs/SofiaTraffic.zip]
+    python -m timetable query 0593 18:00 [--count 5] [--service weekday_service]
+'''
+import argparse
+import csv
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from const import (
+    DATASET_ZIP,
+    TIMETABLE_INDEX,
+)
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SFTT'
+VERSION = 1
+_PREFIX = struct.Struct('<4sII')
+_ALIGN = 8
+
+
+def _parse_seconds(time_str: str):
+    hours, minutes, seconds = time_str.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def parse_clock(clock: str):
+    '''
+    hh:mm or hh:mm:ss to seconds since midnight
+    '''
+    parts = clock.split(':')
+    return int(parts[0]) * 3600 + int(parts[1]) * 60 + (int(parts[2]) if len(parts) > 2 else 0)
+
+
+def _member_rows(archive, name: str):
+    text = io.TextIOWrapper(archive.open(name), encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = [field.strip() for field in next(reader)]
+    return {field: index for index, field in enumerate(header)}, reader
+
+
+def _string_table(values: list):
+    '''
+    (offsets, blob) of utf-8 strings, value i is blob[offsets[i]:offsets[i+1]]
+    '''
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def build_index(zip_path: str = DATASET_ZIP, index_path: str = TIMETABLE_INDEX):
+    '''
+    read trips.txt and stop_times.txt from the archive and write the index file
+    return the number of departures
+    '''
+    trip_index = {}
+    trip_ids, trip_routes, trip_services = [], [], []
+    route_ids, route_index = [], {}
+    service_ids, service_index = [], {}
+    stop_ids, stop_index = [], {}
+    with zipfile.ZipFile(zip_path) as archive:
+        columns, rows = _member_rows(archive, 'trips.txt')
+        trip_column, route_column = columns['trip_id'], columns['route_id']
+        service_column = columns['service_id']
+        for row in rows:
+            route = route_index.setdefault(row[route_column], len(route_ids))
+            if route == len(route_ids):
+                route_ids.append(row[route_column])
+            service = service_index.setdefault(row[service_column], len(service_ids))
+            if service == len(service_ids):
+                service_ids.append(row[service_column])
+            trip_index[row[trip_column]] = len(trip_ids)
+            trip_ids.append(row[trip_column])
+            trip_routes.append(route)
+            trip_services.append(service)
+        columns, rows = _member_rows(archive, 'stop_times.txt')
+        trip_column, stop_column = columns['trip_id'], columns['stop_id']
+        time_column = columns['departure_time']
+        stops, trips, seconds = [], [], []
+        times = {}
+        for row in rows:
+            trip = trip_index.get(row[trip_column])
+            time_str = row[time_column]
+            if trip is None or not time_str:
+                continue
+            stop = stop_index.setdefault(row[stop_column], len(stop_ids))
+            if stop == len(stop_ids):
+                stop_ids.append(row[stop_column])
+            value = times.get(time_str)
+            if value is None:
+                value = times[time_str] = _parse_seconds(time_str)
+            stops.append(stop)
+            trips.append(trip)
+            seconds.append(value)
+        frequencies = []
+        if 'frequencies.txt' in archive.namelist():
+            columns, rows = _member_rows(archive, 'frequencies.txt')
+            for row in rows:
+                trip = trip_index.get(row[columns['trip_id']])
+                if trip is not None:
+                    frequencies.append((trip, _parse_seconds(row[columns['start_time']]),
+                                        _parse_seconds(row[columns['end_time']]),
+                                        int(row[columns['headway_secs']])))
+    if len(service_ids) > 255:
+        raise ValueError('more than 255 services do not fit the index')
+    #stops in id order, the departures sorted by stop, time and trip
+    stop_order = sorted(range(len(stop_ids)), key=stop_ids.__getitem__)
+    stop_rank = np.empty(len(stop_ids), dtype=np.int32)
+    stop_rank[stop_order] = np.arange(len(stop_ids), dtype=np.int32)
+    stops = stop_rank[np.array(stops, dtype=np.int32)]
+    seconds = np.array(seconds, dtype=np.int32)
+    trips = np.array(trips, dtype=np.int32)
+    if frequencies:
+        stops, seconds, trips = _expand_frequencies(stops, seconds, trips, frequencies)
+    order = np.lexsort((trips, seconds, stops))
+    stops, seconds, trips = stops[order], seconds[order], trips[order]
+    stop_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(stops, minlength=len(stop_ids)), out=stop_offsets[1:])
+    sections = {
+        'stop_offsets': stop_offsets,
+        'seconds': seconds,
+        'trip': trips,
+        'route': np.array(trip_routes, dtype=np.int32)[trips],
+        'service': np.array(trip_services, dtype=np.uint8)[trips],
+    }
+    for name, values in (('stop_ids', [stop_ids[index] for index in stop_order]),
+                         ('trip_ids', trip_ids), ('route_ids', route_ids),
+                         ('service_ids', service_ids)):
+        sections[name+'.offsets'], sections[name+'.blob'] = _string_table(values)
+    _write_sections(Path(index_path), sections)
+    logger.info('%s written: %s departures from %s stops', index_path, len(seconds), len(stop_ids))
+    return len(seconds)
+
+
+def _expand_frequencies(stops, seconds, trips, frequencies: list):
+    '''
+    the departures of the trips run at a headway (frequencies.txt) in place of
+    their template rows, every departure keeps the template trip id
+    '''
+    templates = np.zeros(int(trips.max()) + 1 if len(trips) else 0, dtype=bool)
+    by_trip = np.argsort(trips, kind='stable')
+    trip_offsets = np.searchsorted(trips[by_trip], np.arange(len(templates) + 1))
+    parts = []
+    for trip, start, end, headway in frequencies:
+        if trip >= len(templates) or headway <= 0:
+            continue
+        rows = by_trip[trip_offsets[trip]:trip_offsets[trip+1]]
+        if not len(rows):
+            continue
+        templates[trip] = True
+        offsets = np.arange(start, end, headway, dtype=np.int32) - seconds[rows].min()
+        parts.append((np.tile(stops[rows], len(offsets)),
+                      (seconds[rows][None, :] + offsets[:, None]).ravel(),
+                      np.full(len(rows) * len(offsets), trip, dtype=np.int32)))
+    kept = ~templates[trips]
+    parts.append((stops[kept], seconds[kept], trips[kept]))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def _write_sections(path: Path, sections: dict):
+    '''
+    magic, version, header length, json header, then the arrays 8 byte aligned
+    '''
+    header = {}
+    position = 0
+    for name, values in sections.items():
+        header[name] = {'offset': position, 'dtype': values.dtype.str, 'count': len(values)}
+        position += -(-values.nbytes // _ALIGN) * _ALIGN
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = -(-(_PREFIX.size + len(header_bytes)) // _ALIGN) * _ALIGN
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name+'.tmp')
+    with open(temp_path, 'wb') as fd:
+        fd.write(_PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        fd.write(header_bytes)
+        fd.write(b'\0' * (start - fd.tell()))
+        for name, values in sections.items():
+            fd.seek(start + header[name]['offset'])
+            fd.write(values.tobytes())
+        fd.truncate(start + position)
+    os.replace(temp_path, path)
+
+
+class StringTable:
+    '''
+    strings decoded on demand from an offsets array and a utf-8 blob,
+    each decoded once
+    '''
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = memoryview(blob)
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int):
+        value = self._decoded.get(index)
+        if value is None:
+            start, end = self.offsets[index:index+2].tolist()
+            value = self._decoded[index] = str(self.blob[start:end], 'utf-8')
+        return value
+
+
+class Timetable:
+    '''
+    a memory-mapped index file, see build_index
+    '''
+
+    def __init__(self, index_path: str = TIMETABLE_INDEX):
+        with open(index_path, 'rb') as fd:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = _PREFIX.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(str(index_path)+' is not a timetable index of version '+str(VERSION))
+        header = json.loads(self._map[_PREFIX.size:_PREFIX.size+header_length])
+        start = -(-(_PREFIX.size + header_length) // _ALIGN) * _ALIGN
+        arrays = {name: np.frombuffer(self._map, dtype=np.dtype(section['dtype']),
+                                      count=section['count'], offset=start+section['offset'])
+                  for name, section in header.items()}
+        self.stop_offsets = arrays['stop_offsets']
+        self.seconds = arrays['seconds']
+        self.trip = arrays['trip']
+        self.route = arrays['route']
+        self.service = arrays['service']
+        self.stop_ids = StringTable(arrays['stop_ids.offsets'], arrays['stop_ids.blob'])
+        self.trip_ids = StringTable(arrays['trip_ids.offsets'], arrays['trip_ids.blob'])
+        self.route_ids = StringTable(arrays['route_ids.offsets'], arrays['route_ids.blob'])
+        self.service_ids = [StringTable(arrays['service_ids.offsets'],
+                                        arrays['service_ids.blob'])[index]
+                            for index in range(len(arrays['service_ids.offsets']) - 1)]
+        #the stop and route ids are few, they are looked up by dicts built on the first query
+        self._stop_refs = None
+        self._route_refs = None
+
+    def stop_ref(self, stop_id: str):
+        '''
+        index of a stop, None if it has no departures
+        '''
+        if self._stop_refs is None:
+            self._stop_refs = {self.stop_ids[index]: index for index in range(len(self.stop_ids))}
+        return self._stop_refs.get(stop_id)
+
+    def next_departures(self, stop_id: str, after: int, count: int = 5, service: str = None):
+        '''
+        the first count departures from stop_id at or after the after seconds,
+        only the trips of service if given
+        return [(seconds, trip_id, route_id, service_id)]
+        '''
+        stop = self.stop_ref(stop_id)
+        if stop is None:
+            return []
+        start, end = self.stop_offsets[stop:stop+2].tolist()
+        first = start + int(self.seconds[start:end].searchsorted(after))
+        if service is None:
+            refs = slice(first, min(first + count, end))
+        else:
+            if service not in self.service_ids:
+                return []
+            matches = np.flatnonzero(self.service[first:end] == self.service_ids.index(service))
+            refs = first + matches[:count]
+        return self._departures(refs)
+
+    def departures(self, stop_id: str, start: int, end: int, route_id: str = None,
+                   service: str = None):
+        '''
+        the departures from stop_id from start up to end seconds,
+        only those of route_id and service if given
+        return [(seconds, trip_id, route_id, service_id)]
+        '''
+        stop = self.stop_ref(stop_id)
+        if stop is None:
+            return []
+        first, last = self.stop_offsets[stop:stop+2].tolist()
+        first, last = (first + self.seconds[first:last].searchsorted((start, end))).tolist()
+        keep = np.ones(last - first, dtype=bool)
+        if route_id is not None:
+            if self._route_refs is None:
+                self._route_refs = {self.route_ids[index]: index
+                                    for index in range(len(self.route_ids))}
+            if route_id not in self._route_refs:
+                return []
+            keep &= self.route[first:last] == self._route_refs[route_id]
+        if service is not None:
+            if service not in self.service_ids:
+                return []
+            keep &= self.service[first:last] == self.service_ids.index(service)
+        return self._departures(first + np.flatnonzero(keep))
+
+    def _departures(self, refs):
+        return [(seconds, self.trip_ids[trip], self.route_ids[route], self.service_ids[ref])
+                for seconds, trip, route, ref in zip(
+                    self.seconds[refs].tolist(), self.trip[refs].tolist(),
+                    self.route[refs].tolist(), self.service[refs].tolist())]
+
+    def close(self):
+        self.stop_offsets = self.seconds = self.trip = self.route = self.service = None
+        self.stop_ids = self.trip_ids = self.route_ids = self._stop_refs = self._route_refs = None
+        self._map.close()
+
+
+def main():
+    logging.basicConfig(level='INFO', format='%(message)s')
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build')
+    build.add_argument('archive', nargs='?', default=DATASET_ZIP)
+    build.add_argument('--index', default=TIMETABLE_INDEX)
+    query = commands.add_parser('query')
+    query.add_argument('stop_id')
+    query.add_argument('time', help='hh:mm')
+    query.add_argument('--count', type=int, default=5)
+    query.add_argument('--service')
+    query.add_argument('--index', default=TIMETABLE_INDEX)
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_index(args.archive, args.index)
+        return
+    timetable = Timetable(args.index)
+    for seconds, trip_id, route_id, service_id in timetable.next_departures(
+            args.stop_id, parse_clock(args.time), args.count, args.service):
+        print('%02d:%02d:%02d route %s trip %s (%s)' % (seconds // 3600, seconds // 60 % 60,
+                                                        seconds % 60, route_id, trip_id,
+                                                        service_id))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
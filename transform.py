@@ -0,0 +1,112 @@
+'''
+The schedule-to-rows transform stage.
+Turning a downloaded schedule into rows is pure cpu work and every line is
+independent, so the lines are transformed on a pool of worker processes.
+Each worker returns the encoded blocks of one line and the blocks are
+handed back in the order of the lines, the output is identical to a run
+in a single process. A worker is told which routes the lines before have
+already written and does not transform them again.
+The workers are handed the cached response of a line, not its body: they
+read the routes from the cache file as they transform them.
+'''
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from feed import transform_schedule
+from logs import worker_logging
+from const import TRANSFORM_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def transform_response(line: dict, schedule, frequencies: bool = False, skip=frozenset()):
+    '''
+    transform_schedule reading the body of the CachedResponse schedule as it goes
+    '''
+    with schedule.open() as body:
+        return transform_schedule(line, body, frequencies, skip)
+
+
+def _body_sha256(line: dict, schedule):
+    #only the answers with a body are cached, the others are a failed download
+    if schedule.status_code != 200:
+        raise ValueError('line %s: the schedule was answered with %s'
+                         % (line['ext_id'], schedule.status_code))
+    return schedule.sha256()
+
+
+def transform_in_order(schedules, store, workers: int = TRANSFORM_WORKERS,
+                       frequencies: bool = False, routes=None):
+    '''
+    schedules - (line, response) pairs, i.e. from fetch_in_order
+    store - the FragmentStore, lines with an unchanged schedule are not transformed
+    frequencies - compact the regular-headway trips, see frequencies.py
+    routes - the RouteRegistry of the run, the routes an earlier line wrote are
+    not transformed again and the tables come without them
+    yield (line, tables) in the order of schedules
+    workers <= 1 transforms the lines in the calling process, i.e. for debugging
+    '''
+    def seen():
+        return routes.seen() if routes is not None else frozenset()
+
+    def done(line, digest, schedule, tables):
+        if routes is None:
+            return line, tables
+        if not routes.complete(tables):
+            #stored while a line before it had a route it no longer has
+            logger.debug("line %s skipped a route no longer written, transformed again",
+                         line["ext_id"])
+            tables = transform_response(line, schedule, frequencies, seen())
+            store.save(line['ext_id'], digest, tables)
+        return line, routes.unique(line, tables)
+
+    if workers <= 1:
+        for line, schedule in schedules:
+            digest = store.digest(line, _body_sha256(line, schedule))
+            tables = store.load(line['ext_id'], digest)
+            if tables is None:
+                tables = transform_response(line, schedule, frequencies, seen())
+                store.save(line['ext_id'], digest, tables)
+            yield done(line, digest, schedule, tables)
+        return
+    window = 2 * workers
+    pending = deque()
+
+    def finish():
+        line, digest, schedule, result = pending.popleft()
+        if isinstance(result, Future):
+            result = result.result()
+            store.save(line['ext_id'], digest, result)
+        return done(line, digest, schedule, result)
+
+    #spawn, the download threads are running while the pool starts
+    context = multiprocessing.get_context('spawn')
+    #the workers log through the handlers of this process
+    initializer, initargs = worker_logging(context)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer,
+                             initargs=initargs) as executor:
+        try:
+            for line, schedule in schedules:
+                #lines with an unchanged schedule reuse the rows of the previous run
+                digest = store.digest(line, _body_sha256(line, schedule))
+                tables = store.load(line['ext_id'], digest)
+                if tables is None:
+                    #the routes of the lines still in the pool are cut out by routes.unique
+                    pending.append((line, digest, schedule,
+                                    executor.submit(transform_response, line, schedule,
+                                                    frequencies, seen())))
+                else:
+                    logger.debug("line %s unchanged", line["ext_id"])
+                    pending.append((line, digest, schedule, tables))
+                while pending and (len(pending) > window
+                                   or not isinstance(pending[0][3], Future)
+                                   or pending[0][3].done()):
+                    yield finish()
+            while pending:
+                yield finish()
+        finally:
+            for *_, result in pending:
+                if isinstance(result, Future):
+                    result.cancel()
@@ -0,0 +1,391 @@
+'''
+An in-process integrity check of the generated archive.
+Every member is streamed once in dependency order (routes, stops,
+calendar and shapes before trips, trips before stop_times) and the keys of each
+table are kept in hash sets, so the references of the following tables
+are checked as their rows go by. stop_times.txt is checked with a small
+state per trip instead of an index of its rows.
+Problems are reported as notices with a code, a severity and a few sample
+rows, written as json. Any error fails the run and the archive is not
+published.
+    python -m validate [gtfs/SofiaTraffic.zip]
+'''
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+from const import (
+    DATASET_ZIP,
+    VALIDATION_REPORT,
+    VALIDATION_SAMPLES,
+)
+logger = logging.getLogger(__name__)
+
+ERROR = 'ERROR'
+WARNING = 'WARNING'
+
+#columns every member must have
+REQUIRED_COLUMNS = {
+    'agency.txt': ('agency_name', 'agency_url', 'agency_timezone'),
+    'stops.txt': ('stop_id',),
+    'routes.txt': ('route_id', 'route_type'),
+    'trips.txt': ('route_id', 'service_id', 'trip_id'),
+    'stop_times.txt': ('trip_id', 'stop_id', 'stop_sequence'),
+    'calendar.txt': ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                     'saturday', 'sunday', 'start_date', 'end_date'),
+    'feed_info.txt': ('feed_publisher_name', 'feed_publisher_url', 'feed_lang'),
+}
+#columns of the optional members, checked when the member is there
+OPTIONAL_COLUMNS = {
+    'shapes.txt': ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'),
+    'frequencies.txt': ('trip_id', 'start_time', 'end_time', 'headway_secs'),
+    'transfers.txt': ('from_stop_id', 'to_stop_id', 'transfer_type'),
+}
+#the primary key of the members with a single column key
+PRIMARY_KEYS = {
+    'agency.txt': 'agency_id',
+    'stops.txt': 'stop_id',
+    'routes.txt': 'route_id',
+    'trips.txt': 'trip_id',
+    'calendar.txt': 'service_id',
+}
+#columns referencing the key of another member, empty values are not checked
+REFERENCES = {
+    'trips.txt': (('route_id', 'routes.txt'), ('service_id', 'calendar.txt'),
+                  ('shape_id', 'shapes.txt')),
+    'frequencies.txt': (('trip_id', 'trips.txt'),),
+    'transfers.txt': (('from_stop_id', 'stops.txt'), ('to_stop_id', 'stops.txt')),
+}
+
+
+class ValidationError(ValueError):
+    '''
+    raised when the feed has errors, the report holds the details
+    '''
+
+    def __init__(self, report):
+        super().__init__('%s validation errors, see %s' % (report.errors, report.path))
+        self.report = report
+
+
+class ValidationReport:
+    '''
+    the notices found in a feed, counted per code with up to samples examples each
+    '''
+
+    def __init__(self, path: str = VALIDATION_REPORT, samples: int = VALIDATION_SAMPLES):
+        self.path = path
+        self.samples = samples
+        self.notices = {}
+        self.rows = {}
+        self.duration = 0.0
+
+    def add(self, code: str, severity: str, file_name: str, **sample):
+        notice = self.notices.get(code)
+        if notice is None:
+            notice = self.notices[code] = {'severity': severity, 'count': 0, 'samples': []}
+        notice['count'] += 1
+        if len(notice['samples']) < self.samples:
+            notice['samples'].append(dict(file=file_name, **sample))
+
+    def _count(self, severity: str):
+        return sum(notice['count'] for notice in self.notices.values()
+                   if notice['severity'] == severity)
+
+    @property
+    def errors(self):
+        return self._count(ERROR)
+
+    @property
+    def warnings(self):
+        return self._count(WARNING)
+
+    @property
+    def valid(self):
+        return self.errors == 0
+
+    def to_dict(self):
+        return {'valid': self.valid, 'errors': self.errors, 'warnings': self.warnings,
+                'duration_s': round(self.duration, 3), 'rows': dict(self.rows),
+                'notices': self.notices}
+
+    def write(self):
+        '''
+        write the report as json, replacing the old one atomically
+        '''
+        if not self.path:
+            return
+        path = Path(self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name+'.tmp')
+        with open(temp_path, 'wt', encoding='utf-8') as fd:
+            json.dump(self.to_dict(), fd, indent=2, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+
+def parse_gtfs_time(time_str: str):
+    '''
+    hh:mm:ss (hours may go past 24) to seconds, None if malformed
+    '''
+    parts = time_str.split(':')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    hours, minutes, seconds = (int(part) for part in parts)
+    if minutes > 59 or seconds > 59:
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class FeedValidator:
+    '''
+    validates the archive at zip_path, see validate_feed
+    '''
+
+    def __init__(self, zip_path: str, report: ValidationReport):
+        self.zip_path = zip_path
+        self.report = report
+        self.keys = {}
+
+    def run(self):
+        started = time.perf_counter()
+        with zipfile.ZipFile(self.zip_path) as archive:
+            names = set(archive.namelist())
+            for file_name in REQUIRED_COLUMNS:
+                if file_name not in names:
+                    self.report.add('missing_required_file', ERROR, file_name)
+            for file_name in ('agency.txt', 'routes.txt', 'stops.txt', 'calendar.txt',
+                              'feed_info.txt', 'trips.txt', 'frequencies.txt', 'transfers.txt'):
+                if file_name in names:
+                    self._check_table(archive, file_name)
+                if file_name == 'calendar.txt' and 'shapes.txt' in names:
+                    self._check_shapes(archive)
+            if 'stop_times.txt' in names:
+                self._check_stop_times(archive)
+        self.report.duration = time.perf_counter() - started
+        return self.report
+
+    def _rows(self, archive, file_name: str):
+        '''
+        the header as a column -> index dict and an iterator over the other rows,
+        counted in the report as they are read
+        '''
+        text = io.TextIOWrapper(archive.open(file_name), encoding='utf-8-sig', newline='')
+        reader = csv.reader(text)
+        header = next(reader, None)
+        columns = self._check_header(file_name, header or [])
+
+        def rows():
+            count = 0
+            for row in reader:
+                count += 1
+                if len(row) != len(header):
+                    self.report.add('wrong_number_of_fields', ERROR, file_name,
+                                    row=count, expected=len(header), found=len(row))
+                    continue
+                yield count, row
+            self.report.rows[file_name] = count
+        return columns, rows()
+
+    def _check_header(self, file_name: str, header: list):
+        if not header:
+            self.report.add('empty_file', ERROR, file_name)
+        seen = set()
+        for field in header:
+            if field != field.strip():
+                self.report.add('header_whitespace', ERROR, file_name, field=field)
+            if not field.strip():
+                self.report.add('empty_column_name', ERROR, file_name)
+            if field.strip() in seen:
+                self.report.add('duplicate_column', ERROR, file_name, field=field)
+            seen.add(field.strip())
+        for field in REQUIRED_COLUMNS.get(file_name, OPTIONAL_COLUMNS.get(file_name, ())):
+            if field not in seen:
+                self.report.add('missing_required_column', ERROR, file_name, field=field)
+        return {field.strip(): index for index, field in enumerate(header)}
+
+    def _reference(self, file_name: str, row: int, field: str, value: str, parent: str):
+        '''
+        value must be a key of the parent table, skipped if the parent is missing
+        the hot loops test the key themselves and call this only on a miss
+        '''
+        keys = self.keys.get(parent)
+        if keys is not None and value not in keys:
+            self.report.add('foreign_key_violation', ERROR, file_name, row=row,
+                            field=field, value=value, parent=parent)
+
+    def _check_table(self, archive, file_name: str):
+        columns, rows = self._rows(archive, file_name)
+        key_field = PRIMARY_KEYS.get(file_name)
+        key_index = columns.get(key_field)
+        keys = set()
+        if key_index is not None:
+            self.keys[file_name] = keys
+        references = [(field, columns[field], parent)
+                      for field, parent in REFERENCES.get(file_name, ()) if field in columns]
+        for row_number, row in rows:
+            if key_index is not None:
+                key = row[key_index]
+                if key in keys:
+                    self.report.add('duplicate_key', ERROR, file_name, row=row_number,
+                                    field=key_field, value=key)
+                keys.add(key)
+            for field, index, parent in references:
+                if row[index]:
+                    self._reference(file_name, row_number, field, row[index], parent)
+
+    def _check_shapes(self, archive):
+        '''
+        shape ids for the references of trips.txt, unique (shape_id, shape_pt_sequence)
+        and shape_dist_traveled growing along the points of a shape
+        '''
+        file_name = 'shapes.txt'
+        columns, rows = self._rows(archive, file_name)
+        shape_index = columns.get('shape_id')
+        sequence_index = columns.get('shape_pt_sequence')
+        distance_index = columns.get('shape_dist_traveled')
+        keys = self.keys[file_name] = set()
+        points = {}
+        for row_number, row in rows:
+            if shape_index is None or sequence_index is None:
+                continue
+            shape_id = row[shape_index]
+            keys.add(shape_id)
+            try:
+                sequence = int(row[sequence_index])
+                distance = float(row[distance_index]) if distance_index is not None \
+                    and row[distance_index] else None
+            except ValueError:
+                self.report.add('invalid_shape_point', ERROR, file_name, row=row_number)
+                continue
+            points.setdefault(shape_id, []).append((sequence, distance, row_number))
+        for shape_id, entries in points.items():
+            entries.sort()
+            for previous, entry in zip(entries, entries[1:]):
+                if entry[0] == previous[0]:
+                    self.report.add('duplicate_key', ERROR, file_name, row=entry[2],
+                                    field='shape_id,shape_pt_sequence',
+                                    value='%s,%s' % (shape_id, entry[0]))
+                elif None not in (entry[1], previous[1]) and entry[1] < previous[1]:
+                    self.report.add('decreasing_shape_distance', ERROR, file_name,
+                                    row=entry[2], shape_id=shape_id)
+
+    def _check_stop_times(self, archive):
+        '''
+        the rows of a trip normally follow each other in stop_sequence order,
+        so a trip only keeps its last sequence and time; a trip whose rows come
+        out of order has them collected and checked at the end
+        '''
+        file_name = 'stop_times.txt'
+        columns, rows = self._rows(archive, file_name)
+        trip_index = columns.get('trip_id')
+        stop_index = columns.get('stop_id')
+        sequence_index = columns.get('stop_sequence')
+        if trip_index is None or stop_index is None or sequence_index is None:
+            for _ in rows:
+                pass
+            return
+        time_indexes = [columns[field] for field in ('arrival_time', 'departure_time')
+                        if field in columns]
+        trips = self.keys.get('trips.txt')
+        stops = self.keys.get('stops.txt')
+        times = {}
+        last = {}
+        unordered = {}
+        for row_number, row in rows:
+            trip_id = row[trip_index]
+            if trips is not None and trip_id not in trips:
+                self._reference(file_name, row_number, 'trip_id', trip_id, 'trips.txt')
+            if stops is not None and row[stop_index] not in stops:
+                self._reference(file_name, row_number, 'stop_id', row[stop_index], 'stops.txt')
+            sequence = row[sequence_index]
+            if not sequence.isdigit():
+                self.report.add('invalid_stop_sequence', ERROR, file_name, row=row_number,
+                                value=sequence)
+                continue
+            sequence = int(sequence)
+            seconds = None
+            for index in time_indexes:
+                time_str = row[index]
+                if not time_str:
+                    continue
+                #a feed has only so many distinct times
+                parsed = times.get(time_str)
+                if parsed is None:
+                    parsed = times[time_str] = parse_gtfs_time(time_str)
+                if parsed is None:
+                    self.report.add('invalid_time', ERROR, file_name, row=row_number,
+                                    value=time_str)
+                elif seconds is None or parsed > seconds:
+                    seconds = parsed
+            if trip_id in unordered:
+                unordered[trip_id].append((sequence, seconds, row_number))
+                continue
+            previous = last.get(trip_id)
+            if previous is not None:
+                if sequence <= previous[0]:
+                    #out of order, check the whole trip once it is read
+                    unordered[trip_id] = [previous, (sequence, seconds, row_number)]
+                    continue
+                if seconds is None:
+                    seconds = previous[1]
+                elif previous[1] is not None and seconds < previous[1]:
+                    self._decreasing(trip_id, sequence, row_number)
+            last[trip_id] = (sequence, seconds, row_number)
+        for trip_id, entries in unordered.items():
+            #the rows before the first out of order one were checked already
+            entries.sort()
+            previous = None
+            for entry in entries:
+                if previous is not None and entry[0] == previous[0]:
+                    self.report.add('duplicate_key', ERROR, file_name, row=entry[2],
+                                    field='trip_id,stop_sequence',
+                                    value='%s,%s' % (trip_id, entry[0]))
+                    continue
+                if previous is not None:
+                    if entry[1] is None:
+                        entry = (entry[0], previous[1], entry[2])
+                    elif previous[1] is not None and entry[1] < previous[1]:
+                        self._decreasing(trip_id, entry[0], entry[2])
+                previous = entry
+        if trips is not None:
+            for trip_id in trips.difference(last):
+                self.report.add('trip_without_stop_times', WARNING, 'trips.txt', value=trip_id)
+
+    def _decreasing(self, trip_id: str, sequence: int, row: int):
+        self.report.add('decreasing_stop_time', ERROR, 'stop_times.txt', row=row,
+                        trip_id=trip_id, stop_sequence=sequence)
+
+
+def validate_feed(zip_path: str = DATASET_ZIP, report_path: str = VALIDATION_REPORT,
+                  raise_on_error: bool = True):
+    '''
+    check the archive at zip_path and write the report to report_path
+    raises ValidationError when errors were found (unless raise_on_error is False)
+    '''
+    report = FeedValidator(zip_path, ValidationReport(report_path)).run()
+    report.write()
+    for code, notice in report.notices.items():
+        logger.log(logging.ERROR if notice['severity'] == ERROR else logging.WARNING,
+                   'validation %s: %s x %s', notice['severity'].lower(), code, notice['count'])
+    logger.info('%s validated in %.2f s: %s errors, %s warnings', zip_path, report.duration,
+                report.errors, report.warnings)
+    if raise_on_error and not report.valid:
+        raise ValidationError(report)
+    return report
+
+
+def main():
+    logging.basicConfig(level='INFO', format='%(message)s')
+    zip_path = sys.argv[1] if len(sys.argv) > 1 else DATASET_ZIP
+    report = validate_feed(zip_path, raise_on_error=False)
+    sys.exit(0 if report.valid else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+'''
+Content-addressed versions of the feed and the delta between two of them.
+Every row of a member is hashed and the hashes are added up, so the hash
+of a member only depends on its content, not on the order the rows were
+written in, and a member is hashed as it is read. The hashes of all the
+members make the manifest, and the hash of the manifest is the version.
+The dates of the calendar and of feed_info, which move every day, are left
+out of the hashes: a version is its schedule, the dates are only in the
+archive, and an unchanged version is published again once they are about
+to run out (VERSION_REFRESH_DAYS). A published archive is kept in
+VERSIONS_DIR as <version>.zip next to <version>.json (the manifest), and
+latest.json names the current one; a run producing the version already
+published publishes nothing.
+The delta between two versions compares them member by member. Only the
+members whose hashes differ are read: the rows of both archives are
+streamed into DIFF_PARTITIONS temporary files by a hash of the trip id
+(trips.txt, stop_times.txt) or of the row (the other members), and the
+partitions are compared one at a time, so only a partition of each feed
+is ever in memory. The delta lists per route the trips added, removed and
+changed with the stop_times rows added and removed, and for the other
+members the number of rows added and removed:
+    {"from": version, "to": version, "tables": {name: {"added": n, "removed": n}},
+     "routes": {route_id: {"trips": {"added": [row], "changed": [row], "removed": [trip_id]},
+                           "stop_times": {"added": [row], "removed": [row]}}}}
+    python -m versions list
+    python -m versions manifest gtfs/SofiaTraffic.zip
+    python -m versions diff OLD NEW [--out delta.json]
+'''
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from const import (
+    DATASET_ZIP,
+    VERSIONS_DIR,
+    VERSIONS_KEEP,
+    DIFF_PARTITIONS,
+    VERSION_REFRESH_DAYS,
+)
+logger = logging.getLogger(__name__)
+
+#the members compared trip by trip, the others row by row
+TRIP_TABLES = ('trips.txt', 'stop_times.txt')
+#bytes of a member read at a time when it is split
+BLOCK_SIZE = 1 << 20
+#the columns holding the dates of the run, not part of the version
+DATE_COLUMNS = {'calendar.txt': ('start_date', 'end_date'),
+                'feed_info.txt': ('feed_start_date', 'feed_end_date')}
+
+
+def _header(line: bytes):
+    return line.decode('utf-8-sig').rstrip('\r\n')
+
+
+def _blocks(fd, size: int = BLOCK_SIZE):
+    '''
+    the rest of a member as lists of rows (bytes), without the empty ones
+    '''
+    tail = b''
+    while True:
+        block = fd.read(size)
+        if not block:
+            break
+        rows = (tail + block).split(b'\n')
+        tail = rows.pop()
+        yield [row.rstrip(b'\r') for row in rows if row and row != b'\r']
+    if tail.strip():
+        yield [tail.rstrip(b'\r')]
+
+
+def table_hash(archive, name: str, dates=()):
+    '''
+    sha256 of the header and the rows of a member in any order, the row count
+    and the latest value of the dates columns, which are hashed empty
+    every row is hashed and the hashes are added up (four 64 bit lanes,
+    modulo 2**64), so the member is read block by block, never held in memory
+    '''
+    with archive.open(name) as fd:
+        header = _header(fd.readline())
+        fields = [field.strip() for field in header.split(',')]
+        columns = [fields.index(column) for column in dates if column in fields]
+        lanes = np.zeros(4, dtype='<u8')
+        rows = 0
+        latest = None
+        for block in _blocks(fd):
+            if columns:
+                block = [row.split(b',') for row in block]
+                for row in block:
+                    for column in columns:
+                        if column < len(row):
+                            latest = max(latest or '', row[column].strip().decode('utf-8'))
+                            row[column] = b''
+                block = [b','.join(row) for row in block]
+            digests = b''.join([hashlib.sha256(row).digest() for row in block])
+            lanes += np.frombuffer(digests, dtype='<u8').reshape(-1, 4).sum(axis=0, dtype='<u8')
+            rows += len(block)
+    sha = hashlib.sha256(header.encode('utf-8'))
+    sha.update(lanes.tobytes())
+    return sha.hexdigest(), rows, latest
+
+
+def build_manifest(zip_path: str):
+    '''
+    {'version', 'created', 'valid_until', 'tables': {name: {'sha256', 'rows'}}} of an
+    archive, valid_until is the last date of its calendar (YYYYMMDD), None without one
+    '''
+    tables = {}
+    valid_until = None
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in sorted(archive.namelist()):
+            digest, rows, latest = table_hash(archive, name, DATE_COLUMNS.get(name, ()))
+            tables[name] = {'sha256': digest, 'rows': rows}
+            if latest:
+                valid_until = max(valid_until or '', latest)
+    version = hashlib.sha256(''.join(name+tables[name]['sha256'] for name in tables)
+                             .encode('utf-8')).hexdigest()[:20]
+    return {'version': version,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'valid_until': valid_until,
+            'tables': tables}
+
+
+def _write_json(path: Path, value):
+    temp_path = path.with_name(path.name+'.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as fd:
+        json.dump(value, fd, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+class _Partitions:
+    '''
+    the rows of a member spread over count files by the hash of a key
+    '''
+
+    def __init__(self, directory: Path, count: int):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.paths = [directory / str(index) for index in range(count)]
+
+    def fill(self, blocks, key_of):
+        '''
+        blocks - lists of rows, key_of - the key of a row
+        the partition of a key is only the same within the process (hash())
+        '''
+        files = [open(path, 'wb') for path in self.paths]
+        try:
+            count = len(files)
+            for block in blocks:
+                parts = [[] for _ in files]
+                for row in block:
+                    parts[hash(key_of(row)) % count].append(row)
+                for fd, part in zip(files, parts):
+                    if part:
+                        fd.write(b'\n'.join(part) + b'\n')
+        finally:
+            for fd in files:
+                fd.close()
+
+    def read(self, index: int):
+        with open(self.paths[index], 'rb') as fd:
+            return fd.read().split(b'\n')[:-1]
+
+
+def _trip_key(column: int):
+    if column == 0:
+        return lambda row: row[:row.find(b',')]
+    return lambda row: row.split(b',', column + 1)[column]
+
+
+def _row_key(row: bytes):
+    return row
+
+
+def _column(header: str, name: str):
+    fields = [field.strip() for field in header.split(',')]
+    return fields.index(name)
+
+
+def _multiset_diff(old_rows: list, new_rows: list):
+    '''
+    (rows only in new, rows only in old), repeated rows counted
+    '''
+    old, new = set(old_rows), set(new_rows)
+    if len(old) == len(old_rows) and len(new) == len(new_rows):
+        return list(new - old), list(old - new)
+    old, new = Counter(old_rows), Counter(new_rows)
+    return list((new - old).elements()), list((old - new).elements())
+
+
+def diff_archives(old_zip: str, new_zip: str, old_manifest: dict = None,
+                  new_manifest: dict = None, partitions: int = DIFF_PARTITIONS):
+    '''
+    the delta from the archive at old_zip to the one at new_zip, see the module doc
+    the manifests are built when not given
+    '''
+    old_manifest = old_manifest or build_manifest(old_zip)
+    new_manifest = new_manifest or build_manifest(new_zip)
+    old_tables, new_tables = old_manifest['tables'], new_manifest['tables']
+    delta = {'from': old_manifest['version'], 'to': new_manifest['version'],
+             'tables': {}, 'routes': {}}
+    changed = [name for name in sorted(set(old_tables) | set(new_tables))
+               if old_tables.get(name, {}).get('sha256') != new_tables.get(name, {}).get('sha256')]
+    spread_names = list(changed)
+    #the trips give the routes of the stop_times, both are needed when either changed
+    if any(name in changed for name in TRIP_TABLES):
+        spread_names += [name for name in TRIP_TABLES if name not in changed]
+    with tempfile.TemporaryDirectory(prefix='gtfs-diff-') as temp_dir, \
+            zipfile.ZipFile(old_zip) as old_archive, zipfile.ZipFile(new_zip) as new_archive:
+        temp_dir = Path(temp_dir)
+        spread = {}
+        for side, archive in (('old', old_archive), ('new', new_archive)):
+            names = set(archive.namelist())
+            for name in spread_names:
+                parts = spread[side, name] = _Partitions(temp_dir / side / name, partitions)
+                if name not in names:
+                    parts.fill((), _row_key)
+                    continue
+                with archive.open(name) as fd:
+                    header = spread[side, name, 'header'] = _header(fd.readline())
+                    key_of = _trip_key(_column(header, 'trip_id')) if name in TRIP_TABLES \
+                        else _row_key
+                    parts.fill(_blocks(fd), key_of)
+        for name in changed:
+            if name in TRIP_TABLES:
+                continue
+            counts = delta['tables'][name] = {'added': 0, 'removed': 0}
+            for index in range(partitions):
+                added, removed = _multiset_diff(spread['old', name].read(index),
+                                                spread['new', name].read(index))
+                counts['added'] += len(added)
+                counts['removed'] += len(removed)
+        if any(name in changed for name in TRIP_TABLES):
+            _diff_trips(delta, spread, partitions)
+    return delta
+
+
+def _route_of(delta: dict, route_id: str):
+    return delta['routes'].setdefault(route_id, {
+        'trips': {'added': [], 'changed': [], 'removed': []},
+        'stop_times': {'added': [], 'removed': []}})
+
+
+def _diff_trips(delta: dict, spread: dict, partitions: int):
+    '''
+    trips.txt and stop_times.txt partition by partition, both are split by
+    trip id so a partition holds every row of its trips on either side;
+    the partitions are compared as sets and only the rows that differ are
+    grouped by trip
+    '''
+    counts = {name: {'added': 0, 'removed': 0} for name in TRIP_TABLES}
+    trip_key = {side: _trip_key(_column_of(spread, side, 'trips.txt', 'trip_id'))
+                for side in ('old', 'new')}
+    route_column = {side: _column_of(spread, side, 'trips.txt', 'route_id')
+                    for side in ('old', 'new')}
+    stop_time_key = {side: _trip_key(_column_of(spread, side, 'stop_times.txt', 'trip_id'))
+                     for side in ('old', 'new')}
+    for index in range(partitions):
+        trips = {}
+        rows = {}
+        for side in ('old', 'new'):
+            for name in TRIP_TABLES:
+                parts = spread.get((side, name))
+                rows[side, name] = parts.read(index) if parts else []
+            for row in rows[side, 'trips.txt']:
+                trips.setdefault(trip_key[side](row), {})[side] = row
+        added, removed = _multiset_diff(rows['old', 'stop_times.txt'], rows['new', 'stop_times.txt'])
+        counts['stop_times.txt']['added'] += len(added)
+        counts['stop_times.txt']['removed'] += len(removed)
+        stop_times = {}
+        for side, side_rows in (('new', added), ('old', removed)):
+            for row in side_rows:
+                stop_times.setdefault(stop_time_key[side](row), {}).setdefault(side, []).append(row)
+        touched = set(stop_times)
+        touched.update(trip_id for trip_id, sides in trips.items()
+                       if sides.get('old') != sides.get('new'))
+        for trip_id in sorted(touched):
+            old_trip = trips.get(trip_id, {}).get('old')
+            new_trip = trips.get(trip_id, {}).get('new')
+            side = 'new' if new_trip is not None else 'old'
+            trip = new_trip if new_trip is not None else old_trip
+            route_id = trip.split(b',')[route_column[side]].decode('utf-8') if trip else ''
+            route = _route_of(delta, route_id)
+            if old_trip is None and new_trip is not None:
+                route['trips']['added'].append(new_trip.decode('utf-8'))
+                counts['trips.txt']['added'] += 1
+            elif new_trip is None and old_trip is not None:
+                route['trips']['removed'].append(trip_id.decode('utf-8'))
+                counts['trips.txt']['removed'] += 1
+            else:
+                if trip is not None:
+                    route['trips']['changed'].append(trip.decode('utf-8'))
+                if old_trip != new_trip:
+                    counts['trips.txt']['added'] += 1
+                    counts['trips.txt']['removed'] += 1
+            changes = stop_times.get(trip_id, {})
+            route['stop_times']['added'].extend(row.decode('utf-8')
+                                                for row in sorted(changes.get('new', ())))
+            route['stop_times']['removed'].extend(row.decode('utf-8')
+                                                  for row in sorted(changes.get('old', ())))
+    #the partition of a trip depends on the process, the order must not
+    for route in delta['routes'].values():
+        for rows in route.values():
+            for kind in rows.values():
+                kind.sort()
+    for name in TRIP_TABLES:
+        if counts[name]['added'] or counts[name]['removed']:
+            delta['tables'][name] = counts[name]
+
+
+def _column_of(spread: dict, side: str, name: str, column: str):
+    header = spread.get((side, name, 'header'))
+    return _column(header, column) if header else 0
+
+
+def summary(delta: dict):
+    '''
+    a line about the delta for the log
+    '''
+    trips = [sum(len(route['trips'][kind]) for route in delta['routes'].values())
+             for kind in ('added', 'changed', 'removed')]
+    return '%s -> %s: %d routes with %d trips added, %d changed, %d removed; %s' % (
+        delta['from'], delta['to'], len(delta['routes']), *trips,
+        ', '.join('%s +%d -%d' % (name, counts['added'], counts['removed'])
+                  for name, counts in sorted(delta['tables'].items())) or 'no table changed')
+
+
+class VersionStore:
+    '''
+    the published versions in directory: <version>.zip, <version>.json (the
+    manifest with the previous version), <version>.delta.json (the delta from
+    the previous version) and latest.json, the manifest of the current one
+    '''
+
+    def __init__(self, directory: str = VERSIONS_DIR, keep: int = VERSIONS_KEEP):
+        self.directory = Path(directory)
+        self.keep = keep
+
+    def latest(self):
+        '''
+        the manifest of the current version, None before the first one
+        '''
+        try:
+            with open(self.directory / 'latest.json', encoding='utf-8') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, version: str):
+        with open(self.directory / (version+'.json'), encoding='utf-8') as fd:
+            return json.load(fd)
+
+    def archive(self, version: str):
+        return self.directory / (version+'.zip')
+
+    def versions(self):
+        '''
+        the manifests kept, oldest first, following the previous versions from the latest
+        '''
+        manifests = []
+        seen = set()
+        manifest = self.latest()
+        #a version published again points back to the one after it
+        while manifest is not None and manifest['version'] not in seen:
+            seen.add(manifest['version'])
+            manifests.append(manifest)
+            try:
+                manifest = self.manifest(manifest['previous']) if manifest['previous'] else None
+            except FileNotFoundError:
+                manifest = None
+        return manifests[::-1]
+
+    def unchanged(self, manifest: dict, refresh_days: int = VERSION_REFRESH_DAYS):
+        '''
+        whether manifest is the version published, with dates that do not run out
+        within refresh_days
+        '''
+        latest = self.latest()
+        if latest is None or latest['version'] != manifest['version']:
+            return False
+        refresh = datetime.date.today() + datetime.timedelta(days=refresh_days)
+        return not latest.get('valid_until') or latest['valid_until'] > refresh.strftime('%Y%m%d')
+
+    def record(self, zip_path: str, manifest: dict):
+        '''
+        keep the archive published at zip_path as the version of manifest,
+        with the delta from the previous version, and drop the oldest versions
+        returns the delta, None for the first version
+        '''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        version = manifest['version']
+        previous = self.latest()
+        if previous and previous['version'] == version:
+            #the same schedule with new dates keeps its place after the previous version
+            logger.info('version %s published again, valid until %s', version,
+                        manifest.get('valid_until'))
+            previous = self.manifest(previous['previous']) if previous['previous'] else None
+        manifest = dict(manifest, previous=previous['version'] if previous else None)
+        archive = self.archive(version)
+        temp_path = archive.with_name(archive.name+'.tmp')
+        temp_path.unlink(missing_ok=True)
+        try:
+            os.link(zip_path, temp_path)
+        except OSError:
+            shutil.copyfile(zip_path, temp_path)
+        os.replace(temp_path, archive)
+        delta = None
+        if previous and self.archive(previous['version']).exists():
+            delta = diff_archives(self.archive(previous['version']), archive, previous, manifest)
+            _write_json(self.directory / (version+'.delta.json'), delta)
+            logger.info('delta %s', summary(delta))
+        _write_json(self.directory / (version+'.json'), manifest)
+        _write_json(self.directory / 'latest.json', manifest)
+        self._prune()
+        return delta
+
+    def _prune(self):
+        '''
+        drop all but the keep latest versions
+        '''
+        kept = {manifest['version'] for manifest in self.versions()[-self.keep:]}
+        for path in self.directory.glob('*.zip'):
+            version = path.name[:-len('.zip')]
+            if version in kept:
+                continue
+            for name in (version+'.zip', version+'.json', version+'.delta.json'):
+                (self.directory / name).unlink(missing_ok=True)
+            logger.debug('version %s dropped', version)
+
+
+def _resolve(store: VersionStore, name: str):
+    '''
+    an archive path and its manifest from a version id or an archive path
+    '''
+    if store.archive(name).exists():
+        return store.archive(name), store.manifest(name)
+    return Path(name), None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=VERSIONS_DIR, help='the version store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='the versions kept')
+    manifest_parser = commands.add_parser('manifest', help='the manifest of an archive')
+    manifest_parser.add_argument('archive', nargs='?', default=DATASET_ZIP)
+    diff_parser = commands.add_parser('diff', help='the delta between two versions or archives')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.add_argument('--out', help='write the delta here instead of the standard output')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    store = VersionStore(args.dir)
+    if args.command == 'list':
+        latest = store.latest()
+        for manifest in store.versions():
+            rows = sum(table['rows'] for table in manifest['tables'].values())
+            print(manifest['version'], manifest['created'], rows, 'rows',
+                  '(latest)' if latest and latest['version'] == manifest['version'] else '')
+    elif args.command == 'manifest':
+        json.dump(build_manifest(args.archive), sys.stdout, indent=1)
+        print()
+    else:
+        old_zip, old_manifest = _resolve(store, args.old)
+        new_zip, new_manifest = _resolve(store, args.new)
+        delta = diff_archives(old_zip, new_zip, old_manifest, new_manifest)
+        logger.info(summary(delta))
+        if args.out:
+            _write_json(Path(args.out), delta)
+        else:
+            json.dump(delta, sys.stdout, ensure_ascii=False, indent=1)
+            print()
+
+
+if __name__ == '__main__':
+    main()